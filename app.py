@@ -5,11 +5,12 @@ This module sets up the Flask app, registers extensions, and wires
 blueprints together so that ``app`` remains importable for
 gunicorn / wsgi callsites and for blueprint modules that need ``mail``.
 """
+import hmac
 import os
-from datetime import datetime, timezone
 
-from flask import Flask, session, redirect, url_for, flash, request
-from models import db, connect_db, User
+from flask import Flask, redirect, url_for, flash, request
+from kombu import Queue
+from models import db, connect_db, User  # noqa: F401 — re-exported for tests
 from config import (
     SECRET_KEY,
     FLASK_DEBUG,
@@ -17,6 +18,8 @@ from config import (
     SESSION_COOKIE_HTTPONLY,
     SESSION_COOKIE_SAMESITE,
     SESSION_COOKIE_SECURE,
+    SESSION_STORE,
+    SESSION_LOCAL_CACHE_TTL,
     SECURE_SSL_REDIRECT,
     MAIL_SERVER,
     MAIL_PORT,
@@ -25,12 +28,73 @@ from config import (
     MAIL_USERNAME,
     MAIL_PASSWORD,
     MAIL_DEFAULT_SENDER,
+    MAIL_MAX_EMAILS,
     RATELIMIT_ENABLED,
+    RATELIMIT_LOCAL_PRECHECK,
+    BCRYPT_LOG_ROUNDS,
+    BCRYPT_TARGET_MS,
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_HASH_TIMEOUT,
+    THUMB_CACHE_MAX_BYTES,
+    UPLOAD_SENDFILE,
+    UPLOAD_ACCEL_REDIRECT_PREFIX,
+    UPLOAD_STORAGE,
+    S3_BUCKET,
+    S3_PREFIX,
+    S3_ENDPOINT_URL,
+    S3_REGION,
+    S3_ACCESS_KEY_ID,
+    S3_SECRET_ACCESS_KEY,
+    S3_PRESIGN_TTL,
+    S3_PUBLIC_URL,
+    UNVERIFIED_ACCOUNT_TTL_DAYS,
+    APPEAL_ARCHIVE_AFTER_DAYS,
     REDIS_URL,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT,
+    REDIS_SOCKET_TIMEOUT,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_BREAKER_THRESHOLD,
+    REDIS_RECONNECT_MAX,
+    CACHE_LOCAL_MAX_ITEMS,
+    CELERY_LOCAL_WORKERS,
+    CELERY_LOCAL_BACKLOG,
+    SERVER_TIMING_SAMPLE_RATE,
+    QUERY_BUDGET_MODE,
+    METRICS_TOKEN,
     ADMIN_USERNAME,
     ADMIN_EMAIL,
 )
-from extensions import csrf, mail, migrate, limiter, cache, celery
+from extensions import csrf, mail, migrate, limiter, flood_guard, cache, celery, redis_pool
+from services.user_context import get_current_user
+from services import passwords, sessions
+from services.thumb_cache import UPSTREAM_ORIGIN as THUMB_UPSTREAM_ORIGIN
+from services.storage import upload_origin
+from upload_stream import UploadRequest
+from task_fallback import FallbackTask
+import metrics
+import request_timing
+import query_counter
+
+
+# Celery queues.  Email and image work a user is waiting on goes to
+# ``transactional``; broadcast fan-out and thumbnail downloads (a miss is
+# already answered with a redirect upstream) to ``bulk``; beat sweeps to
+# ``maintenance``.  Each queue is served by its own worker profile (see
+# celery_worker.py), so a verification email never waits behind a
+# broadcast or a nightly job.
+CELERY_QUEUES = ('transactional', 'bulk', 'maintenance')
+
+CELERY_TASK_ROUTES = {
+    'email_service.*': {'queue': 'transactional'},
+    'cocktail_service.process_staged_image': {'queue': 'transactional'},
+    'broadcast_service.*': {'queue': 'bulk'},
+    'thumb_cache.fetch_thumb': {'queue': 'bulk'},
+    'cocktail_service.collect_orphaned_api_cocktails': {'queue': 'maintenance'},
+    'thumb_cache.prune_thumb_cache': {'queue': 'maintenance'},
+    'upload_gc.*': {'queue': 'maintenance'},
+    'maintenance.*': {'queue': 'maintenance'},
+}
 
 
 def _celery_init(app):
@@ -38,9 +102,15 @@ def _celery_init(app):
 
     Tasks decorated with ``@celery.task`` will automatically run inside
     a pushed application context, giving them access to ``current_app``,
-    Flask-Mail, SQLAlchemy, etc.
+    Flask-Mail, SQLAlchemy, etc.  ``FallbackTask`` keeps ``apply_async``
+    from blocking on a broker that is down (task_fallback.py).
     """
-    class _FlaskTask(celery.Task):
+    base = celery.Task
+    # create_app() may run more than once (tests); add the mixin only once.
+    if not issubclass(base, FallbackTask):
+        base = type('FallbackTask', (FallbackTask, base), {})
+
+    class _FlaskTask(base):
         def __call__(self, *args, **kwargs):
             with app.app_context():
                 return self.run(*args, **kwargs)
@@ -52,21 +122,79 @@ def _celery_init(app):
         'task_serializer': 'json',
         'result_serializer': 'json',
         'accept_content': ['json'],
+        'task_queues': [Queue(name) for name in CELERY_QUEUES],
+        'task_routes': CELERY_TASK_ROUTES,
+        'task_default_queue': 'transactional',
+        # Reserve one message per process unless a worker profile says
+        # otherwise, so a long task cannot sit on messages others could run.
+        'worker_prefetch_multiplier': 1,
+        # kombu and the result backend keep their own pools; give them the
+        # same bound and connection hygiene as the shared pool.
+        'broker_pool_limit': app.config['REDIS_MAX_CONNECTIONS'],
+        'broker_transport_options': {
+            'max_connections': app.config['REDIS_MAX_CONNECTIONS'],
+            'socket_keepalive': True,
+            'health_check_interval': app.config['REDIS_HEALTH_CHECK_INTERVAL'],
+            'socket_connect_timeout': app.config['REDIS_SOCKET_TIMEOUT'],
+        },
+        'redis_max_connections': app.config['REDIS_MAX_CONNECTIONS'],
+        'redis_socket_keepalive': True,
+        'redis_backend_health_check_interval': app.config['REDIS_HEALTH_CHECK_INTERVAL'],
     })
 
 
 def create_app(config_overrides=None):
     """Create and configure the Flask application."""
     app = Flask(__name__)
+    # Validates uploaded images while the request body streams in.
+    app.request_class = UploadRequest
 
     # ------------------------------------------------------------------ #
     # Core configuration
     # ------------------------------------------------------------------ #
     app.config['UPLOADED_PHOTOS_DEST'] = 'static/uploads'
+    # Raw uploads wait here (outside static/, never served) until the image
+    # worker has re-encoded them.  Workers must share this disk.
+    app.config['UPLOAD_STAGING_DEST'] = os.path.join(app.instance_path, 'upload_staging')
+    # Optional X-Accel-Redirect / X-Sendfile offload for /static/uploads/.
+    app.config['UPLOAD_SENDFILE'] = UPLOAD_SENDFILE
+    app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] = UPLOAD_ACCEL_REDIRECT_PREFIX
+    # Where uploads live: local disk or an S3-compatible bucket.
+    app.config['UPLOAD_STORAGE'] = UPLOAD_STORAGE
+    app.config['S3_BUCKET'] = S3_BUCKET
+    app.config['S3_PREFIX'] = S3_PREFIX
+    app.config['S3_ENDPOINT_URL'] = S3_ENDPOINT_URL
+    app.config['S3_REGION'] = S3_REGION
+    app.config['S3_ACCESS_KEY_ID'] = S3_ACCESS_KEY_ID
+    app.config['S3_SECRET_ACCESS_KEY'] = S3_SECRET_ACCESS_KEY
+    app.config['S3_PRESIGN_TTL'] = S3_PRESIGN_TTL
+    app.config['S3_PUBLIC_URL'] = S3_PUBLIC_URL
+    # On-disk cache of TheCocktailDB thumbnails served by /thumbs/.
+    app.config['THUMB_CACHE_DIR'] = os.path.join(app.instance_path, 'thumb_cache')
+    app.config['THUMB_CACHE_MAX_BYTES'] = THUMB_CACHE_MAX_BYTES
+    # Longest side (px) of stored uploads; larger photos are scaled down at
+    # decode time (JPEGs via draft mode, without a full-resolution decode).
+    app.config['IMAGE_MAX_DIMENSION'] = 1600
+    # Widths (px) of the responsive copies generated for each upload.
+    app.config['IMAGE_VARIANT_WIDTHS'] = (320, 640, 1024)
     app.config['SECRET_KEY'] = SECRET_KEY
     app.config['DEBUG'] = FLASK_DEBUG
     # Issue #5: cap upload size to prevent storage abuse / DoS.
     app.config['MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024  # 4 MB
+    # Page size for the keyset-paginated admin and user message inboxes.
+    app.config['MESSAGES_PER_PAGE'] = 25
+    # Seconds the current user's ban/admin/verified flags stay cached in
+    # Redis; admin actions invalidate the entry explicitly before then.
+    app.config['USER_CONTEXT_CACHE_TTL'] = 60
+    # bcrypt cost (0 = calibrate to BCRYPT_TARGET_MS under DEBUG, else 12)
+    # and the bounded pool that hashes passwords (services/passwords.py).
+    app.config['BCRYPT_LOG_ROUNDS'] = BCRYPT_LOG_ROUNDS
+    app.config['BCRYPT_TARGET_MS'] = BCRYPT_TARGET_MS
+    app.config['PASSWORD_HASH_WORKERS'] = PASSWORD_HASH_WORKERS
+    app.config['PASSWORD_HASH_TIMEOUT'] = PASSWORD_HASH_TIMEOUT
+    # Retention windows for the beat maintenance jobs (services/maintenance.py).
+    app.config['UNVERIFIED_ACCOUNT_TTL_DAYS'] = UNVERIFIED_ACCOUNT_TTL_DAYS
+    app.config['APPEAL_ARCHIVE_AFTER_DAYS'] = APPEAL_ARCHIVE_AFTER_DAYS
 
     # Normalise Heroku-style postgres:// URIs.
     db_uri = DATABASE_URL
@@ -87,6 +215,9 @@ def create_app(config_overrides=None):
     app.config['SESSION_COOKIE_SAMESITE'] = SESSION_COOKIE_SAMESITE
     app.config['PERMANENT_SESSION_LIFETIME'] = 3600
     app.config['SESSION_REFRESH_EACH_REQUEST'] = True
+    # Server-side sessions: the cookie holds only an id, data lives in Redis.
+    app.config['SESSION_STORE'] = SESSION_STORE
+    app.config['SESSION_LOCAL_CACHE_TTL'] = SESSION_LOCAL_CACHE_TTL
     app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
     # ------------------------------------------------------------------ #
@@ -99,8 +230,37 @@ def create_app(config_overrides=None):
     app.config['MAIL_USERNAME'] = MAIL_USERNAME
     app.config['MAIL_PASSWORD'] = MAIL_PASSWORD
     app.config['MAIL_DEFAULT_SENDER'] = MAIL_DEFAULT_SENDER
+    app.config['MAIL_MAX_EMAILS'] = MAIL_MAX_EMAILS
     app.config['RATELIMIT_ENABLED'] = RATELIMIT_ENABLED
     app.config['REDIS_URL'] = REDIS_URL
+    # One bounded, keepalive, health-checked pool per process, shared by the
+    # cache, limiter and session store (redis_pool.py).
+    app.config['REDIS_MAX_CONNECTIONS'] = REDIS_MAX_CONNECTIONS
+    app.config['REDIS_POOL_TIMEOUT'] = REDIS_POOL_TIMEOUT
+    app.config['REDIS_SOCKET_TIMEOUT'] = REDIS_SOCKET_TIMEOUT
+    app.config['REDIS_HEALTH_CHECK_INTERVAL'] = REDIS_HEALTH_CHECK_INTERVAL
+    # When Redis stops answering, the pool's circuit breaker fails calls fast
+    # and each consumer uses its per-process fallback until a jittered
+    # reconnect succeeds (redis_pool.py, task_fallback.py).
+    app.config['REDIS_BREAKER_THRESHOLD'] = REDIS_BREAKER_THRESHOLD
+    app.config['REDIS_RECONNECT_MAX'] = REDIS_RECONNECT_MAX
+    app.config['CACHE_LOCAL_MAX_ITEMS'] = CACHE_LOCAL_MAX_ITEMS
+    app.config['CELERY_LOCAL_WORKERS'] = CELERY_LOCAL_WORKERS
+    app.config['CELERY_LOCAL_BACKLOG'] = CELERY_LOCAL_BACKLOG
+    # Shared moving-window counters in Redis: "10 per minute" means ten per
+    # minute across all workers, not ten per worker, and survives restarts.
+    # The storage borrows connections from the shared pool (see below).
+    app.config['RATELIMIT_STORAGE_URI'] = REDIS_URL
+    app.config['RATELIMIT_STRATEGY'] = 'moving-window'
+    # If Redis is unreachable, keep enforcing the same limits per process
+    # and re-probe the store with exponential back-off.
+    app.config['RATELIMIT_IN_MEMORY_FALLBACK_ENABLED'] = True
+    app.config['RATELIMIT_LOCAL_PRECHECK'] = RATELIMIT_LOCAL_PRECHECK
+    # Share of requests timed for the Server-Timing header and log line.
+    app.config['SERVER_TIMING_SAMPLE_RATE'] = SERVER_TIMING_SAMPLE_RATE
+    app.config['QUERY_BUDGET_MODE'] = QUERY_BUDGET_MODE
+    # Bearer token for /metrics; empty = localhost only.
+    app.config['METRICS_TOKEN'] = METRICS_TOKEN
 
     # Allow tests / scripts to override any config key.
     if config_overrides:
@@ -109,18 +269,37 @@ def create_app(config_overrides=None):
     # ------------------------------------------------------------------ #
     # Extensions
     # ------------------------------------------------------------------ #
+    # First, so its timer starts before (and reports after) every other hook.
+    request_timing.init_app(app)
+    # Also early, so statements run by other before_request hooks count.
+    query_counter.init_app(app)
     connect_db(app)
+    metrics.init_app(app, db)
     csrf.init_app(app)
     mail.init_app(app)
     migrate.init_app(app, db)
+    # Built first: the limiter, cache and session store all borrow from it.
+    redis_pool.init_app(app)
+    app.config['RATELIMIT_STORAGE_OPTIONS'] = {'connection_pool': redis_pool.pool(app)}
+    # The local flood guard must be registered before the limiter so its
+    # before_request hook runs first.
+    flood_guard.init_app(app, limiter)
     limiter.init_app(app)
-    # RedisCache is shared across all worker processes (unlike SimpleCache).
+    # RedisCache is shared across all worker processes (unlike SimpleCache),
+    # with a bounded per-process SimpleCache standing in while Redis is down.
+    # Passing a client as the "host" makes it use the shared pool.
     cache.init_app(app, config={
-        'CACHE_TYPE': 'RedisCache',
+        'CACHE_TYPE': 'redis_pool.FailoverRedisCache',
         'CACHE_DEFAULT_TIMEOUT': 600,
-        'CACHE_REDIS_URL': app.config['REDIS_URL'],
+        'CACHE_REDIS_HOST': redis_pool.client(app),
+        'CACHE_LOCAL_MAX_ITEMS': app.config['CACHE_LOCAL_MAX_ITEMS'],
+        # Account flags must stay invalidatable by every worker, so they are
+        # read from the database rather than from a per-process copy.
+        'CACHE_SHARED_ONLY_PREFIXES': ('user_ctx:',),
     })
     _celery_init(app)
+    passwords.init_app(app)
+    sessions.init_app(app)
 
     if app.config['DEBUG']:
         from flask_debugtoolbar import DebugToolbarExtension
@@ -164,10 +343,9 @@ def create_app(config_overrides=None):
         endpoint = request.endpoint
         if endpoint is None or endpoint in _BAN_EXEMPT:
             return
-        user_id = session.get('user_id')
-        if not user_id:
-            return
-        user = db.session.get(User, user_id)
+        # Flags come from the request-scoped user context (Redis-cached), so
+        # this hook normally costs no DB round trip.
+        user = get_current_user()
         if not user:
             return
         if user.is_permanently_banned:
@@ -177,7 +355,7 @@ def create_app(config_overrides=None):
                 "danger",
             )
             return redirect(url_for('users.submit_appeal'))
-        if user.ban_until and user.ban_until > datetime.now(timezone.utc).replace(tzinfo=None):
+        if user.is_temporarily_banned:
             flash(
                 f"Your account is suspended until "
                 f"{user.ban_until.strftime('%B %d, %Y')}. "
@@ -197,6 +375,13 @@ def create_app(config_overrides=None):
         response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
         response.headers['Permissions-Policy'] = 'geolocation=(), microphone=(), camera=()'
         # Content-Security-Policy: restrict resource origins to trusted CDNs only.
+        # Cocktail thumbnails are served from our own /thumbs/ cache; the
+        # upstream origin is only loaded on a cache miss, via redirect.
+        img_src = f"'self' data: {THUMB_UPSTREAM_ORIGIN}"
+        upload_img_origin = upload_origin(app.config)
+        if upload_img_origin:
+            # Uploads in object storage are read via a redirect to the bucket.
+            img_src += f" {upload_img_origin}"
         csp = (
             "default-src 'self'; "
             "script-src 'self' https://code.jquery.com https://cdn.jsdelivr.net "
@@ -205,7 +390,7 @@ def create_app(config_overrides=None):
             "https://cdnjs.cloudflare.com 'unsafe-inline'; "
             "font-src 'self' https://cdnjs.cloudflare.com "
             "https://stackpath.bootstrapcdn.com; "
-            "img-src 'self' data: https://www.thecocktaildb.com;"
+            f"img-src {img_src};"
         )
         response.headers['Content-Security-Policy'] = csp
         return response
@@ -263,6 +448,25 @@ def create_app(config_overrides=None):
     csrf.exempt(_heartbeat)
     csrf.exempt(_shutdown)
 
+    @app.route('/metrics', methods=['GET'])
+    def _metrics():
+        """Prometheus scrape endpoint, merged across gunicorn workers.
+
+        With ``METRICS_TOKEN`` set the scraper must send it as a bearer
+        token.  Otherwise only localhost is answered, like the watchdog
+        endpoints; nginx proxies from localhost too, so it must ``deny``
+        ``/metrics`` to outside clients.
+        """
+        token = app.config['METRICS_TOKEN']
+        if token:
+            sent = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode()):
+                _abort(403)
+        elif request.remote_addr not in ('127.0.0.1', '::1'):
+            _abort(403)
+        body, content_type = metrics.render()
+        return body, 200, {'Content-Type': content_type}
+
     # ------------------------------------------------------------------ #
     # Template context: inject browser_watchdog flag so base.html can
     # conditionally include the heartbeat JavaScript snippet.
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Throughput benchmark for bulk email delivery.
+
+Sends the same emails twice to a local aiosmtpd server that accepts and
+discards them:
+
+* **per-message sessions** — ``mail.send()`` for each email, which is what
+  the per-email ``_deliver`` task does: connect, EHLO, send, QUIT.
+* **outbox relay** — the emails are committed to the outbox and drained by
+  ``relay_outbox``, which reuses one SMTP session (reopened every
+  ``MAIL_MAX_EMAILS`` messages).
+
+``--latency`` delays every SMTP reply by that many milliseconds to stand
+in for the network round trip to a real relay.  The TCP connect, greeting,
+STARTTLS and AUTH round trips a production session also pays are not
+delayed, so the gain against a remote provider is larger than shown.  The
+database is an in-memory SQLite one; nothing touches the configured
+DATABASE_URL.
+
+Usage::
+
+    pip install aiosmtpd
+    python bench_email_relay.py --messages 500 --latency 5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+# Must be set before config.py is imported by the app.
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from aiosmtpd.controller import Controller
+from flask_mail import Message
+
+from app import create_app
+from extensions import mail
+from models import db
+from services.email_service import enqueue_email, relay_outbox
+
+
+class _Sink:
+    """aiosmtpd handler that counts messages and delays each reply."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.received = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        await asyncio.sleep(self.latency)
+        session.host_name = hostname
+        return responses
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        await asyncio.sleep(self.latency)
+        envelope.mail_from = address
+        return '250 OK'
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        await asyncio.sleep(self.latency)
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        return '250 Message accepted for delivery'
+
+    async def handle_QUIT(self, server, session, envelope):
+        await asyncio.sleep(self.latency)
+        return '221 Bye'
+
+
+def _email(i: int) -> dict:
+    return {
+        'subject': f'Benchmark message {i}',
+        'recipients': [f'user{i}@example.com'],
+        'body': 'Cocktail Chronicles delivery benchmark.\n' * 20,
+    }
+
+
+def _per_message_sessions(app, count: int) -> float:
+    with app.app_context():
+        start = time.perf_counter()
+        for i in range(count):
+            mail.send(Message(**_email(i)))
+        return time.perf_counter() - start
+
+
+def _outbox_relay(app, count: int) -> float:
+    with app.app_context():
+        for i in range(count):
+            enqueue_email(**_email(i))
+        db.session.commit()
+        start = time.perf_counter()
+        sent = 0
+        while batch := relay_outbox.run():
+            sent += batch
+        elapsed = time.perf_counter() - start
+    if sent != count:
+        raise SystemExit(f"relay sent {sent} of {count} emails")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds added to every SMTP reply')
+    parser.add_argument('--port', type=int, default=8025)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)  # aiosmtpd logs every SMTP command
+    sink = _Sink(args.latency / 1000)
+    controller = Controller(sink, hostname='127.0.0.1', port=args.port)
+    controller.start()
+    try:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': args.port,
+            'MAIL_USE_TLS': False,
+            'MAIL_USE_SSL': False,
+            'MAIL_USERNAME': '',
+            'MAIL_PASSWORD': '',
+            'MAIL_SUPPRESS_SEND': False,
+        })
+        with app.app_context():
+            db.create_all()
+
+        print(f"{args.messages} emails, {args.latency:g} ms per SMTP reply, "
+              f"session reopened every {app.config['MAIL_MAX_EMAILS']} messages")
+        results = [
+            ('per-message sessions', _per_message_sessions(app, args.messages)),
+            ('outbox relay', _outbox_relay(app, args.messages)),
+        ]
+        for label, elapsed in results:
+            print(f"  {label:<22} {elapsed:8.2f} s  {args.messages / elapsed:8.1f} emails/s")
+        print(f"  speed-up               {results[0][1] / results[1][1]:8.2f}x")
+    finally:
+        controller.stop()
+
+    if sink.received != 2 * args.messages:
+        raise SystemExit(f"server received {sink.received} of {2 * args.messages} emails")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,24 @@
 import logging
 from datetime import datetime, timedelta, timezone
 
-from flask import Blueprint, render_template, redirect, url_for, session, flash, request
+from flask import Blueprint, render_template, redirect, url_for, session, flash, request, current_app, jsonify
 
 from sqlalchemy import exists
-from models import db, User, Cocktail, Cocktails_Users, AdminMessage, UserAppeal, AdminAuditLog
-from forms import AdminForm, AdminMessageForm
-from decorators import admin_required
+from models import db, User, Cocktail, Cocktails_Users, AdminMessage, UserAppeal, AdminAuditLog, Broadcast
+from forms import AdminForm, AdminMessageForm, BroadcastForm
+from decorators import admin_required, query_budget
 from extensions import limiter
+from services.broadcast_service import broadcast_progress, create_broadcast
+from services.cocktail_service import release_user_cocktail_refs
+from services.user_context import get_current_user, invalidate_user_context
+from services.message_service import (
+    ADMIN_UNREAD_COUNTER,
+    adjust_counter,
+    get_counter,
+    mark_admin_message_read,
+    paginate_messages,
+    record_admin_response,
+)
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -50,6 +61,7 @@ def _guard_self_action(user_id: int, verb: str) -> bool:
 # Issue #8: Require login before the page is shown (not just after POST).
 # ---------------------------------------------------------------------------
 @admin_bp.route("/admin/unlock", methods=["GET", "POST"])
+@query_budget(8)
 @limiter.limit("5 per minute")
 def admin_unlock():
     # Issue #8: Consistent protection — require login for both GET and POST.
@@ -58,8 +70,7 @@ def admin_unlock():
         return redirect(url_for('auth.login'))
 
     # Redirect already-authenticated admins straight to the panel.
-    user = db.session.get(User, session["user_id"])
-    if user and user.is_admin:
+    if get_current_user() and get_current_user().is_admin:
         return redirect(url_for('admin.admin_panel'))
 
     # Bootstrap guard: once any admin account exists, this self-promotion
@@ -78,11 +89,13 @@ def admin_unlock():
     if form.validate_on_submit():
         from config import ADMIN_PASSWORD_KEY
         if form.admin_key.data == ADMIN_PASSWORD_KEY:
+            user = db.session.get(User, session["user_id"])
             if user:
                 user.is_admin = True
                 _log_admin_action("self_promote_admin", target_user_id=user.id,
                                   details="Admin unlock key accepted")
                 db.session.commit()
+                invalidate_user_context(user.id)
                 flash("Admin access granted!", "success")
                 return redirect(url_for('admin.admin_panel'))
             flash("You must be logged in to access the admin panel.", "danger")
@@ -96,6 +109,7 @@ def admin_unlock():
 
 
 @admin_bp.route("/admin/panel")
+@query_budget(10)
 @admin_required
 def admin_panel():
     # Gather high-level counts for the dashboard summary cards.
@@ -115,11 +129,13 @@ def admin_panel():
         stats=stats,
         users=users,
         appeals=appeals,
+        unread_messages=get_counter(ADMIN_UNREAD_COUNTER),
         now=datetime.now(timezone.utc).replace(tzinfo=None),
     )
 
 
 @admin_bp.route("/admin/user/<int:user_id>/promote", methods=["POST"])
+@query_budget(8)
 @admin_required
 def promote_user(user_id):
     if _guard_self_action(user_id, "promote"):
@@ -129,11 +145,13 @@ def promote_user(user_id):
     _log_admin_action("promote_user", target_user_id=user_id,
                       details=f"Promoted {user.username} to admin")
     db.session.commit()
+    invalidate_user_context(user_id)
     flash(f"User {user.username} promoted to admin.", "success")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/user/<int:user_id>/demote", methods=["POST"])
+@query_budget(8)
 @admin_required
 def demote_user(user_id):
     if _guard_self_action(user_id, "demote"):
@@ -143,11 +161,13 @@ def demote_user(user_id):
     _log_admin_action("demote_user", target_user_id=user_id,
                       details=f"Demoted {user.username} from admin")
     db.session.commit()
+    invalidate_user_context(user_id)
     flash(f"User {user.username} demoted from admin.", "success")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/user/<int:user_id>/ban", methods=["POST"])
+@query_budget(8)
 @admin_required
 def ban_user(user_id):
     if _guard_self_action(user_id, "ban"):
@@ -157,18 +177,18 @@ def ban_user(user_id):
     user.ban_until = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(days=365)
     _log_admin_action("ban_user_1yr", target_user_id=user_id,
                       details=f"Banned {user.username} for one year")
+    from services.email_service import send_ban_notification_email
+    # Notify the user and include the appeal link in the email body.  The
+    # email joins the outbox in the same commit as the ban itself.
+    send_ban_notification_email(user)
     db.session.commit()
-    try:
-        from services.email_service import send_ban_notification_email
-        # Notify the user and include the appeal link in the email body.
-        send_ban_notification_email(user)
-    except Exception as e:
-        logging.error(f"Error sending ban notification email: {e}")
+    invalidate_user_context(user_id)
     flash(f"User {user.username} has been banned for one year.", "warning")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/user/<int:user_id>/ban-permanent", methods=["POST"])
+@query_budget(8)
 @admin_required
 def ban_user_permanently(user_id):
     if _guard_self_action(user_id, "permanently ban"):
@@ -178,17 +198,16 @@ def ban_user_permanently(user_id):
     user.is_permanently_banned = True
     _log_admin_action("ban_user_permanent", target_user_id=user_id,
                       details=f"Permanently banned {user.username}")
+    from services.email_service import send_ban_notification_email
+    send_ban_notification_email(user)
     db.session.commit()
-    try:
-        from services.email_service import send_ban_notification_email
-        send_ban_notification_email(user)
-    except Exception as e:
-        logging.error(f"Error sending permanent ban notification email: {e}")
+    invalidate_user_context(user_id)
     flash(f"User {user.username} has been permanently banned.", "danger")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/user/<int:user_id>/delete", methods=["POST"])
+@query_budget(20)
 @admin_required
 def delete_user(user_id):
     if _guard_self_action(user_id, "delete"):
@@ -197,21 +216,42 @@ def delete_user(user_id):
     username = user.username
     _log_admin_action("delete_user", target_user_id=user_id,
                       details=f"Deleted user {username}")
+    # The cascade below removes this user's messages; keep the admin badge
+    # in step with any unread ones that disappear with them.
+    unread = AdminMessage.query.filter_by(user_id=user_id, is_read=False).count()
+    adjust_counter(ADMIN_UNREAD_COUNTER, -unread)
+    # Likewise release the user's cocktail references before the cascade
+    # deletes their Cocktails_Users rows.
+    release_user_cocktail_refs(user_id)
     # Cascade delete removes messages, appeals, and cocktail links tied to this user.
     db.session.delete(user)
     db.session.commit()
+    invalidate_user_context(user_id)
     flash(f"User {username} has been deleted from the system.", "success")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/messages")
+@query_budget(6)
 @admin_required
 def admin_messages():
-    messages = AdminMessage.query.order_by(AdminMessage.created_at.desc()).all()
-    return render_template("admin/messages.html", messages=messages)
+    # Keyset pagination: each page is an index range scan on (created_at, id)
+    # no matter how deep into the history the admin has scrolled.
+    messages, next_cursor = paginate_messages(
+        AdminMessage.query,
+        request.args.get('cursor'),
+        current_app.config['MESSAGES_PER_PAGE'],
+    )
+    return render_template(
+        "admin/messages.html",
+        messages=messages,
+        next_cursor=next_cursor,
+        unread_messages=get_counter(ADMIN_UNREAD_COUNTER),
+    )
 
 
 @admin_bp.route("/admin/message/<int:message_id>/respond", methods=["GET", "POST"])
+@query_budget(10)
 @admin_required
 def respond_to_message(message_id):
     message = AdminMessage.query.get_or_404(message_id)
@@ -220,17 +260,53 @@ def respond_to_message(message_id):
         # Attach the admin's reply and timestamp it.
         message.admin_response = form.message.data
         message.admin_response_date = datetime.now(timezone.utc).replace(tzinfo=None)
-        message.is_read = True
+        record_admin_response(message)
+        mark_admin_message_read(message.id)
         db.session.commit()
         flash("Response saved.", "success")
         return redirect(url_for('admin.admin_messages'))
     # Mark the message as read as soon as an admin opens it.
-    message.is_read = True
+    mark_admin_message_read(message.id)
     db.session.commit()
     return render_template("admin/respond_message.html", message=message, form=form)
 
 
+@admin_bp.route("/admin/broadcasts", methods=["GET", "POST"])
+@query_budget(8)
+@admin_required
+def admin_broadcasts():
+    form = BroadcastForm()
+    if form.validate_on_submit():
+        # Only the delivery rows are written here; the emails are sent by
+        # background chunk tasks, however large the audience.
+        broadcast = create_broadcast(session["user_id"], form.subject.data,
+                                     form.body.data, form.audience.data)
+        _log_admin_action("broadcast", details=(
+            f"Broadcast #{broadcast.id} to {broadcast.audience} users "
+            f"({broadcast.total_recipients} recipients)"
+        ))
+        db.session.commit()
+        flash(f"Broadcast queued for {broadcast.total_recipients} users.", "success")
+        return redirect(url_for('admin.admin_broadcasts'))
+    broadcasts = Broadcast.query.order_by(Broadcast.id.desc()).limit(20).all()
+    return render_template(
+        "admin/broadcasts.html",
+        form=form,
+        broadcasts=broadcasts,
+        progress={b.id: broadcast_progress(b) for b in broadcasts},
+        audiences=dict(form.audience.choices),
+    )
+
+
+@admin_bp.route("/admin/broadcast/<int:broadcast_id>/progress")
+@query_budget(4)
+@admin_required
+def broadcast_status(broadcast_id):
+    return jsonify(broadcast_progress(Broadcast.query.get_or_404(broadcast_id)))
+
+
 @admin_bp.route("/admin/appeal/<int:appeal_id>/approve", methods=["POST"])
+@query_budget(10)
 @admin_required
 def approve_appeal(appeal_id):
     appeal = UserAppeal.query.get_or_404(appeal_id)
@@ -246,18 +322,17 @@ def approve_appeal(appeal_id):
     appeal.admin_response_date = datetime.now(timezone.utc).replace(tzinfo=None)
     _log_admin_action("approve_appeal", target_user_id=user.id,
                       details=f"Approved appeal #{appeal_id} for {user.username}")
+    from services.email_service import send_ban_lifted_email
+    # Let the user know their appeal was successful.
+    send_ban_lifted_email(user)
     db.session.commit()
-    try:
-        from services.email_service import send_ban_lifted_email
-        # Let the user know their appeal was successful.
-        send_ban_lifted_email(user)
-    except Exception as e:
-        logging.error(f"Error sending ban lifted email: {e}")
+    invalidate_user_context(user.id)
     flash(f"Appeal approved. Ban lifted for user {user.username}.", "success")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/appeal/<int:appeal_id>/reject", methods=["POST"])
+@query_budget(8)
 @admin_required
 def reject_appeal(appeal_id):
     appeal = UserAppeal.query.get_or_404(appeal_id)
@@ -270,17 +345,15 @@ def reject_appeal(appeal_id):
     appeal.admin_response_date = datetime.now(timezone.utc).replace(tzinfo=None)
     _log_admin_action("reject_appeal", target_user_id=appeal.user_id,
                       details=f"Rejected appeal #{appeal_id}")
+    from services.email_service import send_appeal_rejection_email
+    send_appeal_rejection_email(user)
     db.session.commit()
-    try:
-        from services.email_service import send_appeal_rejection_email
-        send_appeal_rejection_email(user)
-    except Exception as e:
-        logging.error(f"Error sending appeal rejection email: {e}")
     flash("Appeal rejected.", "warning")
     return redirect(url_for('admin.admin_panel'))
 
 
 @admin_bp.route("/admin/user/<int:user_id>/remove-ban", methods=["POST"])
+@query_budget(8)
 @admin_required
 def remove_user_ban(user_id):
     if _guard_self_action(user_id, "remove ban from"):
@@ -291,11 +364,9 @@ def remove_user_ban(user_id):
     user.is_permanently_banned = False
     _log_admin_action("remove_ban", target_user_id=user_id,
                       details=f"Lifted ban for {user.username}")
+    from services.email_service import send_ban_lifted_email
+    send_ban_lifted_email(user)
     db.session.commit()
-    try:
-        from services.email_service import send_ban_lifted_email
-        send_ban_lifted_email(user)
-    except Exception as e:
-        logging.error(f"Error sending ban lifted email: {e}")
+    invalidate_user_context(user_id)
     flash(f"Ban lifted for user {user.username}.", "success")
     return redirect(url_for('admin.admin_panel'))
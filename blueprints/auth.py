@@ -7,12 +7,16 @@ from flask import Blueprint, render_template, redirect, url_for, session, flash
 from models import db, User
 from forms import RegisterForm, LoginForm
 from extensions import limiter
+from decorators import query_budget
 from config import ADMIN_USERNAME, ADMIN_EMAIL
+from services.user_context import invalidate_user_context
+from services.passwords import PasswordHasherBusy
 
 auth_bp = Blueprint('auth', __name__)
 
 
 @auth_bp.route("/register", methods=["GET", "POST"])
+@query_budget(8)
 @limiter.limit("5 per hour")
 def register():
     # Skip the registration form for already-authenticated users.
@@ -35,7 +39,11 @@ def register():
             return redirect(url_for('auth.register'))
 
         # Hash the password and stage the new user record (not yet committed).
-        user = User.register(username, email, pwd)
+        try:
+            user = User.register(username, email, pwd)
+        except PasswordHasherBusy:
+            flash("We're handling a lot of sign-ups right now. Please try again in a moment.", "warning")
+            return render_template("users/register.html", form=form), 503
 
         # Bootstrap admin: if ADMIN_USERNAME and ADMIN_EMAIL are configured in
         # .env and this registration matches both, promote the user to admin and
@@ -68,14 +76,13 @@ def register():
             # SECRET_KEY is missing — catch it before we commit so the
             # session can be cleanly rolled back.
             token = user.generate_email_verification_token()
-            # Commit only after the token is successfully generated.
-            db.session.commit()
-            # Enqueue the verification email as a Celery task.
-            # NOTE: actual SMTP delivery is asynchronous — if the Celery
-            # worker later fails (e.g. SMTP unreachable), the error is logged
-            # but the user row is already committed.  Users can request a
-            # resend from the verification-pending page.
+            # The verification email is written to the outbox and committed
+            # together with the user row, so one never exists without the
+            # other.  SMTP delivery happens later in the relay task, which
+            # retries failures; users can also request a resend from the
+            # verification-pending page.
             send_verification_email(user, token)
+            db.session.commit()
             flash(
                 f"Registration successful! A verification email has been sent to {email}. "
                 "Please check your inbox.",
@@ -97,6 +104,7 @@ def register():
 
 
 @auth_bp.route('/verify-email/<token>')
+@query_budget(6)
 def verify_email(token):
     try:
         # Decode the signed token; returns None when invalid or past max_age.
@@ -117,6 +125,7 @@ def verify_email(token):
 
         # Stamp the verification timestamp and persist.
         user.mark_email_verified()
+        invalidate_user_context(user.id)
         flash("Email verified successfully! You can now log in.", "success")
         return redirect(url_for('auth.login'))
 
@@ -127,6 +136,7 @@ def verify_email(token):
 
 
 @auth_bp.route('/verification-pending/<int:user_id>')
+@query_budget(3)
 def verification_pending(user_id):
     # Only allow the browser that registered (pending session key) or the
     # already-authenticated user to see this page.  Any other visitor would
@@ -146,6 +156,7 @@ def verification_pending(user_id):
 
 
 @auth_bp.route('/resend-verification/<int:user_id>', methods=['POST'])
+@query_budget(5)
 @limiter.limit("5 per hour")
 def resend_verification(user_id):
     # Only the browser session that registered (or the logged-in owner) may
@@ -164,22 +175,29 @@ def resend_verification(user_id):
         from services.email_service import send_resend_verification_email
         token = user.generate_email_verification_token()
         send_resend_verification_email(user, token)
+        db.session.commit()
         flash(f"A new verification email has been sent to {user.email}.", "success")
         return redirect(url_for('auth.verification_pending', user_id=user.id))
 
     except Exception as e:
         logging.error(f"Error resending verification email: {e}")
+        db.session.rollback()
         flash("Error sending verification email. Please try again.", "danger")
         return redirect(url_for('auth.verification_pending', user_id=user_id))
 
 
 @auth_bp.route("/login", methods=["GET", "POST"])
+@query_budget(6)
 @limiter.limit("10 per minute")
 def login():
     form = LoginForm()
     if form.validate_on_submit():
         # Verify credentials via bcrypt check inside User.authenticate.
-        user = User.authenticate(form.username.data, form.password.data)
+        try:
+            user = User.authenticate(form.username.data, form.password.data)
+        except PasswordHasherBusy:
+            flash("We're handling a lot of sign-ins right now. Please try again in a moment.", "warning")
+            return render_template("users/login.html", form=form), 503
         if user:
             # Bootstrap admin recovery: if ADMIN_USERNAME/ADMIN_EMAIL match
             # this user but the account wasn't granted admin at registration
@@ -195,6 +213,7 @@ def login():
                 user.is_email_verified = True
                 user.email_verified_at = datetime.now(timezone.utc).replace(tzinfo=None)
                 db.session.commit()
+                invalidate_user_context(user.id)
 
             # Block login until the user has confirmed ownership of their email.
             # Redirect to verification_pending (which already shows the resend
@@ -241,6 +260,7 @@ def login():
 
 
 @auth_bp.route("/logout", methods=["POST"])
+@query_budget(2)
 def logout():
     # Remove both identity keys so stale session state cannot authorize access
     # to verification_pending / resend_verification after logout.
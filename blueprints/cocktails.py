@@ -3,22 +3,42 @@ import asyncio
 import logging
 import os
 
+from sqlalchemy.orm import joinedload, selectinload
 from flask import (
     Blueprint, render_template, redirect, url_for,
-    session, flash, request, send_from_directory, current_app,
+    session, flash, request, send_file, current_app, abort,
 )
 
-from models import db, User, Cocktail, Cocktails_Users, Cocktails_Ingredients, Ingredient
+from models import db, Cocktail, Cocktails_Users, Cocktails_Ingredients, Ingredient
 from forms import OriginalCocktailForm, EditCocktailForm, ListCocktailsForm, IngredientForm
 from services.cocktail_service import (
     process_and_store_new_cocktail,
-    save_uploaded_image,
+    api_image_sources,
+    stage_uploaded_image,
+    discard_staged_image,
+    enqueue_image_processing,
     delete_uploaded_image,
-    get_cocktail_image_url,
-    store_or_get_ingredient,
+    upload_relpath,
+    store_or_get_ingredients,
+    link_user_to_cocktail,
+    unlink_user_from_cocktail,
+    find_personal_variant,
+    create_personal_variant,
+    delete_personal_cocktail,
+    resolve_cocktails,
+    apply_variant_edit,
 )
 from cocktaildb_api import get_cocktail_detail, get_combined_cocktails_list
-from decorators import login_required
+from decorators import login_required, query_budget
+from services.storage import get_upload_storage
+from services.user_context import get_current_user
+from services.thumb_cache import (
+    cached_thumb,
+    is_thumb_path,
+    request_thumb_fetch,
+    thumb_mimetype,
+    upstream_url,
+)
 from extensions import cache
 
 cocktails_bp = Blueprint('cocktails', __name__)
@@ -36,6 +56,7 @@ def _cached_cocktail_list():
 
 
 @cocktails_bp.route('/cocktails', methods=['GET', 'POST'])
+@query_budget(3)
 def list_cocktails():
     form = ListCocktailsForm()
     try:
@@ -60,6 +81,7 @@ def list_cocktails():
 
 
 @cocktails_bp.route('/cocktail/<int:cocktail_id>')
+@query_budget(3)
 def cocktail_details(cocktail_id):
     try:
         cocktail = get_cocktail_detail(cocktail_id)
@@ -72,11 +94,16 @@ def cocktail_details(cocktail_id):
         return redirect(url_for('cocktails.list_cocktails'))
 
     return render_template(
-        'cocktail_details.html', cocktail=cocktail, user_id=session.get("user_id")
+        'cocktail_details.html',
+        cocktail=cocktail,
+        image=api_image_sources(cocktail.get('strDrinkThumb')),
+        user_id=session.get("user_id"),
     )
 
 
+# Saving a drink writes up to 15 ingredients and their association rows.
 @cocktails_bp.route('/add_api_cocktails', methods=['GET', 'POST'])
+@query_budget(45)
 @login_required
 def add_api_cocktails():
     form = ListCocktailsForm()
@@ -116,43 +143,38 @@ def add_api_cocktails():
 
 
 @cocktails_bp.route('/my-cocktails')
+@query_budget(5)
 @login_required
 def my_cocktails():
     user_id = session.get('user_id')
 
-    user = db.session.get(User, user_id)
-    if not user:
+    if not get_current_user():
         flash('User not found.', 'danger')
         return redirect(url_for('auth.login'))
 
-    cocktail_details = []
-    for relation in user.cocktails_relation:
-        cocktail = relation.cocktails
-        ingredients = [
-            {'ingredient': ci.ingredient.name, 'measure': ci.quantity}
-            for ci in cocktail.ingredients_relation
-        ]
-        cocktail_details.append({
-            'id': cocktail.id,
-            'name': cocktail.name,
-            'instructions': cocktail.instructions,
-            'ingredients': ingredients,
-            # Resolve image URL once via the service helper (prefers image_url,
-            # falls back to strDrinkThumb, returns None when neither is set).
-            'image_url': get_cocktail_image_url(cocktail),
-        })
+    # One query for the user's cocktails (with any variant source joined in)
+    # and one for all of their ingredient rows; variants are resolved from
+    # their source plus stored deltas.
+    cocktails = (
+        Cocktail.query
+        .join(Cocktails_Users, Cocktails_Users.cocktail_id == Cocktail.id)
+        .filter(Cocktails_Users.user_id == user_id)
+        .options(joinedload(Cocktail.source))
+        .all()
+    )
+    cocktail_details = resolve_cocktails(cocktails)
 
     cocktail_details.sort(key=lambda x: x['name'])
     return render_template('my_cocktails.html', cocktails=cocktail_details)
 
 
 @cocktails_bp.route('/delete-cocktail/<int:cocktail_id>', methods=['POST'])
+@query_budget(14)
 @login_required
 def delete_cocktail(cocktail_id):
     user_id = session.get('user_id')
 
-    user = db.session.get(User, user_id)
-    if not user:
+    if not get_current_user():
         flash('User not found.', 'danger')
         return redirect(url_for('auth.login'))
 
@@ -162,35 +184,32 @@ def delete_cocktail(cocktail_id):
         return redirect(url_for('cocktails.my_cocktails'))
 
     # Confirm the requesting user actually owns this cocktail before deleting.
-    user_cocktail_ids = {r.cocktail_id for r in user.cocktails_relation}
-    if cocktail_id not in user_cocktail_ids:
+    # The join row is looked up by primary key instead of loading the user's
+    # whole collection.
+    rel = db.session.get(Cocktails_Users, (user_id, cocktail_id))
+    if not rel:
         flash('You do not have permission to delete this cocktail.', 'danger')
         return redirect(url_for('cocktails.my_cocktails'))
 
     try:
-        rel = Cocktails_Users.query.filter_by(
-            user_id=user_id, cocktail_id=cocktail_id
-        ).first()
         if rel:
             # Capture image filename before any deletions so we can clean up the
             # file from disk after the row is gone.
             old_image = cocktail.image_url if not cocktail.is_api_cocktail else None
-
-            db.session.delete(rel)
-            # Flush so the count below reflects the deletion already staged.
-            db.session.flush()
-            # Remove the cocktail row itself when no other user references it
-            # (orphan cleanup).  This applies to both user-created and API
-            # cocktails — the latter can also become unreferenced over time.
-            remaining = Cocktails_Users.query.filter_by(cocktail_id=cocktail_id).count()
-            if remaining == 0:
-                db.session.delete(cocktail)
+            old_variants = cocktail.image_variants if old_image else None
+
+            unlink_user_from_cocktail(rel)
+            # Shared API rows are left for the background orphan collector;
+            # a user's own cocktail is removed as soon as nobody links to it.
+            # ref_count was refreshed by the unlink, so no COUNT is needed.
+            if not cocktail.is_api_cocktail and cocktail.ref_count <= 0:
+                delete_personal_cocktail(cocktail)
             db.session.commit()
             # Delete the uploaded image file from disk only after the DB commit
             # succeeds, and only for user-created cocktails (API records do not
             # store a local file).
             if old_image:
-                delete_uploaded_image(old_image)
+                delete_uploaded_image(old_image, old_variants)
             flash('Cocktail deleted successfully!', 'success')
         else:
             flash('Cocktail not found in your collection.', 'danger')
@@ -202,7 +221,9 @@ def delete_cocktail(cocktail_id):
     return redirect(url_for('cocktails.my_cocktails'))
 
 
+# Saving writes up to 10 ingredients and their association rows.
 @cocktails_bp.route('/add-original-cocktails', methods=['GET', 'POST'])
+@query_budget(32)
 @login_required
 def add_original_cocktails():
 
@@ -246,29 +267,25 @@ def add_original_cocktails():
         db.session.flush()
 
         # Link the new cocktail to the current user in the join table.
-        db.session.add(
-            Cocktails_Users(user_id=session['user_id'], cocktail_id=new_cocktail.id)
-        )
+        link_user_to_cocktail(session['user_id'], new_cocktail.id)
 
-        for ingredient_name, measure in filtered:
-            ingredient = store_or_get_ingredient(ingredient_name)
-            # Flush each ingredient so its PK is ready for the association row.
-            db.session.flush()
+        ingredients = store_or_get_ingredients([name for name, _ in filtered])
+        for ingredient, (_, measure) in zip(ingredients, filtered):
             db.session.add(
                 Cocktails_Ingredients(
                     cocktail_id=new_cocktail.id,
-                    ingredient_id=ingredient.id,
+                    ingredient=ingredient,
                     quantity=measure,
                 )
             )
 
-        # Track saved upload path so we can clean it up if the DB commit fails.
-        filename = None
+        # Track the staged upload so we can clean it up if the DB commit fails.
+        staged = None
         try:
-            # Validate extension and magic bytes before saving to disk.
-            filename = save_uploaded_image(form.image.data)
-            if filename:
-                new_cocktail.image_url = filename
+            # Validate extension, magic bytes and header, then stage the raw
+            # file; the full decode/re-encode runs in the image worker.
+            staged = stage_uploaded_image(form.image.data)
+            new_cocktail.pending_image = staged
         except ValueError as e:
             # Invalid image: roll back everything staged in this request and
             # return the form with the error message (do NOT save the cocktail).
@@ -289,12 +306,12 @@ def add_original_cocktails():
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            # Remove the just-saved upload to avoid orphaning it on disk.
-            if filename:
-                delete_uploaded_image(filename)
+            # Remove the staged upload to avoid orphaning it on disk.
+            discard_staged_image(staged)
             current_app.logger.error(f"DB commit failed during cocktail creation: {e}")
             flash('Failed to save your cocktail. Please try again.', 'danger')
             return render_template('add_original_cocktails.html', form=form)
+        enqueue_image_processing(new_cocktail.id, staged)
         flash('Successfully added your original cocktail!', 'success')
         return redirect(url_for('cocktails.my_cocktails'))
 
@@ -305,20 +322,52 @@ def add_original_cocktails():
 
 
 @cocktails_bp.route('/static/uploads/<filename>')
+@query_budget(2)
 def uploaded_file(filename):
-    # Serve user-uploaded images from the configured uploads directory.
-    upload_dir = os.path.join(
-        current_app.root_path,
-        current_app.config['UPLOADED_PHOTOS_DEST'],
-    )
-    return send_from_directory(upload_dir, filename)
-
-
+    # The storage driver serves the bytes with immutable caching, hands
+    # them to the fronting server, or redirects to object storage.
+    if filename != os.path.basename(filename):
+        abort(404)
+    return get_upload_storage().send(upload_relpath(filename))
+
+
+@cocktails_bp.route('/thumbs/<path:path>')
+@query_budget(1)
+def remote_thumb(path):
+    # Local cache in front of TheCocktailDB's image CDN.  Upstream thumbnail
+    # URLs never change content, so a hit can be cached by browsers forever.
+    if not is_thumb_path(path):
+        abort(404)
+    cache_file = cached_thumb(path)
+    if cache_file:
+        response = send_file(cache_file, mimetype=thumb_mimetype(path), conditional=True)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+    # Miss: let the browser fetch upstream this once while a worker fills
+    # the cache.  The redirect itself must not be cached.
+    request_thumb_fetch(path)
+    response = redirect(upstream_url(path))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# Saving writes up to 10 ingredients and their association rows.
 @cocktails_bp.route('/edit-cocktail/<int:cocktail_id>', methods=['GET', 'POST'])
+@query_budget(36)
 @login_required
 def edit_cocktail(cocktail_id):
     user_id = session['user_id']
-    original_cocktail = Cocktail.query.get_or_404(cocktail_id)
+    query = Cocktail.query
+    if request.method == 'POST':
+        # Saving walks the ingredient rows (and a variant's source rows) by
+        # name; load them with their ingredients up front, not one per row.
+        query = query.options(
+            selectinload(Cocktail.ingredients_relation)
+            .joinedload(Cocktails_Ingredients.ingredient),
+            joinedload(Cocktail.source).selectinload(Cocktail.ingredients_relation)
+            .joinedload(Cocktails_Ingredients.ingredient),
+        )
+    original_cocktail = query.get_or_404(cocktail_id)
 
     ownership = Cocktails_Users.query.filter_by(
         user_id=user_id, cocktail_id=cocktail_id
@@ -328,65 +377,20 @@ def edit_cocktail(cocktail_id):
         return redirect(url_for('cocktails.my_cocktails'))
 
     if original_cocktail.is_api_cocktail:
-        # Use a JOIN query to find *this user's own* editable copy rather than
-        # any user's copy sharing the same name — prevents cross-user leakage.
-        user_copy = (
-            Cocktail.query
-            .join(Cocktails_Users, Cocktails_Users.cocktail_id == Cocktail.id)
-            .filter(
-                Cocktails_Users.user_id == user_id,
-                Cocktail.name == original_cocktail.name,
-                Cocktail.is_api_cocktail == False,
-            )
-            .first()
-        )
-
-        if not user_copy:
-            # First edit: create a personal copy that the user can freely change
-            # without affecting the shared API record that other users reference.
-            user_copy = Cocktail(
-                name=original_cocktail.name,
-                instructions=original_cocktail.instructions,
-                strDrinkThumb=original_cocktail.strDrinkThumb,
-                image_url=original_cocktail.image_url,
-                is_api_cocktail=False,
-                owner_id=user_id,
-            )
-            db.session.add(user_copy)
-            # Flush to obtain user_copy.id before creating FK rows below.
-            db.session.flush()
-
-            # Copy all ingredient associations from the shared record.
-            for ci in original_cocktail.ingredients_relation:
-                db.session.add(
-                    Cocktails_Ingredients(
-                        cocktail_id=user_copy.id,
-                        ingredient_id=ci.ingredient_id,
-                        quantity=ci.quantity,
-                    )
-                )
-
-        # Swap the user's join-table row: remove the link to the shared API
-        # record and replace it with a link to the personal copy.
-        api_rel = Cocktails_Users.query.filter_by(
-            user_id=user_id, cocktail_id=original_cocktail.id
-        ).first()
-        if api_rel:
-            db.session.delete(api_rel)
-            # Flush so the count below reflects the deletion already staged.
-            db.session.flush()
-            # If no other user still references the shared API record, remove
-            # it entirely to prevent orphaned rows inflating admin stats.
-            # The cascade on Cocktail.ct_users2 and .ingredients_relation
-            # handles child-row cleanup automatically.
-            if Cocktails_Users.query.filter_by(cocktail_id=original_cocktail.id).count() == 0:
-                db.session.delete(original_cocktail)
-
-        copy_rel = Cocktails_Users.query.filter_by(
-            user_id=user_id, cocktail_id=user_copy.id
-        ).first()
-        if not copy_rel:
-            db.session.add(Cocktails_Users(user_id=user_id, cocktail_id=user_copy.id))
+        # Copy-on-write: the first edit creates a personal variant that only
+        # references the shared record; nothing is copied until the user
+        # actually changes a field or ingredient.  The indexed
+        # (source_cocktail_id, owner_id) lookup finds an existing variant.
+        user_copy = find_personal_variant(user_id, original_cocktail.id)
+        if user_copy:
+            # Stale direct link alongside an existing variant; drop it.
+            unlink_user_from_cocktail(ownership)
+            if not Cocktails_Users.query.filter_by(
+                user_id=user_id, cocktail_id=user_copy.id
+            ).first():
+                link_user_to_cocktail(user_id, user_copy.id)
+        else:
+            user_copy = create_personal_variant(original_cocktail, user_id, ownership)
 
         db.session.commit()
         # Redirect to the copy's own URL so the edit form POSTs to the
@@ -398,26 +402,27 @@ def edit_cocktail(cocktail_id):
         # Already a user-created (non-API) cocktail — edit in place.
         cocktail = original_cocktail
 
-    form = EditCocktailForm(obj=cocktail)
+    # Variants show their resolved (inherited + overridden) values.
+    resolved = resolve_cocktails([cocktail])[0]
+    form = EditCocktailForm(obj=cocktail, instructions=resolved['instructions'])
 
     if request.method == 'POST' and 'add-ingredient' in request.form:
         form.ingredients.append_entry()
 
     elif form.validate_on_submit():
-        cocktail.name = form.name.data
-        cocktail.instructions = form.instructions.data
+        if not cocktail.source_cocktail_id:
+            cocktail.name = form.name.data
+            cocktail.instructions = form.instructions.data
 
-        # Track the new upload path for orphan cleanup if the DB commit fails.
-        new_filename = None
-        old_image = None
+        # Track the staged upload for orphan cleanup if the DB commit fails.
+        # The image worker swaps it into image_url and removes the old file.
+        staged = None
         try:
-            # save_uploaded_image validates both extension and magic bytes.
-            new_filename = save_uploaded_image(form.image.data)
-            if new_filename:
-                old_image = cocktail.image_url  # remember for cleanup after commit
-                # Consolidate to image_url for user uploads; clear legacy field.
-                cocktail.image_url = new_filename
-                cocktail.strDrinkThumb = None
+            # stage_uploaded_image validates extension, magic bytes and header.
+            staged = stage_uploaded_image(form.image.data)
+            if staged:
+                cocktail.pending_image = staged
+                cocktail.image_rejected = None
         except ValueError as e:
             db.session.rollback()
             flash(str(e), 'danger')
@@ -430,33 +435,42 @@ def edit_cocktail(cocktail_id):
                     'warning',
                 )
             return render_template('edit_my_cocktails.html', form=form, cocktail=cocktail,
-                                   resolved_image=get_cocktail_image_url(cocktail))
-
-        # Sync ingredients: remove rows no longer in the form, add/update the rest.
-        new_names = {ing['ingredient'] for ing in form.ingredients.data}
-        for ci in list(cocktail.ingredients_relation):
-            if ci.ingredient.name not in new_names:
-                cocktail.ingredients_relation.remove(ci)
-                db.session.delete(ci)
-
-        for ingredient_data in form.ingredients.data:
-            assoc = next(
-                (
-                    ci for ci in cocktail.ingredients_relation
-                    if ci.ingredient.name == ingredient_data['ingredient']
-                ),
-                None,
-            )
-            if assoc:
-                # Update quantity in place rather than deleting and re-adding.
-                assoc.quantity = ingredient_data['measure']
-            else:
-                ingredient_obj = store_or_get_ingredient(ingredient_data['ingredient'])
+                                   resolved_image=resolved['image_url'])
+
+        if cocktail.source_cocktail_id:
+            # Personal variant: persist only what differs from the source.
+            apply_variant_edit(cocktail, form.name.data, form.instructions.data,
+                               form.ingredients.data)
+        else:
+            # Sync ingredients: remove rows no longer in the form, add/update the rest.
+            new_names = {ing['ingredient'] for ing in form.ingredients.data}
+            for ci in list(cocktail.ingredients_relation):
+                if ci.ingredient.name not in new_names:
+                    cocktail.ingredients_relation.remove(ci)
+                    db.session.delete(ci)
+
+            added = {}
+            for ingredient_data in form.ingredients.data:
+                assoc = next(
+                    (
+                        ci for ci in cocktail.ingredients_relation
+                        if ci.ingredient.name == ingredient_data['ingredient']
+                    ),
+                    None,
+                )
+                if assoc:
+                    # Update quantity in place rather than deleting and re-adding.
+                    assoc.quantity = ingredient_data['measure']
+                else:
+                    # A name repeated in the form keeps its last measure.
+                    added[ingredient_data['ingredient']] = ingredient_data['measure']
+            for ingredient_obj, measure in zip(store_or_get_ingredients(list(added)),
+                                               added.values()):
                 db.session.add(
                     Cocktails_Ingredients(
                         cocktail=cocktail,
                         ingredient=ingredient_obj,
-                        quantity=ingredient_data['measure'],
+                        quantity=measure,
                     )
                 )
 
@@ -464,15 +478,13 @@ def edit_cocktail(cocktail_id):
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            # Remove the new upload to prevent it becoming an orphan on disk.
-            if new_filename:
-                delete_uploaded_image(new_filename)
+            # Remove the staged upload to prevent it becoming an orphan on disk.
+            discard_staged_image(staged)
             current_app.logger.error(f"DB commit failed during cocktail edit: {e}")
             flash('Failed to save changes. Please try again.', 'danger')
             return render_template('edit_my_cocktails.html', form=form, cocktail=cocktail,
-                                   resolved_image=get_cocktail_image_url(cocktail))
-        # Delete the old local upload only after a successful commit.
-        delete_uploaded_image(old_image)
+                                   resolved_image=resolved['image_url'])
+        enqueue_image_processing(cocktail.id, staged)
         flash('Your cocktail has been updated!', 'success')
         return redirect(url_for('cocktails.my_cocktails'))
 
@@ -481,11 +493,11 @@ def edit_cocktail(cocktail_id):
         all_ingredients = Ingredient.query.all()
         IngredientForm.ingredient.choices = [(ing.name, ing.name) for ing in all_ingredients]
         form.ingredients.entries.clear()
-        for assoc in cocktail.ingredients_relation:
+        for item in resolved['ingredients']:
             entry = IngredientForm()
-            entry.ingredient.data = assoc.ingredient.name
-            entry.measure.data = assoc.quantity
+            entry.ingredient.data = item['ingredient']
+            entry.measure.data = item['measure']
             form.ingredients.append_entry(entry.data)
 
     return render_template('edit_my_cocktails.html', form=form, cocktail=cocktail,
-                           resolved_image=get_cocktail_image_url(cocktail))
+                           resolved_image=resolved['image_url'])
@@ -3,18 +3,26 @@ import asyncio
 import logging
 from datetime import datetime, timezone
 
-from flask import Blueprint, render_template, redirect, url_for, session, flash, request
+from flask import Blueprint, render_template, redirect, url_for, session, flash, request, current_app
 
 from models import db, User, Ingredient, UserFavoriteIngredients, AdminMessage, UserAppeal
 from forms import PreferenceForm, UserFavoriteIngredientForm, UserMessageForm, AppealForm
-from decorators import login_required
+from decorators import login_required, query_budget
 from cocktaildb_api import list_ingredients
 from extensions import cache
+from services.message_service import (
+    ADMIN_UNREAD_COUNTER,
+    adjust_counter,
+    mark_responses_read,
+    paginate_messages,
+)
+from services.user_context import get_current_user
 
 users_bp = Blueprint('users', __name__)
 
 
 @users_bp.route("/")
+@query_budget(3)
 def homepage():
     # Redirect unauthenticated visitors straight to registration.
     if "user_id" in session:
@@ -23,12 +31,13 @@ def homepage():
 
 
 @users_bp.route('/users/profile/<int:user_id>', methods=['GET', 'POST'])
+@query_budget(8)
 @login_required
 def profile(user_id):
     current_user_id = session['user_id']
     # Allow admins to view and edit any profile; regular users may only touch their own.
     if current_user_id != user_id:
-        current_user_obj = db.session.get(User, current_user_id)
+        current_user_obj = get_current_user()
         if not current_user_obj or not current_user_obj.is_admin:
             flash('You do not have permission to edit this profile.', 'danger')
             return redirect(url_for('users.homepage'))
@@ -101,8 +110,11 @@ def profile(user_id):
                     logging.error(f"Failed to add ingredient: {e}")
                     flash('Failed to add ingredient!', 'danger')
 
+    # One joined query rather than a lazy ingredient load per favourite.
     user_favorite_ingredients = [
-        (i.ingredient.id, i.ingredient.name) for i in user.user_favorite_ingredients
+        tuple(row) for row in db.session.query(Ingredient.id, Ingredient.name)
+        .join(UserFavoriteIngredients, UserFavoriteIngredients.ingredient_id == Ingredient.id)
+        .filter(UserFavoriteIngredients.user_id == user.id)
     ]
     return render_template(
         '/users/profile.html',
@@ -114,13 +126,14 @@ def profile(user_id):
 
 
 @users_bp.route('/delete-favorite-ingredient/<int:user_id>/<int:ingredient_id>', methods=['POST'])
+@query_budget(5)
 def delete_favorite_ingredient(user_id, ingredient_id):
     current_user_id = session.get('user_id')
     if not current_user_id:
         flash('You do not have permission to delete this ingredient.', 'danger')
         return redirect(url_for('users.profile', user_id=user_id))
     # Allow admins to remove ingredients on any profile; users may only touch their own.
-    current_user_obj = db.session.get(User, current_user_id)
+    current_user_obj = get_current_user()
     if current_user_id != user_id and (not current_user_obj or not current_user_obj.is_admin):
         flash('You do not have permission to delete this ingredient.', 'danger')
         return redirect(url_for('users.profile', user_id=user_id))
@@ -143,20 +156,26 @@ def delete_favorite_ingredient(user_id, ingredient_id):
 
 
 @users_bp.route("/user/messages")
+@query_budget(8)
 @login_required
 def user_messages():
     user_id = session.get("user_id")
-    # Retrieve the user's message thread, newest first.
-    messages = (
-        AdminMessage.query
-        .filter_by(user_id=user_id)
-        .order_by(AdminMessage.created_at.desc())
-        .all()
+    # Retrieve one page of the user's message thread, newest first.
+    messages, next_cursor = paginate_messages(
+        AdminMessage.query.filter_by(user_id=user_id),
+        request.args.get('cursor'),
+        current_app.config['MESSAGES_PER_PAGE'],
     )
-    return render_template("user_messages.html", messages=messages)
+    # Opening the inbox counts as seeing every pending admin response.
+    user = db.session.get(User, user_id)
+    if user and user.unread_response_count:
+        mark_responses_read(user)
+        db.session.commit()
+    return render_template("user_messages.html", messages=messages, next_cursor=next_cursor)
 
 
 @users_bp.route("/user/send-message", methods=["GET", "POST"])
+@query_budget(6)
 @login_required
 def send_user_message():
     form = UserMessageForm()
@@ -169,6 +188,7 @@ def send_user_message():
                 message_type=form.message_type.data,
             )
         )
+        adjust_counter(ADMIN_UNREAD_COUNTER, 1)
         db.session.commit()
         flash("Your message has been sent to the admin.", "success")
         return redirect(url_for('users.user_messages'))
@@ -176,6 +196,7 @@ def send_user_message():
 
 
 @users_bp.route("/appeal/status")
+@query_budget(4)
 def appeal_status():
     """Stable landing page for banned users after they submit or already have a pending appeal.
 
@@ -198,6 +219,7 @@ def appeal_status():
 
 
 @users_bp.route("/appeal", methods=["GET", "POST"])
+@query_budget(5)
 def submit_appeal():
     user_id = session.get("user_id")
     if not user_id:
@@ -4,13 +4,20 @@ Creates the Flask app (which configures the Celery broker, result backend,
 and FlaskTask base class) and then imports all task modules so the worker
 discovers every task before it begins consuming queue messages.
 
-Start a worker:
+Start a worker for one queue profile (see WORKER_PROFILES below):
+    python celery_worker.py transactional --loglevel=info
+    python celery_worker.py bulk --loglevel=info
+    python celery_worker.py maintenance --loglevel=info
+
+or one worker for every queue (development):
     celery -A celery_worker worker --loglevel=info
 
 Run scheduled/periodic tasks (optional):
     celery -A celery_worker beat --loglevel=info
 """
-from app import create_app
+import sys
+
+from app import CELERY_QUEUES, create_app
 
 # Spin up the Flask app; this call runs _celery_init(), which:
 #   • Sets the broker/result-backend URLs on the global Celery instance.
@@ -21,7 +28,96 @@ flask_app = create_app()
 # Import task modules *after* create_app() so the _FlaskTask base class
 # is already in place when @celery.task decorators are evaluated.
 import services.email_service  # noqa: F401 — registers email tasks
+import services.cocktail_service  # noqa: F401 — registers the orphan collector
+import services.thumb_cache  # noqa: F401 — registers thumbnail fetch/prune
+import services.upload_gc  # noqa: F401 — registers the orphaned-upload collector
+import services.broadcast_service  # noqa: F401 — registers broadcast fan-out
+import services.maintenance  # noqa: F401 — registers ban, account and appeal sweeps
 
 # Re-export the configured Celery instance so that
 # ``celery -A celery_worker`` can locate it.
-from extensions import celery  # noqa: F401
+from extensions import celery  # noqa: E402
+
+# Periodic jobs picked up by ``celery -A celery_worker beat``.
+celery.conf.beat_schedule = {
+    # Sends email committed to the outbox; failures are retried with backoff.
+    'relay-email-outbox': {
+        'task': 'email_service.relay_outbox',
+        'schedule': 10,
+    },
+    # Shared API cocktails are only de-referenced inside user requests; the
+    # rows themselves (and their ingredient links) are reclaimed here.
+    'collect-orphaned-api-cocktails': {
+        'task': 'cocktail_service.collect_orphaned_api_cocktails',
+        'schedule': 15 * 60,
+    },
+    # Keeps the on-disk thumbnail cache under THUMB_CACHE_MAX_BYTES.
+    'prune-thumb-cache': {
+        'task': 'thumb_cache.prune_thumb_cache',
+        'schedule': 10 * 60,
+    },
+    # Splits newly queued admin broadcasts into chunked send tasks.
+    'dispatch-broadcasts': {
+        'task': 'broadcast_service.dispatch_broadcasts',
+        'schedule': 10,
+    },
+    # Clears temporary bans once they expire and emails the user.
+    'lift-expired-bans': {
+        'task': 'maintenance.lift_expired_bans',
+        'schedule': 5 * 60,
+    },
+    # Deletes sign-ups never verified within UNVERIFIED_ACCOUNT_TTL_DAYS.
+    'purge-unverified-accounts': {
+        'task': 'maintenance.purge_unverified_accounts',
+        'schedule': 24 * 60 * 60,
+    },
+    # Moves appeals decided APPEAL_ARCHIVE_AFTER_DAYS ago out of user_appeal.
+    'archive-decided-appeals': {
+        'task': 'maintenance.archive_decided_appeals',
+        'schedule': 24 * 60 * 60,
+    },
+    # Quarantines uploads no row refers to and deletes them a week later.
+    'collect-orphaned-uploads': {
+        'task': 'upload_gc.collect_orphaned_uploads',
+        'schedule': 24 * 60 * 60,
+    },
+}
+
+
+# Per-queue worker settings.  Extra command-line options are passed through
+# after these, so e.g. ``python celery_worker.py bulk --concurrency 4`` wins.
+WORKER_PROFILES = {
+    # Short tasks a user is waiting on: several processes, each reserving a
+    # few messages so a burst of sign-ups drains without broker round trips.
+    'transactional': {'queues': ('transactional',), 'concurrency': 4, 'prefetch_multiplier': 4},
+    # Broadcast chunks run for minutes and are acknowledged late; reserving
+    # more than one would only strand it behind a running chunk.
+    'bulk': {'queues': ('bulk',), 'concurrency': 2, 'prefetch_multiplier': 1},
+    # Beat sweeps lock rows in batches; one at a time is plenty.
+    'maintenance': {'queues': ('maintenance',), 'concurrency': 1, 'prefetch_multiplier': 1},
+    # Development: a single worker for everything.
+    'all': {'queues': CELERY_QUEUES, 'concurrency': 2, 'prefetch_multiplier': 1},
+}
+
+
+def worker_argv(profile, extra=()):
+    """Celery ``worker`` arguments for *profile*, followed by *extra*."""
+    settings = WORKER_PROFILES[profile]
+    return [
+        'worker',
+        '--queues', ','.join(settings['queues']),
+        '--concurrency', str(settings['concurrency']),
+        '--prefetch-multiplier', str(settings['prefetch_multiplier']),
+        '--hostname', f'{profile}@%h',
+        *extra,
+    ]
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    profile = 'all'
+    if args and not args[0].startswith('-'):
+        profile = args.pop(0)
+    if profile not in WORKER_PROFILES:
+        sys.exit(f"Unknown worker profile {profile!r}; choose from {', '.join(WORKER_PROFILES)}")
+    celery.worker_main(worker_argv(profile, args))
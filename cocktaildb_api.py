@@ -5,8 +5,12 @@ import requests  # For synchronous HTTP requests
 import httpx  # For asynchronous HTTP requests
 import asyncio  # For asynchronous programming
 import backoff  # For handling retries with exponential backoff
+import time
+from contextlib import contextmanager
 
 from config import COCKTAILDB_API_KEY
+import metrics
+from request_timing import timed
 
 # Build the base URL from the configured API key so it can be swapped
 # in .env without touching source code (free-tier key is "1").
@@ -16,14 +20,29 @@ BASE_URL = f"https://www.thecocktaildb.com/api/json/v1/{COCKTAILDB_API_KEY}"
 _SYNC_TIMEOUT = (5, 10)
 
 
+@contextmanager
+def _upstream_call():
+    """Time one API request for Server-Timing and /metrics, counting failures."""
+    started = time.perf_counter()
+    try:
+        with timed('cocktaildb'):
+            yield
+    except Exception as exc:
+        metrics.COCKTAILDB_ERRORS.labels(type(exc).__name__).inc()
+        raise
+    finally:
+        metrics.COCKTAILDB_LATENCY.observe(time.perf_counter() - started)
+
+
 # Function to search for an ingredient by name
 @backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=3)
 def search_ingredient(ingredient_name):
     # Define the API endpoint for searching ingredients
     url = f"{BASE_URL}/search.php"
     # Send a GET request to the API with the ingredient name as a parameter
-    response = requests.get(url, params={"i": ingredient_name}, timeout=_SYNC_TIMEOUT)
-    response.raise_for_status()
+    with _upstream_call():
+        response = requests.get(url, params={"i": ingredient_name}, timeout=_SYNC_TIMEOUT)
+        response.raise_for_status()
     return response.json()
 
 # Asynchronous function to list all ingredients from the API
@@ -33,9 +52,10 @@ async def list_ingredients():
     try:
         # Use httpx.AsyncClient to send a GET request asynchronously
         async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=5.0)) as client:
-            response = await client.get(url)
-            # Raise an exception for 4XX/5XX responses
-            response.raise_for_status()
+            with _upstream_call():
+                response = await client.get(url)
+                # Raise an exception for 4XX/5XX responses
+                response.raise_for_status()
             
             # Extract the list of ingredients from the response JSON
             ingredients = response.json().get('drinks', [])
@@ -61,9 +81,10 @@ async def get_cocktails_by_first_letter(letter):
         timeout = httpx.Timeout(10.0, connect=5.0)
         
         async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(url)
-            # Raise an exception for 4XX/5XX responses
-            response.raise_for_status()
+            with _upstream_call():
+                response = await client.get(url)
+                # Raise an exception for 4XX/5XX responses
+                response.raise_for_status()
             
             # Extract the list of cocktails from the response JSON
             cocktails = response.json().get('drinks', [])
@@ -84,8 +105,9 @@ def lookup_cocktail(cocktail_id):
     # Define the API endpoint for looking up a cocktail by ID
     url = f"{BASE_URL}/lookup.php"
     # Send a GET request to the API with the cocktail ID as a parameter
-    response = requests.get(url, params={"i": cocktail_id}, timeout=_SYNC_TIMEOUT)
-    response.raise_for_status()
+    with _upstream_call():
+        response = requests.get(url, params={"i": cocktail_id}, timeout=_SYNC_TIMEOUT)
+        response.raise_for_status()
     return response.json()
 
 # Asynchronous function to get a combined list of cocktails by querying multiple letters
@@ -120,8 +142,9 @@ def get_cocktail_detail(cocktail_id):
     # Define the API endpoint for looking up a cocktail by ID
     url = f"{BASE_URL}/lookup.php?i={cocktail_id}"
     # Send a GET request to the API with an explicit timeout to prevent hangs.
-    response = requests.get(url, timeout=_SYNC_TIMEOUT)
-    response.raise_for_status()
+    with _upstream_call():
+        response = requests.get(url, timeout=_SYNC_TIMEOUT)
+        response.raise_for_status()
     drinks = response.json().get('drinks') or []
     return drinks[0] if drinks else None
 
@@ -131,7 +154,8 @@ def get_random_cocktail():
     # Define the endpoint URL for getting a random cocktail
     endpoint = f"{BASE_URL}/random.php"
     # Send a GET request to the API with an explicit timeout.
-    response = requests.get(endpoint, timeout=_SYNC_TIMEOUT)
+    with _upstream_call():
+        response = requests.get(endpoint, timeout=_SYNC_TIMEOUT)
     # Parse the JSON response data
     data = response.json()
     
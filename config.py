@@ -36,6 +36,11 @@ SECURE_SSL_REDIRECT: bool = os.environ.get('SECURE_SSL_REDIRECT', 'False').lower
 SESSION_COOKIE_SECURE: bool = os.environ.get('SESSION_COOKIE_SECURE', 'False').lower() == 'true'
 SESSION_COOKIE_HTTPONLY: bool = os.environ.get('SESSION_COOKIE_HTTPONLY', 'True').lower() == 'true'
 SESSION_COOKIE_SAMESITE: str = os.environ.get('SESSION_COOKIE_SAMESITE', 'Lax')
+# 'redis' keeps session data server-side (revocable, see services/sessions.py);
+# 'cookie' keeps Flask's signed-cookie sessions.
+SESSION_STORE: str = os.environ.get('SESSION_STORE', 'redis')
+# Seconds each process may reuse a session it read from Redis.
+SESSION_LOCAL_CACHE_TTL: float = float(os.environ.get('SESSION_LOCAL_CACHE_TTL', '5'))
 
 # ── Mail (Flask-Mail) ─────────────────────────────────────────────────────────
 # For local development the defaults point at localhost with no auth.
@@ -47,6 +52,9 @@ MAIL_USE_SSL: bool = os.environ.get('MAIL_USE_SSL', 'False').lower() == 'true'
 MAIL_USERNAME: str = os.environ.get('MAIL_USERNAME', '')
 MAIL_PASSWORD: str = os.environ.get('MAIL_PASSWORD', '')
 MAIL_DEFAULT_SENDER: str = os.environ.get('MAIL_DEFAULT_SENDER', 'noreply@cocktaildb.com')
+# Bulk sends reuse one SMTP session; Flask-Mail reopens it after this many
+# messages, since many providers cap the messages accepted per session.
+MAIL_MAX_EMAILS: int = int(os.environ.get('MAIL_MAX_EMAILS', '100'))
 
 # ── Admin panel ───────────────────────────────────────────────────────────────
 # Keep this private; never commit its real value to version control.
@@ -66,8 +74,93 @@ COCKTAILDB_API_KEY: str = os.environ.get('COCKTAILDB_API_KEY', '1')
 # ── Rate limiting (Flask-Limiter) ─────────────────────────────────────────────
 # Set to False in test environments to disable rate limiting.
 RATELIMIT_ENABLED: bool = os.environ.get('RATELIMIT_ENABLED', 'True').lower() == 'true'
+# Counters live in Redis (REDIS_URL) so limits are shared by every worker.
+# Per-process ceiling checked before Redis is consulted; a client that
+# exceeds it in one process alone is rejected without a round trip.
+RATELIMIT_LOCAL_PRECHECK: str = os.environ.get('RATELIMIT_LOCAL_PRECHECK', '50 per second')
 
-# ── Redis (Celery broker + result backend + cache) ────────────────────────────
+# ── Password hashing ──────────────────────────────────────────────────────────
+# bcrypt work factor; set it in production so every process hashes at the
+# same cost.  Unset, FLASK_DEBUG picks the highest cost that hashes within
+# BCRYPT_TARGET_MS on this machine at startup, and anything else uses 12.
+BCRYPT_LOG_ROUNDS: int = int(os.environ.get('BCRYPT_LOG_ROUNDS') or '0')
+BCRYPT_TARGET_MS: int = int(os.environ.get('BCRYPT_TARGET_MS', '250'))
+# Threads per process that hash and check passwords (0 = half the CPU
+# cores), and how long a login may wait for one before it is refused.
+PASSWORD_HASH_WORKERS: int = int(os.environ.get('PASSWORD_HASH_WORKERS') or '0')
+PASSWORD_HASH_TIMEOUT: float = float(os.environ.get('PASSWORD_HASH_TIMEOUT', '5'))
+
+# ── TheCocktailDB thumbnail cache ─────────────────────────────────────────────
+# Upper bound on the on-disk thumbnail cache; least-recently-served
+# thumbnails are evicted by the periodic prune job beyond this.
+THUMB_CACHE_MAX_BYTES: int = int(os.environ.get('THUMB_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# ── Upload serving ────────────────────────────────────────────────────────────
+# Hand upload bytes to the fronting server instead of streaming them from a
+# Python worker: "x-accel-redirect" (nginx), "x-sendfile" (Apache
+# mod_xsendfile, lighttpd) or empty to serve from Flask.
+UPLOAD_SENDFILE: str = os.environ.get('UPLOAD_SENDFILE', '').lower()
+# nginx ``internal`` location aliased to the uploads directory.
+UPLOAD_ACCEL_REDIRECT_PREFIX: str = os.environ.get('UPLOAD_ACCEL_REDIRECT_PREFIX', '/_uploads/')
+
+# ── Upload storage ────────────────────────────────────────────────────────────
+# "local" keeps uploads in static/uploads on this node; "s3" stores them in
+# an S3-compatible bucket shared by every node (set S3_ENDPOINT_URL for
+# MinIO or another non-AWS provider).  The s3 driver needs boto3.
+UPLOAD_STORAGE: str = os.environ.get('UPLOAD_STORAGE', 'local').lower()
+S3_BUCKET: str = os.environ.get('S3_BUCKET', '')
+S3_PREFIX: str = os.environ.get('S3_PREFIX', 'uploads/')
+S3_ENDPOINT_URL: str = os.environ.get('S3_ENDPOINT_URL', '')
+S3_REGION: str = os.environ.get('S3_REGION', '')
+# Leave blank to use boto3's default credential chain (env, instance role…).
+S3_ACCESS_KEY_ID: str = os.environ.get('S3_ACCESS_KEY_ID', '')
+S3_SECRET_ACCESS_KEY: str = os.environ.get('S3_SECRET_ACCESS_KEY', '')
+# Lifetime of the presigned URLs uploads redirect to.
+S3_PRESIGN_TTL: int = int(os.environ.get('S3_PRESIGN_TTL', '3600'))
+# Public (e.g. CDN) base URL for the bucket; when set, reads redirect there
+# instead of to a presigned URL.
+S3_PUBLIC_URL: str = os.environ.get('S3_PUBLIC_URL', '')
+
+# ── Scheduled maintenance ─────────────────────────────────────────────────────
+# Accounts whose email is still unverified this many days after sign-up are
+# deleted by the nightly purge job.
+UNVERIFIED_ACCOUNT_TTL_DAYS: int = int(os.environ.get('UNVERIFIED_ACCOUNT_TTL_DAYS', '30'))
+# Approved / rejected appeals move to user_appeal_archive this many days
+# after they were decided.
+APPEAL_ARCHIVE_AFTER_DAYS: int = int(os.environ.get('APPEAL_ARCHIVE_AFTER_DAYS', '90'))
+
+# ── Redis (Celery, cache, rate limiter, sessions) ─────────────────────────────
 # Heroku / Render inject this automatically when a Redis add-on is attached.
 # For local development, run: redis-server (default port 6379).
-REDIS_URL: str = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
\ No newline at end of file
+REDIS_URL: str = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Connections each process may hold in the shared pool (redis_pool.py), and
+# how long a caller waits for a free one before the call fails.
+REDIS_MAX_CONNECTIONS: int = int(os.environ.get('REDIS_MAX_CONNECTIONS', '20'))
+REDIS_POOL_TIMEOUT: float = float(os.environ.get('REDIS_POOL_TIMEOUT', '1'))
+# Connect / read timeout per command, and idle seconds before a pooled
+# connection is checked with PING on its next use.
+REDIS_SOCKET_TIMEOUT: float = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '0.5'))
+REDIS_HEALTH_CHECK_INTERVAL: int = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+# After this many failed connects in a row Redis is treated as down: calls
+# fail over at once, and reconnects are retried after a jittered delay that
+# doubles up to REDIS_RECONNECT_MAX seconds.
+REDIS_BREAKER_THRESHOLD: int = int(os.environ.get('REDIS_BREAKER_THRESHOLD', '3'))
+REDIS_RECONNECT_MAX: float = float(os.environ.get('REDIS_RECONNECT_MAX', '30'))
+# Per-process stand-ins while Redis is down: entries in the fallback cache,
+# and threads / queued tasks for Celery tasks that may run in-process.
+CACHE_LOCAL_MAX_ITEMS: int = int(os.environ.get('CACHE_LOCAL_MAX_ITEMS', '500'))
+CELERY_LOCAL_WORKERS: int = int(os.environ.get('CELERY_LOCAL_WORKERS', '2'))
+CELERY_LOCAL_BACKLOG: int = int(os.environ.get('CELERY_LOCAL_BACKLOG', '100'))
+
+# ── Request instrumentation ───────────────────────────────────────────────────
+# Fraction of requests (0 to 1) that get a Server-Timing header and a timing
+# log line (request_timing.py); 0 turns instrumentation off.
+SERVER_TIMING_SAMPLE_RATE: float = float(os.environ.get('SERVER_TIMING_SAMPLE_RATE', '0'))
+# What happens when a request runs more SQL statements than its view's
+# @query_budget (query_counter.py): 'raise', 'log' or 'off'.  Empty means
+# 'raise' under TESTING, 'log' under DEBUG and 'off' otherwise.
+QUERY_BUDGET_MODE: str = os.environ.get('QUERY_BUDGET_MODE', '')
+# Bearer token a Prometheus scraper must send to GET /metrics.  Empty means
+# only requests from localhost are answered; behind a reverse proxy on the
+# same host every request looks local, so set this or deny /metrics there.
+METRICS_TOKEN: str = os.environ.get('METRICS_TOKEN', '')
\ No newline at end of file
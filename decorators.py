@@ -1,6 +1,6 @@
 from functools import wraps
 from flask import session, flash, redirect, url_for
-from models import db, User
+from services.user_context import get_current_user
 
 
 def login_required(f):
@@ -19,13 +19,26 @@ def admin_required(f):
     """Redirect non-admin users; require login first."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Two-step check: session presence, then admin flag from the DB.
+        # Two-step check: session presence, then the admin flag from the
+        # request-scoped user context (shared with enforce_ban).
         if "user_id" not in session:
             flash("You must be logged in to access this page.", "danger")
             return redirect(url_for('auth.login'))
-        user = db.session.get(User, session["user_id"])
+        user = get_current_user()
         if not user or not user.is_admin:
             flash("Admin access required.", "danger")
             return redirect(url_for('users.homepage'))
         return f(*args, **kwargs)
     return decorated_function
+
+
+def query_budget(max_statements):
+    """Declare how many SQL statements one request to this view may run.
+
+    Place it directly under the route decorator.  The view is returned
+    unchanged; query_counter.py checks the count after each request.
+    """
+    def decorator(f):
+        f.query_budget = max_statements
+        return f
+    return decorator
@@ -5,7 +5,7 @@ circular-import errors (blueprints → app → blueprints).
 
 Usage in blueprints::
 
-    from extensions import limiter, mail, cache
+    from extensions import limiter, mail, cache, redis_pool
 """
 
 from flask_wtf.csrf import CSRFProtect
@@ -16,10 +16,15 @@ from flask_limiter.util import get_remote_address
 from flask_caching import Cache
 from celery import Celery
 
+from rate_limiting import LocalFloodGuard
+from redis_pool import RedisPool
+
 # Uninitialised singletons — call .init_app(app) inside create_app().
 csrf = CSRFProtect()
 mail = Mail()
 migrate = Migrate()
 limiter = Limiter(key_func=get_remote_address)
+flood_guard = LocalFloodGuard()
 cache = Cache()
 celery = Celery()
+redis_pool = RedisPool()
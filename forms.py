@@ -125,6 +125,23 @@ class AdminMessageForm(FlaskForm):
     submit = SubmitField('Send Message')
     # Submit button for sending the message
 
+# Define a form for admins to email an announcement to a group of users
+class BroadcastForm(FlaskForm):
+    """Form for admins to broadcast an announcement or warning by email."""
+    audience = SelectField('Send To', choices=[
+        ('all', 'All users'),
+        ('verified', 'Verified users'),
+        ('unverified', 'Unverified users'),
+        ('banned', 'Banned users'),
+    ], validators=[InputRequired()])
+    # Which users receive the broadcast
+    subject = StringField('Subject', validators=[DataRequired(), Length(min=5, max=255)])
+    # Subject line of the email
+    body = TextAreaField('Message', validators=[DataRequired(), Length(min=10, max=5000)])
+    # Plain-text body of the email
+    submit = SubmitField('Send Broadcast')
+    # Submit button for queuing the broadcast
+
 # Define a form for banned users to appeal their ban
 class AppealForm(FlaskForm):
     """Form for banned users to submit an appeal requesting ban removal."""
@@ -0,0 +1,25 @@
+"""gunicorn settings, loaded automatically from the working directory.
+
+Prepares the shared directory prometheus_client writes per-process
+metrics to, so ``/metrics`` reports all workers rather than the one that
+answered the scrape (see metrics.py).
+"""
+import os
+import shutil
+import tempfile
+
+# Must be set before any worker imports prometheus_client.
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'cocktail-metrics'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would be merged into this one's.
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    # Drops the dead worker's live gauges; its counters and histograms stay.
+    multiprocess.mark_process_dead(worker.pid)
@@ -84,6 +84,24 @@ to contact our support team.
 
 We look forward to having you back in our community!
 
+Best regards,
+The Cocktail Chronicles Admin Team
+    """.strip()
+    return email_body
+
+def generate_ban_expired_email(username):
+    """Generate email notifying user that their temporary suspension has ended."""
+    email_body = f"""
+Dear {username},
+
+The temporary suspension on your Cocktail Chronicles account has now ended.
+
+Your account is active again, and you are welcome to log in and use all features of Cocktail Chronicles as before. 
+Please remember to follow our Community Guidelines so that your account stays in good standing.
+
+If you have any questions or concerns, or if you experience any issues accessing your account, please don't hesitate 
+to contact our support team.
+
 Best regards,
 The Cocktail Chronicles Admin Team
     """.strip()
@@ -0,0 +1,118 @@
+"""Prometheus metrics, served at ``/metrics``.
+
+* ``http_request_duration_seconds{endpoint, status}`` — request latency.
+* ``db_pool_checked_out`` / ``db_pool_overflow`` — SQLAlchemy pool gauges,
+  updated on every checkout and checkin.
+* ``cache_lookups_total{key, result}`` — hits and misses for the keys in
+  :data:`TRACKED_CACHE_KEYS`; the hit ratio is
+  ``rate(...{result="hit"}) / rate(...)``.
+* ``cocktaildb_request_duration_seconds`` and
+  ``cocktaildb_errors_total{error}`` — TheCocktailDB calls.
+* ``celery_enqueue_duration_seconds{task, outcome}`` — time to hand a task
+  to the broker.
+
+gunicorn runs several worker processes, and a scrape reaches only one of
+them.  When ``PROMETHEUS_MULTIPROC_DIR`` is set (``gunicorn.conf.py`` sets
+it), every process writes its samples to files in that directory and
+:func:`render` merges them, so each scrape covers all workers.  Gauges
+are summed over live processes.
+"""
+import os
+import time
+
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+
+
+# Keys whose cache hit ratio is exported; other keys are not labelled so
+# the series count stays fixed.
+TRACKED_CACHE_KEYS = frozenset({'all_cocktails', 'api_ingredients_list'})
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint and status.',
+    ['endpoint', 'status'],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out', 'Database connections checked out of the pool.',
+    multiprocess_mode='livesum',
+)
+DB_POOL_OVERFLOW = Gauge(
+    'db_pool_overflow', 'Database connections open beyond the pool size.',
+    multiprocess_mode='livesum',
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Cache lookups of tracked keys by result.', ['key', 'result'],
+)
+COCKTAILDB_LATENCY = Histogram(
+    'cocktaildb_request_duration_seconds', 'TheCocktailDB request latency.',
+)
+COCKTAILDB_ERRORS = Counter(
+    'cocktaildb_errors_total', 'Failed TheCocktailDB requests by error type.', ['error'],
+)
+CELERY_ENQUEUE_LATENCY = Histogram(
+    'celery_enqueue_duration_seconds', 'Time to publish a Celery task by outcome.',
+    ['task', 'outcome'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, float('inf')),
+)
+
+
+def record_cache_lookup(key, hit: bool) -> None:
+    if key in TRACKED_CACHE_KEYS:
+        CACHE_LOOKUPS.labels(key, 'hit' if hit else 'miss').inc()
+
+
+def render() -> tuple[bytes, str]:
+    """Exposition text for all processes, and its content type."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def _watch_pool(engine) -> None:
+    if not hasattr(engine.pool, 'checkedout'):
+        # SQLite's single-connection pools have nothing to report.
+        return
+
+    def update(returning):
+        # Looked up per call: engine.dispose() replaces the pool.
+        pool = engine.pool
+        # "checkin" fires before the connection is back in the pool.
+        checked_out = pool.checkedout() - returning
+        DB_POOL_CHECKED_OUT.set(checked_out)
+        DB_POOL_OVERFLOW.set(max(0, checked_out - pool.size()))
+
+    event.listen(engine, 'checkout', lambda *args: update(0))
+    event.listen(engine, 'checkin', lambda *args: update(1))
+
+
+def init_app(app, db) -> None:
+    """Time every request and watch *db*'s connection pool."""
+    with app.app_context():
+        _watch_pool(db.engine)
+
+    @app.before_request
+    def _start_request_metrics():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            # Unmatched URLs share one label so scanners cannot add series.
+            REQUEST_LATENCY.labels(request.endpoint or '<unmatched>',
+                                   str(response.status_code)).observe(
+                time.perf_counter() - started)
+        return response
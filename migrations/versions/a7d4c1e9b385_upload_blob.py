@@ -0,0 +1,39 @@
+"""content-addressed upload blobs
+
+Revision ID: a7d4c1e9b385
+Revises: f1b3e8c6d527
+Create Date: 2026-10-19 00:00:00.000000
+
+New uploads are stored under the SHA-256 of their re-encoded bytes and
+shared between every cocktail that uses the same image.  ``upload_blob``
+holds one row per stored file with the number of cocktails referring to
+it; files are deleted only when that count reaches zero.
+
+Existing UUID-named uploads get no row and keep their old delete-on-use
+behaviour.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d4c1e9b385'
+down_revision = 'f1b3e8c6d527'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'upload_blob',
+        sa.Column('filename', sa.String(length=80), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('variants', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('filename'),
+    )
+
+
+def downgrade():
+    op.drop_table('upload_blob')
@@ -0,0 +1,50 @@
+"""transactional email outbox
+
+Revision ID: b2e8f4a6c719
+Revises: a7d4c1e9b385
+Create Date: 2026-10-19 00:00:00.000000
+
+Outbound email is written to ``email_outbox`` in the same transaction as
+the action that triggers it and relayed to SMTP by a periodic worker task,
+so requests no longer enqueue Celery tasks (or lose email when the broker
+is down).  The ``(status, next_attempt_at)`` index serves the relay's
+"due pending rows" scan.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2e8f4a6c719'
+down_revision = 'a7d4c1e9b385'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'email_outbox',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('subject', sa.String(length=255), nullable=False),
+        sa.Column('recipients', sa.JSON(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('html', sa.Text(), nullable=True),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        'ix_email_outbox_status_next_attempt_at',
+        'email_outbox',
+        ['status', 'next_attempt_at'],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index('ix_email_outbox_status_next_attempt_at', table_name='email_outbox')
+    op.drop_table('email_outbox')
@@ -0,0 +1,70 @@
+"""message inbox pagination indexes and unread counters
+
+Revision ID: b7e4c2a9d013
+Revises: a1b2c3d4e5f6
+Create Date: 2026-10-19 00:00:00.000000
+
+Adds composite ``(created_at, id)`` indexes on ``admin_message`` for the
+keyset-paginated admin and user inboxes, plus the columns and table that
+hold the O(1) unread counters:
+
+* ``admin_message.response_is_read`` — False while the author has an
+  unseen admin response.
+* ``user.unread_response_count`` — per-user badge value.
+* ``inbox_counter`` — named global counters (``admin_unread``).
+
+Existing data is back-filled so the counters start out correct.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4c2a9d013'
+down_revision = 'a1b2c3d4e5f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_admin_message_created_at_id',
+        'admin_message',
+        ['created_at', 'id'],
+        unique=False,
+    )
+    op.create_index(
+        'ix_admin_message_user_id_created_at_id',
+        'admin_message',
+        ['user_id', 'created_at', 'id'],
+        unique=False,
+    )
+    # Existing responses are treated as already seen so users are not
+    # greeted with a badge for replies they read long ago.
+    op.add_column(
+        'admin_message',
+        sa.Column('response_is_read', sa.Boolean(), nullable=False, server_default='1'),
+    )
+    op.add_column(
+        'user',
+        sa.Column('unread_response_count', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.create_table(
+        'inbox_counter',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+    # Seed the admin badge from the current unread messages (one-off scan).
+    op.execute(
+        "INSERT INTO inbox_counter (name, value) "
+        "SELECT 'admin_unread', COUNT(*) FROM admin_message WHERE is_read = false"
+    )
+
+
+def downgrade():
+    op.drop_table('inbox_counter')
+    op.drop_column('user', 'unread_response_count')
+    op.drop_column('admin_message', 'response_is_read')
+    op.drop_index('ix_admin_message_user_id_created_at_id', table_name='admin_message')
+    op.drop_index('ix_admin_message_created_at_id', table_name='admin_message')
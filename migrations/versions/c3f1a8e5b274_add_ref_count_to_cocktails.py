@@ -0,0 +1,45 @@
+"""add ref_count to cocktails
+
+Revision ID: c3f1a8e5b274
+Revises: b7e4c2a9d013
+Create Date: 2026-10-19 00:00:00.000000
+
+Adds ``cocktails.ref_count`` — the number of ``cocktails_users`` rows that
+reference each cocktail — so request handlers no longer COUNT the join
+table to decide whether a shared API row is still needed.  The column is
+back-filled from the current join-table contents, and an index on
+``(is_api_cocktail, ref_count)`` lets the background orphan collector find
+unreferenced API rows cheaply.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a8e5b274'
+down_revision = 'b7e4c2a9d013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'cocktails',
+        sa.Column('ref_count', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.execute(
+        "UPDATE cocktails SET ref_count = ("
+        "SELECT COUNT(*) FROM cocktails_users "
+        "WHERE cocktails_users.cocktail_id = cocktails.id)"
+    )
+    op.create_index(
+        'ix_cocktails_is_api_cocktail_ref_count',
+        'cocktails',
+        ['is_api_cocktail', 'ref_count'],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index('ix_cocktails_is_api_cocktail_ref_count', table_name='cocktails')
+    op.drop_column('cocktails', 'ref_count')
@@ -0,0 +1,55 @@
+"""admin broadcasts
+
+Revision ID: c5a9e3d71f08
+Revises: b2e8f4a6c719
+Create Date: 2026-10-19 00:00:00.000000
+
+``broadcast`` holds one admin announcement and its progress counters;
+``broadcast_delivery`` holds one row per recipient, keyed by
+``(broadcast_id, user_id)`` so the fan-out tasks can walk a broadcast in
+``user_id`` ranges.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a9e3d71f08'
+down_revision = 'b2e8f4a6c719'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'broadcast',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('admin_id', sa.Integer(), nullable=True),
+        sa.Column('subject', sa.String(length=255), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('audience', sa.String(length=20), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='queued'),
+        sa.Column('total_recipients', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('sent_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('failed_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['admin_id'], ['user.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'broadcast_delivery',
+        sa.Column('broadcast_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='pending'),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['broadcast_id'], ['broadcast.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('broadcast_id', 'user_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('broadcast_delivery')
+    op.drop_table('broadcast')
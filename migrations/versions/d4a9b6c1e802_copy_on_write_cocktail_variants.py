@@ -0,0 +1,52 @@
+"""copy-on-write cocktail variants
+
+Revision ID: d4a9b6c1e802
+Revises: c3f1a8e5b274
+Create Date: 2026-10-19 00:00:00.000000
+
+Personal edits of shared API cocktails are now stored as variants: a
+``cocktails`` row whose ``source_cocktail_id`` points at the shared row and
+which holds only the overridden fields.  Ingredient changes are stored as
+``cocktails_ingredients`` deltas on the variant; ``is_removed`` marks a
+source ingredient the user deleted.
+
+The ``(source_cocktail_id, owner_id)`` index replaces the old name-based
+join used to find a user's personal copy.  Existing full copies are left
+untouched and continue to work as ordinary user cocktails.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a9b6c1e802'
+down_revision = 'c3f1a8e5b274'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # batch_alter_table lets SQLite add the self-referencing FK constraint.
+    with op.batch_alter_table('cocktails') as batch_op:
+        batch_op.add_column(sa.Column('source_cocktail_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key(
+            'fk_cocktails_source_cocktail_id', 'cocktails',
+            ['source_cocktail_id'], ['id'],
+        )
+        batch_op.create_index(
+            'ix_cocktails_source_cocktail_id_owner_id',
+            ['source_cocktail_id', 'owner_id'],
+            unique=False,
+        )
+    op.add_column(
+        'cocktails_ingredients',
+        sa.Column('is_removed', sa.Boolean(), nullable=False, server_default='0'),
+    )
+
+
+def downgrade():
+    op.drop_column('cocktails_ingredients', 'is_removed')
+    with op.batch_alter_table('cocktails') as batch_op:
+        batch_op.drop_index('ix_cocktails_source_cocktail_id_owner_id')
+        batch_op.drop_constraint('fk_cocktails_source_cocktail_id', type_='foreignkey')
+        batch_op.drop_column('source_cocktail_id')
@@ -0,0 +1,59 @@
+"""maintenance sweep indexes and appeal archive
+
+Revision ID: d7b2f6a0c493
+Revises: c5a9e3d71f08
+Create Date: 2026-10-19 00:00:00.000000
+
+Indexes for the beat maintenance jobs: expired bans (``user.ban_until``),
+stale unverified accounts (``user.is_email_verified, created_at``) and
+decided appeals (``user_appeal.status, admin_response_date``), plus the
+``user_appeal_archive`` table decided appeals are moved into.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b2f6a0c493'
+down_revision = 'c5a9e3d71f08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_user_ban_until', 'user', ['ban_until'], unique=False)
+    op.create_index(
+        'ix_user_is_email_verified_created_at',
+        'user',
+        ['is_email_verified', 'created_at'],
+        unique=False,
+    )
+    op.create_index(
+        'ix_user_appeal_status_admin_response_date',
+        'user_appeal',
+        ['status', 'admin_response_date'],
+        unique=False,
+    )
+    op.create_table(
+        'user_appeal_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('appeal_text', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('status', sa.String(length=50), nullable=False),
+        sa.Column('admin_response', sa.Text(), nullable=True),
+        sa.Column('admin_response_date', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        op.f('ix_user_appeal_archive_user_id'), 'user_appeal_archive', ['user_id'], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_appeal_archive_user_id'), table_name='user_appeal_archive')
+    op.drop_table('user_appeal_archive')
+    op.drop_index('ix_user_appeal_status_admin_response_date', table_name='user_appeal')
+    op.drop_index('ix_user_is_email_verified_created_at', table_name='user')
+    op.drop_index('ix_user_ban_until', table_name='user')
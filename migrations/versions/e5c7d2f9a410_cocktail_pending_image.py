@@ -0,0 +1,31 @@
+"""pending image state for background upload processing
+
+Revision ID: e5c7d2f9a410
+Revises: d4a9b6c1e802
+Create Date: 2026-10-19 00:00:00.000000
+
+Uploaded images are now re-encoded by a Celery task instead of inside the
+request.  ``cocktails.pending_image`` holds the staged upload's name until
+the worker has swapped the clean file into ``image_url``.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c7d2f9a410'
+down_revision = 'd4a9b6c1e802'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'cocktails',
+        sa.Column('pending_image', sa.String(length=64), nullable=True),
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('cocktails') as batch_op:
+        batch_op.drop_column('pending_image')
@@ -0,0 +1,32 @@
+"""reason a staged image upload was not used
+
+Revision ID: e8a3b5d2c916
+Revises: d7b2f6a0c493
+Create Date: 2026-10-19 00:00:00.000000
+
+When the image worker cannot use a staged upload (it does not decode, or
+storing it keeps failing) it clears ``pending_image`` and stores the reason
+in ``cocktails.image_rejected`` so the owner is told instead of silently
+keeping the previous image.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a3b5d2c916'
+down_revision = 'd7b2f6a0c493'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'cocktails',
+        sa.Column('image_rejected', sa.String(length=255), nullable=True),
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('cocktails') as batch_op:
+        batch_op.drop_column('image_rejected')
@@ -0,0 +1,33 @@
+"""responsive image variant manifest
+
+Revision ID: f1b3e8c6d527
+Revises: e5c7d2f9a410
+Create Date: 2026-10-19 00:00:00.000000
+
+The image worker now writes each upload at several widths in WebP (and
+AVIF where supported) plus a JPEG fallback.  ``cocktails.image_variants``
+records which widths and formats exist so ``srcset`` attributes can be
+built without touching the disk.  Existing uploads keep NULL and are
+served at full size as before.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b3e8c6d527'
+down_revision = 'e5c7d2f9a410'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'cocktails',
+        sa.Column('image_variants', sa.JSON(), nullable=True),
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('cocktails') as batch_op:
+        batch_op.drop_column('image_variants')
@@ -1,10 +1,9 @@
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta, timezone
 import logging
 
-# Initialize Bcrypt for hashing passwords
-bcrypt = Bcrypt()
+# Password hashing runs on a bounded pool; bcrypt is re-exported from there.
+from services.passwords import bcrypt, hash_password, check_password, needs_rehash  # noqa: F401
 # Initialize SQLAlchemy for database interactions
 db = SQLAlchemy()
 # Configure logging to display debug messages
@@ -18,6 +17,12 @@ def connect_db(app):
 class User(db.Model):
     """User in the system."""
     __tablename__ = "user"
+    # Back the maintenance sweeps (services/maintenance.py): expired bans by
+    # ban_until, stale unverified accounts by (is_email_verified, created_at).
+    __table_args__ = (
+        db.Index('ix_user_ban_until', 'ban_until'),
+        db.Index('ix_user_is_email_verified_created_at', 'is_email_verified', 'created_at'),
+    )
     
     id = db.Column(
         db.Integer,
@@ -83,6 +88,16 @@ class User(db.Model):
         nullable=True,
         default=None
     )
+
+    # Number of admin responses this user has not yet seen.  Maintained
+    # incrementally by the messaging routes so the inbox badge is a column
+    # read instead of a COUNT over the user's whole message history.
+    unread_response_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
     
     # Relationship to admin messages
     admin_messages = db.relationship('AdminMessage', foreign_keys='AdminMessage.user_id', backref='user', cascade="all, delete-orphan")
@@ -95,7 +110,7 @@ class User(db.Model):
         """Sign up user. Hashes password and adds user to system."""
         try:
             # Hash the user's password
-            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+            hashed_pwd = hash_password(password)
             # Create a new user instance with the hashed password
             user = cls(username=username, email=email, password=hashed_pwd)
             logging.debug(f"User registered: {user}")
@@ -108,14 +123,24 @@ class User(db.Model):
     def authenticate(cls, username, password):
         """Validate that user exists & password is correct.
         
-        Return user if valid; else return False."""
+        Return user if valid; else return False.  A hash made at an older
+        bcrypt cost is replaced with one at the current cost.  Raises
+        ``PasswordHasherBusy`` if the hashing pool is saturated."""
         # Query the database for a user with the given username
         user = cls.query.filter_by(username=username).first()
 
         if user:
             # Check if the provided password matches the stored hashed password
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    try:
+                        user.password = hash_password(password)
+                        db.session.commit()
+                    except Exception as e:
+                        # The old hash still works; try again next login.
+                        db.session.rollback()
+                        logging.warning(f"Could not rehash password for user #{user.id}: {e}")
                 return user
 
         return False
@@ -197,6 +222,13 @@ class Ingredient(db.Model):
 class Cocktail(db.Model):
     """Cocktails a user selects for their account or self-made cocktails, can also enter instructions for how to make, and have the option of labeling cocktail as sweet or dry"""
     __tablename__ = "cocktails"
+    # Lets the orphan collector find unreferenced API rows without a scan.
+    # (source_cocktail_id, owner_id) answers "does this user already have a
+    # variant of this API cocktail?" with a single index probe.
+    __table_args__ = (
+        db.Index('ix_cocktails_is_api_cocktail_ref_count', 'is_api_cocktail', 'ref_count'),
+        db.Index('ix_cocktails_source_cocktail_id_owner_id', 'source_cocktail_id', 'owner_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -223,6 +255,32 @@ class Cocktail(db.Model):
         db.String,
         nullable=True
     )
+
+    # Resized copies written at ingest: {"width": <original px>,
+    # "widths": [...], "formats": ["webp", "jpg", ...]}.  NULL for legacy
+    # uploads and images too small to need variants.
+    image_variants = db.Column(
+        db.JSON,
+        nullable=True,
+        default=None,
+    )
+
+    # Staged upload still being decoded and re-encoded by the image worker.
+    # While set, pages show a "processing" placeholder; the worker swaps the
+    # clean file into image_url and clears this column when it finishes.
+    pending_image = db.Column(
+        db.String(64),
+        nullable=True,
+        default=None,
+    )
+
+    # Why the last staged upload was not used (unreadable, or it could not
+    # be saved), shown to the owner until they upload again.
+    image_rejected = db.Column(
+        db.String(255),
+        nullable=True,
+        default=None,
+    )
     
     is_api_cocktail = db.Column(
         db.Boolean,
@@ -250,12 +308,38 @@ class Cocktail(db.Model):
         default=None,
     )
 
+    # Copy-on-write personal variants: when a user edits a shared API
+    # cocktail, the variant row points at the shared row here and stores only
+    # the fields the user actually changed (NULL means "inherit from source").
+    # Ingredient changes live on the variant as Cocktails_Ingredients deltas.
+    source_cocktail_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cocktails.id'),
+        nullable=True,
+        default=None,
+    )
+
+    # Number of Cocktails_Users rows pointing at this cocktail, plus the
+    # personal variants that use it as their source.  Kept in step
+    # by link_user_to_cocktail / unlink_user_from_cocktail in the same
+    # transaction as the join-row change, so deciding whether a shared API
+    # row is still needed never requires a COUNT.  Unreferenced API rows are
+    # reclaimed later by the background orphan collector.
+    ref_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     # Define the relationship between Cocktail and Cocktails_Users
     # Issue #10: cascade="all, delete-orphan" removes join-table rows when a Cocktail is deleted.
     ct_users2 = db.relationship('Cocktails_Users', backref='cocktails', cascade="all, delete-orphan")
     # Define the relationship between Cocktail and Cocktails_Ingredients
     # Issue #10: cascade="all, delete-orphan" removes ingredient associations when a Cocktail is deleted.
     ingredients_relation = db.relationship('Cocktails_Ingredients', backref='cocktail', cascade="all, delete-orphan")
+    # Shared API row a personal variant was derived from (None otherwise).
+    source = db.relationship('Cocktail', remote_side=[id], foreign_keys=[source_cocktail_id])
 
 class Cocktails_Ingredients(db.Model):
     """Binds cocktails table and ingredients table together and allows user to select quantity"""
@@ -281,6 +365,15 @@ class Cocktails_Ingredients(db.Model):
         db.Text,
         nullable=False,
     )
+
+    # Only meaningful on personal variants: marks a source ingredient the
+    # user removed (a tombstone), so it is hidden when the variant is resolved.
+    is_removed = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='0',
+    )
     
     # Define the relationship between Cocktails_Ingredients and Ingredient
     ingredient = db.relationship('Ingredient', backref='cocktails_ingredients')
@@ -319,6 +412,13 @@ class UserFavoriteIngredients(db.Model):
 class AdminMessage(db.Model):
     """Messages between admin and users for warnings, suggestions, and incident reports"""
     __tablename__ = "admin_message"
+    # Composite indexes back the keyset-paginated inboxes: the admin inbox
+    # walks (created_at, id) across all users, the user thread walks the same
+    # key within a single user_id.
+    __table_args__ = (
+        db.Index('ix_admin_message_created_at_id', 'created_at', 'id'),
+        db.Index('ix_admin_message_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
     
     id = db.Column(
         db.Integer,
@@ -371,12 +471,293 @@ class AdminMessage(db.Model):
         nullable=True,
         default=None
     )
+
+    # False while the user has an admin response they have not yet seen.
+    response_is_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+        server_default='1',
+    )
     
     def __repr__(self):
         return f"<AdminMessage #{self.id}: from {self.user_id} - {self.subject}>"
+
+
+class InboxCounter(db.Model):
+    """Named counters for O(1) inbox badges (e.g. ``admin_unread``).
+
+    Values are adjusted with atomic ``UPDATE ... SET value = value + n``
+    statements in the same transaction as the change they track, so they
+    never need to be recomputed by scanning ``admin_message``.
+    """
+    __tablename__ = "inbox_counter"
+
+    name = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    value = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    def __repr__(self):
+        return f"<InboxCounter {self.name}={self.value}>"
+
+
+class UploadBlob(db.Model):
+    """One stored upload, named by the SHA-256 of its re-encoded bytes.
+
+    Identical images uploaded by different users (or re-uploaded by the
+    same user) share a single file.  ``ref_count`` is the number of
+    cocktails whose ``image_url`` names this blob; the files are removed
+    only when it drops to zero.
+    """
+    __tablename__ = "upload_blob"
+
+    filename = db.Column(
+        db.String(80),
+        primary_key=True,
+    )
+
+    ref_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    size = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Responsive-variant manifest, generated once for the blob and reused
+    # by every later upload of the same bytes.
+    variants = db.Column(
+        db.JSON,
+        nullable=True,
+        default=None,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+
+    def __repr__(self):
+        return f"<UploadBlob {self.filename} refs={self.ref_count}>"
+
+
+class EmailOutbox(db.Model):
+    """One outbound email, written in the same transaction as its trigger.
+
+    Routes never talk to the broker or SMTP server: they add a row here and
+    commit it together with the change the email announces (a ban, a new
+    account …).  The ``email_service.relay_outbox`` beat task drains due
+    ``pending`` rows in batches and marks each one ``sent``, or schedules a
+    retry with backoff until it is given up on as ``failed``.
+    """
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        db.Index("ix_email_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    subject = db.Column(
+        db.String(255),
+        nullable=False,
+    )
+
+    recipients = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    body = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    html = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    # pending → sent, or pending → failed once the retries are exhausted.
+    status = db.Column(
+        db.String(16),
+        nullable=False,
+        default="pending",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    next_attempt_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+
+    sent_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    def __repr__(self):
+        return f"<EmailOutbox #{self.id} {self.status} {self.subject!r}>"
+
+
+class Broadcast(db.Model):
+    """An admin announcement emailed to every user in an audience.
+
+    Creating one inserts a :class:`BroadcastDelivery` row per recipient
+    with a single ``INSERT ... SELECT``; the emails are then sent by
+    chunked background tasks in ``services.broadcast_service``, which add
+    to ``sent_count`` / ``failed_count`` as they go.
+    """
+    __tablename__ = "broadcast"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    # The admin who sent it; set to NULL if that user is deleted.
+    admin_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', ondelete='SET NULL'),
+        nullable=True,
+    )
+
+    subject = db.Column(
+        db.String(255),
+        nullable=False,
+    )
+
+    body = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Key into broadcast_service.AUDIENCES: all, verified, unverified, banned.
+    audience = db.Column(
+        db.String(20),
+        nullable=False,
+    )
+
+    # queued → sending → done
+    status = db.Column(
+        db.String(16),
+        nullable=False,
+        default="queued",
+    )
+
+    total_recipients = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    sent_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    failed_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+
+    completed_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    def __repr__(self):
+        return f"<Broadcast #{self.id} {self.status} {self.subject!r}>"
+
+
+class BroadcastDelivery(db.Model):
+    """Delivery state of one broadcast to one user.
+
+    The ``(broadcast_id, user_id)`` primary key doubles as the index the
+    fan-out tasks walk: each chunk is a ``user_id`` range of one broadcast.
+    """
+    __tablename__ = "broadcast_delivery"
+
+    broadcast_id = db.Column(
+        db.Integer,
+        db.ForeignKey('broadcast.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # pending → sent, or pending → failed
+    status = db.Column(
+        db.String(16),
+        nullable=False,
+        default="pending",
+    )
+
+    error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    sent_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    def __repr__(self):
+        return f"<BroadcastDelivery {self.broadcast_id}:{self.user_id} {self.status}>"
+
+
 class UserAppeal(db.Model):
     """Appeals submitted by banned users requesting removal of their ban"""
     __tablename__ = "user_appeal"
+    # Lets the archive job find appeals decided before a cutoff.
+    __table_args__ = (
+        db.Index('ix_user_appeal_status_admin_response_date', 'status', 'admin_response_date'),
+    )
     
     id = db.Column(
         db.Integer,
@@ -404,7 +785,7 @@ class UserAppeal(db.Model):
     status = db.Column(
         db.String(50),
         nullable=False,
-        default='pending'  # pending, approved, rejected
+        default='pending'  # pending, approved, rejected, expired
     )
     
     admin_response = db.Column(
@@ -423,6 +804,60 @@ class UserAppeal(db.Model):
         return f"<UserAppeal #{self.id}: from {self.user_id} - {self.status}>"
 
 
+class UserAppealArchive(db.Model):
+    """Decided appeals moved out of ``user_appeal`` by the archive job.
+
+    Keeps the original id and fields.  ``user_id`` is deliberately not a
+    foreign key, so the history survives the user's deletion.
+    """
+    __tablename__ = "user_appeal_archive"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+        index=True,
+    )
+
+    appeal_text = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    status = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    admin_response = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    admin_response_date = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    archived_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<UserAppealArchive #{self.id}: from {self.user_id} - {self.status}>"
+
+
 class AdminAuditLog(db.Model):
     """Issue #9: Central audit trail for all admin actions.
 
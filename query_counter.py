@@ -0,0 +1,120 @@
+"""SQL statement counting and per-route query budgets.
+
+Views declare how many statements a request may run with
+``@query_budget(n)`` (decorators.py).  The count covers the whole request,
+from the first ``before_request`` hook (ban enforcement, the user lookup)
+through template rendering.  A request that runs more statements than its
+view's budget is handled according to ``QUERY_BUDGET_MODE``:
+
+* ``'raise'`` — :class:`QueryBudgetExceeded` is raised, failing the test
+  that made the request.  This is the default when ``TESTING`` is on.
+* ``'log'`` — a warning lists the statements.  The default under ``DEBUG``.
+* ``'off'`` — nothing is counted.  The default otherwise, i.e. production.
+
+A lazy load inside a loop shows up as a statement count that grows with
+the data, so budgets checked against a seeded dataset in the test suite
+catch N+1 regressions before they ship.  :func:`count_queries` counts
+the statements of any block of code, inside a request or not.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """A request ran more SQL statements than its view's ``query_budget``."""
+
+
+class QueryCount:
+    """Statements run while this counter was active."""
+
+    __slots__ = ('statements',)
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+# Counters currently collecting; nested blocks each get their own.
+_active: ContextVar[tuple] = ContextVar('query_counters', default=())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for counter in _active.get():
+        counter.statements.append(statement)
+
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def _install_engine_hook() -> None:
+    global _listening
+    with _listening_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            _listening = True
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run inside the ``with`` block."""
+    _install_engine_hook()
+    counter = QueryCount()
+    token = _active.set(_active.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _active.reset(token)
+
+
+def budget_mode(app) -> str:
+    mode = app.config.get('QUERY_BUDGET_MODE')
+    if mode:
+        return mode
+    if app.testing:
+        return 'raise'
+    return 'log' if app.debug else 'off'
+
+
+def init_app(app) -> None:
+    """Count each request's statements; register early so hooks are included."""
+    _install_engine_hook()
+
+    @app.before_request
+    def _start_query_count():
+        if budget_mode(app) == 'off':
+            return
+        counter = QueryCount()
+        g._query_count = counter
+        g._query_count_token = _active.set(_active.get() + (counter,))
+
+    @app.after_request
+    def _check_query_budget(response):
+        counter = g.pop('_query_count', None)
+        if counter is None:
+            return response
+        view = app.view_functions.get(request.endpoint)
+        limit = getattr(view, 'query_budget', None)
+        if limit is None or counter.count <= limit:
+            return response
+        message = (f"{request.method} {request.path} ({request.endpoint}) ran "
+                   f"{counter.count} SQL statements; its budget is {limit}")
+        if budget_mode(app) == 'raise':
+            raise QueryBudgetExceeded(message + ":\n  " + "\n  ".join(counter.statements))
+        logging.warning("%s", message)
+        return response
+
+    @app.teardown_request
+    def _stop_query_count(exc):
+        token = g.pop('_query_count_token', None)
+        if token is not None:
+            _active.reset(token)
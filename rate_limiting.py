@@ -0,0 +1,49 @@
+"""In-process flood pre-check that runs ahead of Flask-Limiter.
+
+Flask-Limiter keeps its moving-window counters in Redis so limits hold
+across every worker and node.  That costs a Redis round trip per limited
+request, which is wasted work when a single client is plainly flooding
+one process.  :class:`LocalFloodGuard` keeps a small per-process moving
+window per client address and answers ``429`` straight away once that
+client exceeds ``RATELIMIT_LOCAL_PRECHECK`` in this process alone.
+
+The ceiling is deliberately far above any legitimate browsing rate and
+only ever *adds* a rejection: anything it lets through is still checked
+against the shared limits in Redis.
+"""
+from flask import abort, current_app, request
+from flask_limiter.util import get_remote_address
+from limits import parse
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
+
+
+class LocalFloodGuard:
+    """Per-process moving-window ceiling checked before the shared limits."""
+
+    # Static assets arrive in bursts on every page load and are never
+    # rate limited by the shared limiter either.
+    EXEMPT_ENDPOINTS = frozenset({'static'})
+
+    def __init__(self):
+        self._window = MovingWindowRateLimiter(MemoryStorage())
+        self._limit = None
+
+    def init_app(self, app, limiter) -> None:
+        """Register the guard; call *before* ``limiter.init_app(app)``.
+
+        Flask runs ``before_request`` hooks in registration order, so
+        registering first means a flood is rejected before Flask-Limiter
+        talks to Redis.
+        """
+        self._limit = parse(app.config['RATELIMIT_LOCAL_PRECHECK'])
+        self._limiter = limiter
+        app.before_request(self._check)
+
+    def _check(self):
+        if not current_app.config.get('RATELIMIT_ENABLED', True) or not self._limiter.enabled:
+            return
+        if request.endpoint in self.EXEMPT_ENDPOINTS:
+            return
+        if not self._window.hit(self._limit, 'local-precheck', get_remote_address()):
+            abort(429)
@@ -0,0 +1,323 @@
+"""One Redis connection pool per process, shared by every Redis consumer.
+
+The cache, the rate limiter and the session store used to open their own
+connections from ``REDIS_URL``, so each gunicorn worker held three pools
+and no overall bound.  :class:`RedisPool` builds a single
+``BlockingConnectionPool`` instead: at most ``REDIS_MAX_CONNECTIONS`` per
+process, and a caller waits up to ``REDIS_POOL_TIMEOUT`` seconds for a free
+connection rather than opening another.  Every connection uses TCP
+keepalive and is health-checked with ``PING`` after
+``REDIS_HEALTH_CHECK_INTERVAL`` idle seconds, so connections dropped by a
+load balancer are replaced rather than failing a request.
+
+Celery's broker and result backend are driven by kombu and the Celery
+backend, which keep their own pools; ``_celery_init`` gives them the same
+size cap, keepalive and health-check settings.
+
+When Redis goes away the pool trips a :class:`CircuitBreaker` after
+``REDIS_BREAKER_THRESHOLD`` failed connects in a row.  While it is open,
+checkouts fail at once instead of each waiting out a connect timeout, so
+every consumer falls back straight away: the cache to
+:class:`FailoverRedisCache`'s per-process store, the limiter to its
+in-memory storage, sessions to signed cookies and Celery publishing to
+``task_fallback``.  After a jittered, exponentially growing delay (up to
+``REDIS_RECONNECT_MAX`` seconds) one caller is let through to reconnect;
+the first successful connect closes the breaker for everyone.
+"""
+import logging
+import random
+import threading
+import time
+
+import redis
+from flask import current_app, has_app_context
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.rediscache import RedisCache
+from flask_caching.backends.simplecache import SimpleCache
+
+import metrics
+import request_timing
+
+
+class CircuitBreaker:
+    """Tracks whether Redis is reachable and paces reconnect attempts.
+
+    ``closed`` lets every call through.  ``threshold`` consecutive failures
+    make it ``open``: calls are refused until a reconnect delay drawn from
+    [delay / 2, delay] has passed, where the delay doubles with each failed
+    attempt from *base_delay* up to *max_delay*.  The breaker is then
+    ``half-open`` and lends one caller a *probe_lease*-second slot to try;
+    its success closes the breaker and its failure re-opens it.
+    """
+
+    def __init__(self, threshold=3, base_delay=1.0, max_delay=30.0, probe_lease=5.0):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.probe_lease = probe_lease
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.attempt = 0
+        self.retry_at = 0.0
+        self._probe_until = 0.0
+        # Counters since start-up.
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go to Redis now."""
+        if self.state == 'closed':
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'closed':
+                return True
+            if now < self.retry_at or now < self._probe_until:
+                self.rejected += 1
+                return False
+            self.state = 'half-open'
+            self._probe_until = now + self.probe_lease
+            return True
+
+    def record_success(self) -> None:
+        if self.state == 'closed' and not self.failures:
+            return
+        with self._lock:
+            if self.state != 'closed':
+                logging.warning("Redis reachable again after %d reconnect attempt(s)",
+                                self.attempt)
+            self.state = 'closed'
+            self.failures = self.attempt = 0
+            self._probe_until = 0.0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == 'closed' and self.failures < self.threshold:
+                return
+            if self.state == 'closed':
+                self.trips += 1
+            self.attempt += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.attempt - 1))
+            # Jitter spreads the reconnects of many processes apart.
+            delay = random.uniform(delay / 2, delay)
+            self.state = 'open'
+            self.retry_at = time.monotonic() + delay
+            self._probe_until = 0.0
+            logging.warning("Redis unavailable; next reconnect attempt in %.1fs", delay)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'reconnect_in': max(0.0, self.retry_at - time.monotonic())
+                if self.state == 'open' else 0.0,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+
+def _guarded(connection_class, breaker):
+    """*connection_class* reporting every failed connect to *breaker*."""
+
+    class GuardedConnection(connection_class):
+        def connect(self):
+            if self._sock is not None:
+                return
+            try:
+                super().connect()
+            except (redis.ConnectionError, redis.TimeoutError):
+                breaker.record_failure()
+                raise
+
+    GuardedConnection.__name__ = f'Guarded{connection_class.__name__}'
+    return GuardedConnection
+
+
+class _MeteredPool(redis.BlockingConnectionPool):
+    """``BlockingConnectionPool`` that counts checkouts, wait time and errors."""
+
+    def __init__(self, *args, breaker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker or CircuitBreaker()
+        self.connection_class = _guarded(self.connection_class, self.breaker)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.errors = 0
+        self.wait_seconds_total = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        if not self.breaker.allow():
+            with self._stats_lock:
+                self.errors += 1
+            raise redis.ConnectionError("Redis marked unavailable; waiting to reconnect")
+        started = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.RedisError:
+            # Includes "No connection available." once the pool is exhausted.
+            with self._stats_lock:
+                self.errors += 1
+            raise
+        self.breaker.record_success()
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds_total += time.perf_counter() - started
+        return connection
+
+
+class RedisPool:
+    """Flask extension owning the process-wide Redis connection pool."""
+
+    def init_app(self, app) -> None:
+        app.extensions['redis_pool'] = _MeteredPool.from_url(
+            app.config['REDIS_URL'],
+            max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+            timeout=app.config['REDIS_POOL_TIMEOUT'],
+            socket_connect_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+            socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+            socket_keepalive=True,
+            health_check_interval=app.config['REDIS_HEALTH_CHECK_INTERVAL'],
+            breaker=CircuitBreaker(
+                threshold=app.config['REDIS_BREAKER_THRESHOLD'],
+                max_delay=app.config['REDIS_RECONNECT_MAX'],
+            ),
+        )
+
+    def pool(self, app=None) -> _MeteredPool:
+        return (app or current_app).extensions['redis_pool']
+
+    def client(self, app=None) -> redis.Redis:
+        """A client borrowing connections from the shared pool."""
+        return redis.Redis(connection_pool=self.pool(app))
+
+    def breaker(self, app=None) -> CircuitBreaker | None:
+        """The pool's breaker, or ``None`` outside an app without *app*."""
+        if app is None and not has_app_context():
+            return None
+        pool = (app or current_app).extensions.get('redis_pool')
+        return pool.breaker if pool is not None else None
+
+    def available(self, app=None) -> bool:
+        """False while the breaker is refusing calls to Redis."""
+        breaker = self.breaker(app)
+        return breaker is None or breaker.state == 'closed'
+
+    def stats(self, app=None) -> dict:
+        """Pool size, usage counters and breaker state for this process."""
+        pool = self.pool(app)
+        with pool._lock:
+            created = len(pool._connections)
+            idle = sum(1 for connection in pool.pool.queue if connection is not None)
+        with pool._stats_lock:
+            return {
+                'max_connections': pool.max_connections,
+                'created': created,
+                'in_use': created - idle,
+                'idle': idle,
+                'checkouts': pool.checkouts,
+                'errors': pool.errors,
+                'wait_seconds_total': pool.wait_seconds_total,
+                'breaker': pool.breaker.snapshot(),
+            }
+
+
+class FailoverRedisCache(BaseCache):
+    """Flask-Caching backend: ``RedisCache``, or a per-process cache while Redis is down.
+
+    Any Redis error (including an open breaker) sends the call to a
+    ``SimpleCache`` of at most ``CACHE_LOCAL_MAX_ITEMS`` entries instead,
+    so ``cache.get`` and ``@cache.cached`` keep working, per process.  The
+    local entries are dropped on the first call Redis answers again, so no
+    value written during the outage outlives it.
+
+    Keys starting with one of *shared_only* never fall back: the error is
+    raised instead.  They hold values another process must be able to
+    invalidate, such as the user-context flags a ban changes.
+    """
+
+    def __init__(self, redis_cache, local_cache, default_timeout=300, shared_only=()):
+        super().__init__(default_timeout=default_timeout)
+        self.redis = redis_cache
+        self.local = local_cache
+        self.shared_only = tuple(shared_only)
+        self._degraded = False
+        self.fallback_calls = 0
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        return cls(
+            RedisCache.factory(app, config, list(args), dict(kwargs)),
+            SimpleCache(threshold=config['CACHE_LOCAL_MAX_ITEMS'], **kwargs),
+            shared_only=config.get('CACHE_SHARED_ONLY_PREFIXES', ()),
+            **kwargs,
+        )
+
+    @property
+    def degraded(self) -> bool:
+        return self._degraded
+
+    def _call(self, method, keys, *args, **kwargs):
+        with request_timing.timed('cache'):
+            try:
+                result = getattr(self.redis, method)(*args, **kwargs)
+            except redis.RedisError as exc:
+                if self.shared_only and any(str(key).startswith(self.shared_only) for key in keys):
+                    raise
+                if not self._degraded:
+                    logging.warning("Cache using per-process fallback: %s", exc)
+                    self._degraded = True
+                self.fallback_calls += 1
+                return getattr(self.local, method)(*args, **kwargs)
+            if self._degraded:
+                self._degraded = False
+                self.local.clear()
+            return result
+
+    def get(self, key):
+        value = self._call('get', (key,), key)
+        request_timing.record_cache_lookup(int(value is not None), int(value is None))
+        metrics.record_cache_lookup(key, value is not None)
+        return value
+
+    def get_many(self, *keys):
+        values = self._call('get_many', keys, *keys)
+        hits = sum(value is not None for value in values)
+        request_timing.record_cache_lookup(hits, len(keys) - hits)
+        return values
+
+    def get_dict(self, *keys):
+        values = self._call('get_dict', keys, *keys)
+        hits = sum(value is not None for value in values.values())
+        request_timing.record_cache_lookup(hits, len(keys) - hits)
+        return values
+
+    def set(self, key, value, timeout=None):
+        return self._call('set', (key,), key, value, timeout=timeout)
+
+    def set_many(self, mapping, timeout=None):
+        return self._call('set_many', tuple(mapping), mapping, timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        return self._call('add', (key,), key, value, timeout=timeout)
+
+    def has(self, key):
+        return self._call('has', (key,), key)
+
+    def delete(self, key):
+        return self._call('delete', (key,), key)
+
+    def delete_many(self, *keys):
+        return self._call('delete_many', keys, *keys)
+
+    def inc(self, key, delta=1):
+        return self._call('inc', (key,), key, delta=delta)
+
+    def dec(self, key, delta=1):
+        return self._call('dec', (key,), key, delta=delta)
+
+    def clear(self):
+        self.local.clear()
+        return self._call('clear', ())
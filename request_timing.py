@@ -0,0 +1,183 @@
+"""Per-request timings, reported as a ``Server-Timing`` header and a log line.
+
+A sampled request (``SERVER_TIMING_SAMPLE_RATE``, 0 to 1) collects:
+
+* ``db`` — SQL statements run and their total time (SQLAlchemy cursor events),
+* ``cache`` — cache hits, misses and time spent in the cache backend,
+* ``cocktaildb`` — calls to TheCocktailDB and their total time,
+* ``tmpl`` — templates rendered and their total render time,
+* ``total`` — the whole request, from the first ``before_request`` hook.
+
+The figures are sent back as ``Server-Timing`` (shown in the browser's
+network panel) and logged as one JSON line on the ``request_timing``
+logger.  Calls that overlap, such as the concurrent CocktailDB fetches
+behind ``/cocktails``, are summed.
+
+Requests that are not sampled carry no timings object, so every hook
+costs one context lookup and returns.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger('request_timing')
+
+# Header entries, in order: metric name -> Server-Timing description.
+METRICS = ('db', 'cache', 'cocktaildb', 'tmpl')
+
+
+class RequestTimings:
+    """Counters and durations (seconds) collected during one request."""
+
+    __slots__ = ('started', 'counts', 'seconds', 'hits', 'misses', '_starts')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts = dict.fromkeys(METRICS, 0)
+        self.seconds = dict.fromkeys(METRICS, 0.0)
+        self.hits = 0
+        self.misses = 0
+        self._starts = []
+
+    def add(self, metric, seconds, count=1):
+        self.counts[metric] += count
+        self.seconds[metric] += seconds
+
+    def header(self, total) -> str:
+        descriptions = {
+            'db': f"{self.counts['db']} queries",
+            'cache': f"{self.hits} hits, {self.misses} misses",
+            'cocktaildb': f"{self.counts['cocktaildb']} calls",
+            'tmpl': f"{self.counts['tmpl']} templates",
+        }
+        parts = [
+            f'{metric};dur={self.seconds[metric] * 1000:.1f};desc="{descriptions[metric]}"'
+            for metric in METRICS if self.counts[metric]
+        ]
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+    def as_dict(self, total) -> dict:
+        return {
+            'db_queries': self.counts['db'],
+            'db_ms': round(self.seconds['db'] * 1000, 2),
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_ms': round(self.seconds['cache'] * 1000, 2),
+            'cocktaildb_calls': self.counts['cocktaildb'],
+            'cocktaildb_ms': round(self.seconds['cocktaildb'] * 1000, 2),
+            'templates': self.counts['tmpl'],
+            'template_ms': round(self.seconds['tmpl'] * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+        }
+
+
+def current() -> RequestTimings | None:
+    """Timings of the current request, or ``None`` when it is not sampled."""
+    if not has_request_context():
+        return None
+    return g.get('_request_timings')
+
+
+@contextmanager
+def timed(metric):
+    """Add the time spent in the ``with`` block to *metric*."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(metric, time.perf_counter() - started)
+
+
+def record_cache_lookup(hits, misses) -> None:
+    timings = current()
+    if timings is not None:
+        timings.hits += hits
+        timings.misses += misses
+
+
+# ---------------------------------------------------------------------------
+# Hooks
+# ---------------------------------------------------------------------------
+
+# The start time rides on the statement's own execution context, so a
+# statement that raises (and never reaches the "after" hook) leaves nothing
+# behind on the pooled connection.
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current() is not None:
+        context._request_timing_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current()
+    started = getattr(context, '_request_timing_start', None)
+    if timings is not None and started is not None:
+        timings.add('db', time.perf_counter() - started)
+
+
+def _before_render(sender, template, context, **extra):
+    timings = current()
+    if timings is not None:
+        timings._starts.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    timings = current()
+    if timings is not None and timings._starts:
+        timings.add('tmpl', time.perf_counter() - timings._starts.pop())
+
+
+_engine_hooks_installed = False
+_engine_hooks_lock = threading.Lock()
+
+
+def _install_engine_hooks() -> None:
+    global _engine_hooks_installed
+    with _engine_hooks_lock:
+        if not _engine_hooks_installed:
+            # On the Engine class, so every engine (and test database) is covered.
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            _engine_hooks_installed = True
+
+
+def init_app(app) -> None:
+    """Register the hooks; call before other extensions so ``total`` spans them."""
+    _install_engine_hooks()
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def _start_request_timing():
+        rate = app.config['SERVER_TIMING_SAMPLE_RATE']
+        if rate > 0 and (rate >= 1 or random.random() < rate):
+            g._request_timings = RequestTimings()
+
+    @app.after_request
+    def _report_request_timing(response):
+        timings = g.pop('_request_timings', None)
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings.started
+        response.headers['Server-Timing'] = timings.header(total)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            **timings.as_dict(total),
+        }))
+        return response
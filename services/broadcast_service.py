@@ -0,0 +1,251 @@
+"""Admin broadcasts: one announcement emailed to a whole audience.
+
+:func:`create_broadcast` stores the broadcast and one
+:class:`~models.BroadcastDelivery` row per recipient with a single
+``INSERT ... SELECT``, so even a 100k-user audience costs the request one
+statement and no Python loop.  Nothing is sent in the request: the
+``dispatch_broadcasts`` beat task picks queued broadcasts up, splits each
+into ``user_id`` ranges of :data:`CHUNK_SIZE` pending deliveries and
+enqueues one :func:`send_broadcast_chunk` task per range.  Chunks send over
+one reused SMTP session, add to the broadcast's counters as they finish,
+and the last one to finish marks the broadcast ``done``.
+"""
+import logging
+from datetime import datetime, timezone
+
+from flask_mail import Message
+from sqlalchemy import exists, insert, literal, or_, select, true, update
+
+from extensions import celery
+from models import db, Broadcast, BroadcastDelivery, User
+from services.email_service import SmtpSession, is_connection_error, is_permanent_failure
+
+
+# Deliveries per fan-out task.
+CHUNK_SIZE = 1000
+
+# Deliveries claimed, sent and committed together inside a chunk; a worker
+# that dies mid-chunk re-sends at most this many emails.
+COMMIT_EVERY = 50
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _audience_filter(audience: str, now: datetime):
+    if audience == 'all':
+        return true()
+    if audience == 'verified':
+        return User.is_email_verified == True
+    if audience == 'unverified':
+        return User.is_email_verified == False
+    if audience == 'banned':
+        return or_(User.is_permanently_banned == True, User.ban_until > now)
+    raise ValueError(f"Unknown broadcast audience {audience!r}")
+
+
+def create_broadcast(admin_id, subject, body, audience) -> Broadcast:
+    """Store a broadcast and its per-user delivery rows; the caller commits.
+
+    Recipients are resolved now: users who register later are not included.
+    """
+    criteria = _audience_filter(audience, _utcnow())
+    broadcast = Broadcast(admin_id=admin_id, subject=subject, body=body, audience=audience)
+    db.session.add(broadcast)
+    db.session.flush()
+    result = db.session.execute(
+        insert(BroadcastDelivery).from_select(
+            ['broadcast_id', 'user_id', 'status'],
+            select(literal(broadcast.id), User.id, literal('pending')).where(criteria),
+        )
+    )
+    broadcast.total_recipients = result.rowcount
+    return broadcast
+
+
+def broadcast_progress(broadcast: Broadcast) -> dict:
+    """JSON-ready progress of *broadcast*, read from its counters."""
+    total = broadcast.total_recipients
+    finished = broadcast.sent_count + broadcast.failed_count
+    return {
+        'id': broadcast.id,
+        'status': broadcast.status,
+        'total': total,
+        'sent': broadcast.sent_count,
+        'failed': broadcast.failed_count,
+        'percent': 100 if not total else round(100 * finished / total),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Celery tasks — run in a worker process under the Flask app context
+# ---------------------------------------------------------------------------
+
+def _chunk_ranges(broadcast_id: int, size: int):
+    """Yield ``(after_user_id, upto_user_id)`` ranges of up to *size* pending deliveries.
+
+    Each boundary is one keyset probe on the primary key; the last range
+    is open-ended (``upto_user_id`` is ``None``).
+    """
+    pending = (
+        select(BroadcastDelivery.user_id)
+        .where(BroadcastDelivery.broadcast_id == broadcast_id,
+               BroadcastDelivery.status == 'pending')
+        .order_by(BroadcastDelivery.user_id)
+    )
+    after = None
+    while True:
+        query = pending if after is None else pending.where(BroadcastDelivery.user_id > after)
+        upto = db.session.scalar(query.offset(size - 1).limit(1))
+        if upto is None:
+            if db.session.scalar(query.limit(1)) is not None:
+                yield after, None
+            return
+        yield after, upto
+        after = upto
+
+
+@celery.task(name='broadcast_service.dispatch_broadcasts', ignore_result=True)
+def dispatch_broadcasts() -> int:
+    """Fan queued broadcasts out into chunk tasks; return how many were started."""
+    started = 0
+    while True:
+        broadcast = (
+            Broadcast.query
+            .filter_by(status='queued')
+            .order_by(Broadcast.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if broadcast is None:
+            return started
+        ranges = list(_chunk_ranges(broadcast.id, CHUNK_SIZE))
+        if not ranges:
+            broadcast.status = 'done'
+            broadcast.completed_at = _utcnow()
+            db.session.commit()
+            continue
+        broadcast.status = 'sending'
+        broadcast_id = broadcast.id
+        db.session.commit()
+        try:
+            for after, upto in ranges:
+                send_broadcast_chunk.apply_async((broadcast_id, after, upto))
+        except Exception as exc:
+            # Chunks only send pending deliveries, so dispatching again
+            # later is safe even if some chunks were already enqueued.
+            logging.warning("Could not dispatch broadcast #%s: %s", broadcast_id, exc)
+            (Broadcast.query
+             .filter_by(id=broadcast_id, status='sending')
+             .update({Broadcast.status: 'queued'}, synchronize_session=False))
+            db.session.commit()
+            return started
+        started += 1
+        logging.info("Broadcast #%s dispatched in %d chunks", broadcast_id, len(ranges))
+
+
+def _finish_if_complete(broadcast_id: int) -> None:
+    # Every chunk runs this after committing its own rows, so the last one
+    # to finish always sees no pending deliveries left.
+    pending = exists().where(BroadcastDelivery.broadcast_id == broadcast_id,
+                             BroadcastDelivery.status == 'pending')
+    db.session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id, Broadcast.status == 'sending', ~pending)
+        .values(status='done', completed_at=_utcnow())
+    )
+    db.session.commit()
+
+
+# At most ten chunks (10,000 emails) a minute per worker, well inside
+# common SMTP provider limits; the transactional relay is not throttled.
+@celery.task(name='broadcast_service.send_broadcast_chunk', bind=True,
+             acks_late=True, max_retries=5, ignore_result=True, rate_limit='10/m')
+def send_broadcast_chunk(self, broadcast_id, after_user_id, upto_user_id) -> int:
+    """Email the pending deliveries in one ``user_id`` range; return how many were sent.
+
+    Deliveries are claimed :data:`COMMIT_EVERY` at a time with ``FOR UPDATE
+    SKIP LOCKED`` and marked and committed after each batch, so a concurrent
+    copy of the chunk skips rows being sent and a redelivered one resumes
+    after the last commit.  Emails sent since then (at most one batch) go
+    out again when a worker dies.  A permanent refusal fails that delivery;
+    transient errors leave it pending and retry the chunk with backoff, and
+    the last retry fails whatever is left.
+    """
+    broadcast = db.session.get(Broadcast, broadcast_id)
+    if broadcast is None:
+        return 0
+    subject, body = broadcast.subject, broadcast.body
+    query = (
+        select(BroadcastDelivery, User.email)
+        .outerjoin(User, User.id == BroadcastDelivery.user_id)
+        .where(BroadcastDelivery.broadcast_id == broadcast_id,
+               BroadcastDelivery.status == 'pending')
+        .order_by(BroadcastDelivery.user_id)
+        .limit(COMMIT_EVERY)
+        .with_for_update(skip_locked=True, of=BroadcastDelivery)
+    )
+    if upto_user_id is not None:
+        query = query.where(BroadcastDelivery.user_id <= upto_user_id)
+
+    final_attempt = self.request.retries >= self.max_retries
+    sent = failed = total_sent = 0
+    error = None
+    last_user_id = after_user_id
+    halted = False
+
+    def fail(delivery, reason):
+        nonlocal failed
+        delivery.status = 'failed'
+        delivery.error = str(reason)[:1000]
+        failed += 1
+
+    with SmtpSession() as session:
+        while not halted:
+            batch = query
+            if last_user_id is not None:
+                batch = batch.where(BroadcastDelivery.user_id > last_user_id)
+            rows = db.session.execute(batch).all()
+            for delivery, email in rows:
+                last_user_id = delivery.user_id
+                if email is None:
+                    fail(delivery, "User no longer exists")
+                    continue
+                if error is not None and is_connection_error(error):
+                    if not final_attempt:
+                        halted = True
+                        break
+                    fail(delivery, error)
+                    continue
+                try:
+                    session.send(Message(subject=subject, recipients=[email], body=body))
+                except Exception as exc:
+                    permanent = is_permanent_failure(exc)
+                    if permanent or final_attempt:
+                        fail(delivery, exc)
+                    if not permanent:
+                        error = exc
+                    continue
+                delivery.status = 'sent'
+                delivery.sent_at = _utcnow()
+                sent += 1
+
+            db.session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast_id)
+                .values(sent_count=Broadcast.sent_count + sent,
+                        failed_count=Broadcast.failed_count + failed)
+            )
+            db.session.commit()
+            total_sent += sent
+            sent = failed = 0
+            if len(rows) < COMMIT_EVERY:
+                break
+
+    if error is not None and not final_attempt:
+        logging.warning("Broadcast #%s chunk after user %s will be retried: %s",
+                        broadcast_id, after_user_id, error)
+        raise self.retry(exc=error, countdown=60 * 2 ** self.request.retries)
+    _finish_if_complete(broadcast_id)
+    return total_sent
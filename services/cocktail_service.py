@@ -2,16 +2,23 @@
 
 Extracted from app.py to keep route handlers thin and testable.
 """
+import hashlib
 import io
 import os
 import logging
+import re
 import uuid
 import warnings
 
 from PIL import Image
 from flask import current_app, url_for
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 
-from models import db, Cocktail, Cocktails_Users, Cocktails_Ingredients, Ingredient
+from extensions import celery
+from services.storage import get_staging_storage, get_upload_storage
+from services.thumb_cache import proxied_thumb_url
+from models import db, Cocktail, Cocktails_Users, Cocktails_Ingredients, Ingredient, UploadBlob
 
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
@@ -38,6 +45,38 @@ def _is_valid_image_content(file_stream) -> bool:
     return any(header.startswith(sig) for sig in _IMAGE_SIGNATURES)
 
 
+# Pillow warns above MAX_IMAGE_PIXELS and raises outright above twice that;
+# both are treated as a rejection.
+_BOMB_ERRORS = (Image.DecompressionBombWarning, Image.DecompressionBombError)
+
+
+def check_image_header(head: bytes) -> bool:
+    """Run gate 2 and the dimension check on the first bytes of an upload.
+
+    Used while the upload is still streaming in.  Returns ``True`` once the
+    header has been parsed and accepted, ``False`` while more bytes are
+    needed, and raises ``ValueError`` (with the same messages as
+    :func:`_check_upload_gates`) as soon as the file can be rejected.
+    """
+    if len(head) < len(_IMAGE_SIGNATURES[0]):
+        return False
+    if not _is_valid_image_content(io.BytesIO(head)):
+        raise ValueError(
+            "Uploaded file does not appear to be a valid image."
+        )
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            Image.open(io.BytesIO(head))
+    except _BOMB_ERRORS as exc:
+        raise ValueError(
+            "Image is too large to process safely."
+        ) from exc
+    except OSError:
+        return False  # header not complete yet
+    return True
+
+
 def allowed_file(filename: str) -> bool:
     """Return True if the filename has an allowed image extension."""
     return (
@@ -46,49 +85,69 @@ def allowed_file(filename: str) -> bool:
     )
 
 
-def save_uploaded_image(image_file) -> str | None:
-    """Validate and persist an uploaded image file.
-
-    Returns the stored filename (not the full path), or ``None`` when no file
-    was provided.  Raises ``ValueError`` for invalid or disallowed files.
-
-    Three-layer defence against malicious uploads:
+def _check_upload_gates(image_file) -> None:
+    """Run the cheap upload gates; raise ``ValueError`` on rejection.
 
-    1. **Extension allow-list** — fast first gate that rejects obviously wrong
-       file types before any further processing.
-    2. **Magic-byte check** — inspects the first bytes of the stream to catch
-       extension spoofing (e.g. a PHP shell renamed to ``evil.jpg``).
-    3. **Pillow re-encode** — opens the file, forces a full pixel decode
-       (``img.load()``), then writes a brand-new image to a clean buffer.
-       This strips *all* metadata (EXIF, ICC profiles, comments, thumbnails)
-       and destroys any polyglot payload (files that are simultaneously valid
-       images and executable scripts).  Decompression-bomb files and corrupt
-       /truncated data are also caught here before touching the filesystem.
+    Covers gates 1 and 2 of :func:`save_uploaded_image` plus a header-only
+    parse: ``Image.open`` reads just the format header and dimensions, so
+    non-images and decompression bombs are refused inside the request
+    without decoding a single pixel.
     """
-    if not image_file or not image_file.filename:
-        return None
-
     # Gate 1: allow-list based on file extension.
     if not allowed_file(image_file.filename):
         raise ValueError(
             "File type not allowed. Please upload a PNG, JPG, or JPEG image."
         )
 
+    # Already rejected by check_image_header while the body streamed in;
+    # the rest of that file was discarded rather than stored.
+    rejected = getattr(image_file.stream, 'rejected', None)
+    if rejected:
+        raise ValueError(rejected)
+
     # Gate 2: inspect actual file content to prevent extension spoofing.
     if not _is_valid_image_content(image_file.stream):
         raise ValueError(
             "Uploaded file does not appear to be a valid image."
         )
 
-    # Gate 3: Re-encode through Pillow to neutralise any embedded payload.
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            Image.open(image_file.stream)
+    except _BOMB_ERRORS as exc:
+        raise ValueError(
+            "Image is too large to process safely."
+        ) from exc
+    except OSError as exc:
+        raise ValueError(
+            "Uploaded file is not a valid or supported image."
+        ) from exc
+    finally:
+        image_file.stream.seek(0)
+
+
+def _decode_image(stream, max_dimension: int | None = None) -> Image.Image:
+    """Gate 3, first half: fully decode *stream* into a Pillow image.
+
+    With *max_dimension*, larger images are scaled down so their longest
+    side fits.  JPEGs are then decoded in draft mode: libjpeg scales by
+    1/2, 1/4 or 1/8 while decoding, so a large photo never materialises at
+    full resolution.  Raises ``ValueError`` for corrupt, truncated or
+    oversized images.
+    """
     # ``warnings.catch_warnings`` promotes DecompressionBombWarning to an
     # exception so oversized images are rejected before Pillow allocates RAM.
     try:
         with warnings.catch_warnings():
             warnings.simplefilter("error", Image.DecompressionBombWarning)
-            img = Image.open(image_file.stream)
+            img = Image.open(stream)
+            if max_dimension and max(img.size) > max_dimension:
+                scale = max_dimension / max(img.size)
+                target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+                img.draft(None, target)  # no-op for formats other than JPEG
             img.load()  # force full pixel decode — catches corrupt data
-    except Image.DecompressionBombWarning as exc:
+    except _BOMB_ERRORS as exc:
         raise ValueError(
             "Image is too large to process safely."
         ) from exc
@@ -99,7 +158,16 @@ def save_uploaded_image(image_file) -> str | None:
         raise ValueError(
             "Uploaded file is not a valid or supported image."
         ) from exc
+    if max_dimension and max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    return img
+
 
+def _encode_clean(img: Image.Image) -> tuple[bytes, str]:
+    """Gate 3, second half: write *img* to a brand-new buffer.
+
+    Returns ``(data, extension)``.
+    """
     # Re-encode to a clean buffer.  Preserve transparency with PNG; use JPEG
     # for everything else to keep file sizes reasonable.
     output_format = "PNG" if img.mode in ("RGBA", "P") else "JPEG"
@@ -108,38 +176,411 @@ def save_uploaded_image(image_file) -> str | None:
 
     clean_buffer = io.BytesIO()
     img.save(clean_buffer, format=output_format)
-    clean_buffer.seek(0)
-
-    # Build a collision-resistant filename from a UUID only.  The original
-    # user-supplied name is intentionally discarded — it is never safe to
-    # preserve attacker-controlled input as a filesystem path component.
-    ext = "png" if output_format == "PNG" else "jpg"
-    filename = f"{uuid.uuid4().hex}.{ext}"
-    uploads_dir = os.path.join(
-        current_app.root_path,
-        current_app.config['UPLOADED_PHOTOS_DEST'],
-    )
-    os.makedirs(uploads_dir, exist_ok=True)
-    with open(os.path.join(uploads_dir, filename), "wb") as f:
-        f.write(clean_buffer.read())
+    return clean_buffer.getvalue(), ("png" if output_format == "PNG" else "jpg")
+
+
+def _reencode_image(stream, max_dimension: int | None = None) -> tuple[bytes, str]:
+    """Gate 3: fully decode *stream* and re-encode it to clean bytes."""
+    return _encode_clean(_decode_image(stream, max_dimension))
+
+
+# ---------------------------------------------------------------------------
+# Responsive image variants
+# ---------------------------------------------------------------------------
+#
+# Each processed upload is also written at a few smaller widths in modern
+# formats plus a JPEG fallback, once, by the image worker.  Variant files
+# sit next to the original as ``<stem>-<width>w.<ext>`` and the widths and
+# formats produced are recorded in ``Cocktail.image_variants`` so building
+# a ``srcset`` never touches the disk.
+
+# (extension, Pillow format, MIME type, save options) — best format first.
+_VARIANT_FORMATS = (
+    ('avif', 'AVIF', 'image/avif', {'quality': 60}),
+    ('webp', 'WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+# Rendered width of cocktail images; lets the browser pick the smallest
+# candidate that still fills the slot at the device's pixel density.
+IMAGE_SIZES = '(max-width: 768px) 100vw, 700px'
+
+# TheCocktailDB serves pre-scaled copies of every drink thumbnail when the
+# size name is appended to the URL.
+_API_THUMB_WIDTHS = (('small', 200), ('medium', 350), ('large', 500))
+
+
+def _variant_name(filename: str, width: int, ext: str) -> str:
+    return f"{filename.rsplit('.', 1)[0]}-{width}w.{ext}"
+
+
+# ---------------------------------------------------------------------------
+# Content-addressed upload storage
+# ---------------------------------------------------------------------------
+#
+# Uploads are named by the SHA-256 of their re-encoded bytes, so the same
+# image uploaded twice is stored once.  Files live two hash-prefix levels
+# deep (``ab/cd/abcd….jpg``) to keep directories small; the public URL
+# stays flat.  Pre-existing UUID-named uploads remain at the top level.
+# Bytes go through the configured storage driver (``services.storage``),
+# so the same code writes to local disk or to an S3-compatible bucket.
+
+_CONTENT_NAME = re.compile(r'^[0-9a-f]{64}(?:-\d+w)?\.[a-z]+$')
+
+
+def upload_relpath(filename: str) -> str:
+    """Storage key of an upload: its path below the uploads root."""
+    if _CONTENT_NAME.match(filename):
+        return f"{filename[:2]}/{filename[2:4]}/{filename}"
+    return filename
+
+
+# Dialects with ``INSERT ... ON CONFLICT DO UPDATE``.
+_UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def _take_blob_reference(filename: str, size: int) -> None:
+    """Create the blob row for *filename* or add one to its ``ref_count``.
+
+    Two first uploads of the same bytes can race; a single upsert (or, on
+    other databases, an insert retried as an update inside a savepoint)
+    lets both take their reference instead of one failing on the key.
+    """
+    insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if insert is not None:
+        db.session.execute(
+            insert(UploadBlob)
+            .values(filename=filename, ref_count=1, size=size)
+            .on_conflict_do_update(
+                index_elements=[UploadBlob.filename],
+                set_={'ref_count': UploadBlob.ref_count + 1},
+            )
+        )
+        return
+
+    def increment():
+        return (
+            UploadBlob.query
+            .filter_by(filename=filename)
+            .update({UploadBlob.ref_count: UploadBlob.ref_count + 1},
+                    synchronize_session=False)
+        )
+
+    if increment():
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(UploadBlob(filename=filename, ref_count=1, size=size))
+    except IntegrityError:
+        # Another upload inserted the row first; count ours on top of it.
+        increment()
+
+
+def store_upload(data: bytes, ext: str) -> str:
+    """Store re-encoded image bytes and take one reference to them.
+
+    Returns the content-addressed filename.  The file is written only when
+    no copy exists yet.  The reference is added to the session; the caller
+    commits it together with the row that points at the file.
+    """
+    filename = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    _take_blob_reference(filename, len(data))
+    storage = get_upload_storage()
+    key = upload_relpath(filename)
+    # Also re-creates a file lost from storage while its row survived.
+    if not storage.exists(key):
+        storage.save(key, io.BytesIO(data))
     return filename
 
 
-def get_cocktail_image_url(cocktail) -> str | None:
+def _remove_upload_files(filename: str, variants: dict | None) -> None:
+    names = [filename]
+    if variants:
+        names += [
+            _variant_name(filename, width, ext)
+            for width in variants.get('widths', [])
+            for ext in variants.get('formats', [])
+        ]
+    # One batched call: a single DeleteObjects request on object storage.
+    try:
+        get_upload_storage().delete_many([upload_relpath(name) for name in names])
+    except Exception as exc:
+        logging.warning("Could not delete uploaded image %r: %s", filename, exc)
+
+
+def generate_image_variants(filename: str, img: Image.Image) -> dict | None:
+    """Write resized variants of the upload *filename*; return the manifest.
+
+    Only widths narrower than the original are produced (never upscaled).
+    AVIF is skipped when this Pillow build cannot encode it.  Returns
+    ``None`` when the original is already at or below the smallest width.
+    """
+    widths = [w for w in current_app.config['IMAGE_VARIANT_WIDTHS'] if w < img.width]
+    if not widths:
+        return None
+    Image.init()  # load every format plugin so Image.SAVE is complete
+    formats = [f for f in _VARIANT_FORMATS if f[1] in Image.SAVE]
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('P', 'LA', 'PA') else 'RGB')
+    storage = get_upload_storage()
+    for width in widths:
+        resized = img.resize(
+            (width, max(1, round(img.height * width / img.width))),
+            Image.Resampling.LANCZOS,
+        )
+        for ext, pil_format, _mime, options in formats:
+            frame = resized
+            if pil_format == 'JPEG' and frame.mode != 'RGB':
+                # JPEG has no alpha channel: flatten onto white.
+                frame = Image.new('RGB', resized.size, (255, 255, 255))
+                frame.paste(resized, mask=resized.getchannel('A'))
+            buf = io.BytesIO()
+            frame.save(buf, format=pil_format, **options)
+            buf.seek(0)
+            storage.save(upload_relpath(_variant_name(filename, width, ext)), buf)
+    return {'width': img.width, 'widths': widths, 'formats': [f[0] for f in formats]}
+
+
+def api_image_sources(url: str | None) -> dict | None:
+    """Responsive image data for a remote TheCocktailDB thumbnail URL.
+
+    Every candidate goes through the local thumbnail proxy.
+    """
+    if not url:
+        return None
+    return {
+        'src': proxied_thumb_url(url),
+        'srcset': ', '.join(
+            f"{proxied_thumb_url(f'{url}/{name}')} {width}w" for name, width in _API_THUMB_WIDTHS
+        ),
+        'sources': [],
+        'sizes': IMAGE_SIZES,
+    }
+
+
+def save_uploaded_image(image_file) -> str | None:
+    """Validate and persist an uploaded image file synchronously.
+
+    Returns the stored filename (not the full path), or ``None`` when no file
+    was provided.  Raises ``ValueError`` for invalid or disallowed files.
+    The stored name is derived from the content hash only — the
+    user-supplied name is never used as a path component — and the caller
+    commits the blob reference taken by :func:`store_upload`.
+    Request handlers use :func:`stage_uploaded_image` instead so the
+    expensive decode runs off the request path.
+
+    Three-layer defence against malicious uploads:
+
+    1. **Extension allow-list** — fast first gate that rejects obviously wrong
+       file types before any further processing.
+    2. **Magic-byte check** — inspects the first bytes of the stream to catch
+       extension spoofing (e.g. a PHP shell renamed to ``evil.jpg``).
+    3. **Pillow re-encode** — opens the file, forces a full pixel decode
+       (``img.load()``), then writes a brand-new image to a clean buffer.
+       This strips *all* metadata (EXIF, ICC profiles, comments, thumbnails)
+       and destroys any polyglot payload (files that are simultaneously valid
+       images and executable scripts).  Decompression-bomb files and corrupt
+       /truncated data are also caught here before touching the filesystem.
+    """
+    if not image_file or not image_file.filename:
+        return None
+    _check_upload_gates(image_file)
+    data, ext = _reencode_image(image_file.stream, current_app.config['IMAGE_MAX_DIMENSION'])
+    return store_upload(data, ext)
+
+
+# ---------------------------------------------------------------------------
+# Background image processing
+# ---------------------------------------------------------------------------
+#
+# Decoding and re-encoding a photo of up to 10 MP holds a request worker
+# (and the GIL) for hundreds of milliseconds.  Uploads are therefore
+# *staged*: gates 1 and 2 plus a header-only parse run in the request, the
+# raw bytes are written to the staging storage (never served; on S3 the
+# bucket's ``_staging/`` prefix, so any node's worker can read them), and
+# gate 3 runs in the ``process_staged_image`` Celery task.  Until it
+# finishes the cocktail's ``pending_image`` column names the staged file.
+
+def stage_uploaded_image(image_file) -> str | None:
+    """Run the cheap upload gates and stage the raw file for processing.
+
+    Returns the staged name to store in ``Cocktail.pending_image``, or
+    ``None`` when no file was provided.  Raises ``ValueError`` exactly like
+    :func:`save_uploaded_image` for files rejected by the request-time gates.
+    """
+    if not image_file or not image_file.filename:
+        return None
+    _check_upload_gates(image_file)
+    staged_name = uuid.uuid4().hex
+    get_staging_storage().save(staged_name, image_file.stream)
+    return staged_name
+
+
+def discard_staged_image(staged_name: str | None) -> None:
+    """Remove a staged upload that is processed or was never committed."""
+    if not staged_name or staged_name != os.path.basename(staged_name):
+        return
+    # Missing files are ignored; other failures are logged by the driver.
+    get_staging_storage().delete_many([staged_name])
+
+
+# Shown on the cocktail when a staged upload could not be stored.
+_IMAGE_LOST = "The image was lost before it could be processed. Please upload it again."
+_IMAGE_NOT_SAVED = "The image could not be saved. Please try uploading it again."
+
+
+def _store_clean_image(img: Image.Image) -> tuple[str, dict | None]:
+    """Store the re-encoded *img* and its variants; return name and manifest."""
+    filename = store_upload(*_encode_clean(img))
+    blob = db.session.get(UploadBlob, filename)
+    # A duplicate of an existing blob reuses its variants as well.
+    if blob.variants is None:
+        blob.variants = generate_image_variants(filename, img)
+    return filename, blob.variants
+
+
+def _finish_staged_image(cocktail_id: int, staged_name: str, filename=None,
+                         variants=None, rejected: str | None = None) -> None:
+    """Commit the outcome of a staged upload, then remove the staged file.
+
+    Publishes *filename* on the cocktail, or records why the upload was
+    *rejected*.  Guarded on the staged name so a newer upload is never
+    overwritten; a superseded upload's stored file is released again.
+    """
+    cocktail = db.session.get(Cocktail, cocktail_id)
+    old_image = cocktail.image_url if cocktail and filename else None
+    old_variants = cocktail.image_variants if old_image else None
+    values = {Cocktail.pending_image: None, Cocktail.image_rejected: rejected}
+    if filename:
+        # Consolidate to image_url for user uploads; clear legacy field.
+        values.update({
+            Cocktail.image_url: filename,
+            Cocktail.image_variants: variants,
+            Cocktail.strDrinkThumb: None,
+        })
+    published = (
+        Cocktail.query
+        .filter_by(id=cocktail_id, pending_image=staged_name)
+        .update(values, synchronize_session=False)
+    )
+    db.session.commit()
+    discard_staged_image(staged_name)
+    if not published:
+        delete_uploaded_image(filename, variants)
+        return
+    # Delete the replaced upload only after the swap is committed.
+    delete_uploaded_image(old_image, old_variants)
+
+
+@celery.task(bind=True, name='cocktail_service.process_staged_image', ignore_result=True,
+             max_retries=5, default_retry_delay=30)
+def process_staged_image(self, cocktail_id: int, staged_name: str) -> None:
+    """Gate 3 for a staged upload: re-encode it and publish it on the cocktail.
+
+    A superseded upload (the user uploaded again, or deleted the cocktail,
+    before this ran) is processed but discarded.  A file that fails to
+    decode clears the pending state and records the reason in
+    ``image_rejected`` for the user, as does a staged file that is gone; the
+    previous image stays.  Other storage or database errors are retried with
+    the staged file kept, and reported the same way after the last attempt.
+    The staged file is deleted only once the outcome is committed.
+    """
+    try:
+        try:
+            with get_staging_storage().open(staged_name) as staged:
+                img = _decode_image(staged, current_app.config['IMAGE_MAX_DIMENSION'])
+        except ValueError as exc:
+            logging.warning("Rejected staged image %r for cocktail %s: %s",
+                            staged_name, cocktail_id, exc)
+            _finish_staged_image(cocktail_id, staged_name, rejected=str(exc))
+            return
+        except FileNotFoundError as exc:
+            logging.warning("Could not read staged image %r for cocktail %s: %s",
+                            staged_name, cocktail_id, exc)
+            _finish_staged_image(cocktail_id, staged_name, rejected=_IMAGE_LOST)
+            return
+        filename, variants = _store_clean_image(img)
+        _finish_staged_image(cocktail_id, staged_name, filename, variants)
+    except Exception as exc:
+        db.session.rollback()
+        if not self.request.called_directly and self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)
+        logging.exception("Could not store staged image %r for cocktail %s",
+                          staged_name, cocktail_id)
+        _finish_staged_image(cocktail_id, staged_name, rejected=_IMAGE_NOT_SAVED)
+
+
+def enqueue_image_processing(cocktail_id: int, staged_name: str | None) -> None:
+    """Hand a committed staged upload to the image worker.
+
+    Falls back to processing in-process when the broker is unreachable so
+    an outage delays nothing worse than this one request.
+    """
+    if not staged_name:
+        return
+    try:
+        process_staged_image.apply_async((cocktail_id, staged_name), retry=False)
+    except Exception as exc:
+        logging.warning("Image queue unavailable, processing inline: %s", exc)
+        process_staged_image(cocktail_id, staged_name)
+
+
+def get_cocktail_image_url(cocktail, srcset: bool = False):
     """Return the resolved public URL for a cocktail image, or ``None``.
 
     ``image_url`` (user uploads) takes priority over ``strDrinkThumb``
-    (API URLs or legacy user-edit filenames).
+    (API URLs or legacy user-edit filenames).  A personal variant without an
+    image of its own inherits its source cocktail's image.
+
+    With ``srcset=True`` a dict is returned instead, for the
+    ``responsive_image`` template macro: ``src`` (the full-size URL),
+    ``srcset`` (JPEG or remote candidates), ``sources`` (one
+    ``{'type', 'srcset'}`` entry per modern format) and ``sizes``.
     """
+    source = getattr(cocktail, 'source', None)
+    if source is not None and not (cocktail.image_url or cocktail.strDrinkThumb):
+        cocktail = source
     if cocktail.image_url:
-        return url_for('cocktails.uploaded_file', filename=cocktail.image_url)
+        url = url_for('cocktails.uploaded_file', filename=cocktail.image_url)
+        if not srcset:
+            return url
+        return _upload_image_sources(url, cocktail.image_url, cocktail.image_variants)
     if cocktail.strDrinkThumb:
         if cocktail.strDrinkThumb.startswith('http'):
-            return cocktail.strDrinkThumb
-        return url_for('cocktails.uploaded_file', filename=cocktail.strDrinkThumb)
+            if srcset:
+                return api_image_sources(cocktail.strDrinkThumb)
+            # TheCocktailDB thumbnails are served through the local cache.
+            return proxied_thumb_url(cocktail.strDrinkThumb)
+        url = url_for('cocktails.uploaded_file', filename=cocktail.strDrinkThumb)
+        return _upload_image_sources(url, None, None) if srcset else url
     return None
 
 
+def _upload_image_sources(url: str, filename: str | None, manifest: dict | None) -> dict:
+    sources, fallback = [], None
+    if filename and manifest:
+        mimes = {ext: mime for ext, _fmt, mime, _opts in _VARIANT_FORMATS}
+        for ext in manifest['formats']:
+            # The full-size original is always the widest candidate.
+            candidates = ', '.join([
+                url_for('cocktails.uploaded_file',
+                        filename=_variant_name(filename, width, ext)) + f" {width}w"
+                for width in manifest['widths']
+            ] + [f"{url} {manifest['width']}w"])
+            if ext == 'jpg':
+                fallback = candidates
+            else:
+                sources.append({'type': mimes[ext], 'srcset': candidates})
+    return {'src': url, 'srcset': fallback, 'sources': sources, 'sizes': IMAGE_SIZES}
+
+
+def canonical_ingredient_name(name: str) -> str:
+    """Return the canonical spelling used for ``Ingredient.name``."""
+    # Canonicalise: remove leading/trailing whitespace, collapse internal
+    # whitespace, then apply title-case so "dry gin" and "Dry Gin" are equal.
+    return " ".join(name.strip().split()).title()
+
+
 def store_or_get_ingredient(name: str) -> Ingredient:
     """Return the ``Ingredient`` row for *name*, creating it if absent.
 
@@ -147,9 +588,7 @@ def store_or_get_ingredient(name: str) -> Ingredient:
     case and whitespace variants ("vodka", " Vodka ", "VODKA") all resolve to
     the same canonical row.  The caller is responsible for committing the session.
     """
-    # Canonicalise: remove leading/trailing whitespace, collapse internal
-    # whitespace, then apply title-case so "dry gin" and "Dry Gin" are equal.
-    canonical = " ".join(name.strip().split()).title()
+    canonical = canonical_ingredient_name(name)
     ingredient = Ingredient.query.filter_by(name=canonical).first()
     if not ingredient:
         ingredient = Ingredient(name=canonical)
@@ -157,11 +596,41 @@ def store_or_get_ingredient(name: str) -> Ingredient:
     return ingredient
 
 
-def delete_uploaded_image(filename: str) -> None:
-    """Delete a locally stored upload by filename; silently ignores missing files.
+def store_or_get_ingredients(names) -> list[Ingredient]:
+    """Return the ``Ingredient`` rows for *names*, in order, creating any absent.
+
+    Batch form of :func:`store_or_get_ingredient`: one query looks up every
+    name and new rows are staged together, so saving a recipe costs the same
+    number of statements however many ingredients it has.  The caller commits.
+    """
+    canonical = [canonical_ingredient_name(name) for name in names]
+    found = {}
+    if canonical:
+        found = {
+            ingredient.name: ingredient
+            for ingredient in Ingredient.query.filter(Ingredient.name.in_(set(canonical)))
+        }
+    for name in canonical:
+        if name not in found:
+            found[name] = Ingredient(name=name)
+            db.session.add(found[name])
+    return [found[name] for name in canonical]
+
+
+def delete_uploaded_image(filename: str, variants: dict | None = None) -> None:
+    """Release one reference to an upload; delete its files with the last one.
 
-    Only plain filenames (no directory separators) are accepted to prevent
-    path-traversal attacks.
+    Content-addressed uploads are only removed from storage once no cocktail
+    refers to them any more, and only after the row deletion is committed,
+    so a failed commit never leaves a surviving row without its files.  The
+    blob row is locked while its count drops, and files are kept if an
+    upload of the same bytes has re-created the row since.  Legacy
+    UUID-named uploads have no blob row and are deleted directly — pass the
+    cocktail's ``image_variants`` manifest to remove their resized copies.
+
+    Call this after the caller's own commit: it commits the reference change
+    itself.  Only plain filenames (no directory separators) are accepted to
+    prevent path-traversal attacks.
     """
     if not filename:
         return
@@ -169,15 +638,323 @@ def delete_uploaded_image(filename: str) -> None:
     if filename != os.path.basename(filename):
         return
     try:
-        upload_dir = os.path.join(
-            current_app.root_path,
-            current_app.config['UPLOADED_PHOTOS_DEST'],
+        blob = (
+            UploadBlob.query
+            .filter_by(filename=filename)
+            .with_for_update()
+            .first()
         )
-        path = os.path.join(upload_dir, filename)
-        if os.path.isfile(path):
-            os.remove(path)
+        if blob is not None:
+            blob.ref_count -= 1
+            released = blob.ref_count <= 0
+            manifest = blob.variants
+            if released:
+                db.session.delete(blob)
+            db.session.commit()
+            if released and db.session.get(UploadBlob, filename) is None:
+                _remove_upload_files(filename, manifest)
+            return
     except Exception as exc:
-        logging.warning("Could not delete uploaded image %r: %s", filename, exc)
+        db.session.rollback()
+        logging.warning("Could not release uploaded image %r: %s", filename, exc)
+        return
+    _remove_upload_files(filename, variants)
+
+
+class SharedCocktailGone(LookupError):
+    """The cocktail being linked was deleted (by the orphan collector) first."""
+
+
+def _adjust_ref_count(cocktail_id: int, delta: int) -> int:
+    """Atomically add *delta* to ``Cocktail.ref_count`` for one row.
+
+    ``UPDATE ... SET ref_count = ref_count + :delta`` keeps concurrent
+    add/remove requests from losing updates; ``fetch`` synchronisation keeps
+    any already-loaded ``Cocktail`` instance in step with the new value.
+    Returns the number of rows updated, which is 0 when the row is gone.
+    """
+    return Cocktail.query.filter_by(id=cocktail_id).update(
+        {Cocktail.ref_count: Cocktail.ref_count + delta},
+        synchronize_session='fetch',
+    )
+
+
+def link_user_to_cocktail(user_id: int, cocktail_id: int) -> Cocktails_Users:
+    """Stage a ``Cocktails_Users`` row and bump the cocktail's reference count.
+
+    The count is taken first: if its ``UPDATE`` matches no row, the cocktail
+    was deleted since it was read, and :class:`SharedCocktailGone` is raised
+    before any link is staged.  The caller is responsible for committing the
+    session.
+    """
+    if not _adjust_ref_count(cocktail_id, 1):
+        raise SharedCocktailGone(cocktail_id)
+    rel = Cocktails_Users(user_id=user_id, cocktail_id=cocktail_id)
+    db.session.add(rel)
+    return rel
+
+
+def unlink_user_from_cocktail(rel: Cocktails_Users) -> None:
+    """Stage deletion of a ``Cocktails_Users`` row and drop the reference count.
+
+    Shared API rows that fall to zero references are *not* deleted here —
+    :func:`collect_orphaned_api_cocktails` reclaims them in the background so
+    the user's request does no cascade work.  The caller commits.
+    """
+    cocktail_id = rel.cocktail_id
+    db.session.delete(rel)
+    _adjust_ref_count(cocktail_id, -1)
+
+
+def release_user_cocktail_refs(user_id: int) -> None:
+    """Drop the references *user_id* holds on cocktails and variant sources.
+
+    Called before a user is deleted, because the ORM cascade removes their
+    ``Cocktails_Users`` rows without passing through
+    :func:`unlink_user_from_cocktail`.  The caller commits.
+    """
+    linked_ids = (
+        db.select(Cocktails_Users.cocktail_id)
+        .where(Cocktails_Users.user_id == user_id)
+        .scalar_subquery()
+    )
+    Cocktail.query.filter(Cocktail.id.in_(linked_ids)).update(
+        {Cocktail.ref_count: Cocktail.ref_count - 1},
+        synchronize_session=False,
+    )
+    # The user's personal variants are about to be orphaned as well, so
+    # release the reference each one holds on its source cocktail.
+    variant_sources = (
+        db.select(Cocktail.source_cocktail_id)
+        .join(Cocktails_Users, Cocktails_Users.cocktail_id == Cocktail.id)
+        .where(Cocktails_Users.user_id == user_id, Cocktail.source_cocktail_id.isnot(None))
+        .scalar_subquery()
+    )
+    Cocktail.query.filter(Cocktail.id.in_(variant_sources)).update(
+        {Cocktail.ref_count: Cocktail.ref_count - 1},
+        synchronize_session=False,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Copy-on-write personal variants
+# ---------------------------------------------------------------------------
+
+def find_personal_variant(user_id: int, source_id: int) -> Cocktail | None:
+    """Return *user_id*'s variant of the shared cocktail *source_id*, if any.
+
+    Served by the ``(source_cocktail_id, owner_id)`` index.
+    """
+    return Cocktail.query.filter_by(
+        source_cocktail_id=source_id, owner_id=user_id
+    ).first()
+
+
+def create_personal_variant(source: Cocktail, user_id: int,
+                            rel: Cocktails_Users | None = None) -> Cocktail:
+    """Stage a copy-on-write variant of *source* owned by *user_id*.
+
+    Only the name is materialised (so listings can sort without a join);
+    every other field and every ingredient is inherited until the user
+    overrides it.  The user's ``Cocktails_Users`` row *rel* on the shared
+    record is replaced by a link to the variant.  The reference it held moves
+    to the variant's ``source_cocktail_id``, so ``source.ref_count`` is left
+    unchanged.  The caller commits.
+    """
+    variant = Cocktail(
+        name=source.name,
+        is_api_cocktail=False,
+        owner_id=user_id,
+        source_cocktail_id=source.id,
+    )
+    db.session.add(variant)
+    # Flush to obtain variant.id before building the join row.
+    db.session.flush()
+    if rel is not None:
+        db.session.delete(rel)
+    elif not _adjust_ref_count(source.id, 1):
+        raise SharedCocktailGone(source.id)
+    link_user_to_cocktail(user_id, variant.id)
+    return variant
+
+
+def delete_personal_cocktail(cocktail: Cocktail) -> None:
+    """Stage deletion of a user-owned cocktail, releasing its source reference."""
+    if cocktail.source_cocktail_id:
+        _adjust_ref_count(cocktail.source_cocktail_id, -1)
+    db.session.delete(cocktail)
+
+
+def _merge_ingredient_rows(base_rows, delta_rows):
+    """Overlay a variant's ingredient deltas on its source's ingredient rows.
+
+    Overrides replace the source row in place, tombstones hide it, and
+    ingredients the source does not have are appended in insertion order.
+    """
+    overrides = {row.ingredient_id: row for row in delta_rows}
+    merged = []
+    for row in base_rows:
+        override = overrides.pop(row.ingredient_id, None)
+        if override is None:
+            merged.append(row)
+        elif not override.is_removed:
+            merged.append(override)
+    merged.extend(row for row in overrides.values() if not row.is_removed)
+    return merged
+
+
+def resolve_cocktails(cocktails) -> list[dict]:
+    """Return display dicts for *cocktails*, resolving personal variants.
+
+    Ingredient rows for every cocktail and every variant source are loaded
+    with a single query.  Load ``Cocktail.source`` eagerly on the input so
+    inherited scalar fields do not cost extra round trips either.
+    """
+    ids = {c.id for c in cocktails}
+    ids.update(c.source_cocktail_id for c in cocktails if c.source_cocktail_id)
+    rows_by_cocktail = {}
+    if ids:
+        rows = (
+            db.session.query(
+                Cocktails_Ingredients.cocktail_id,
+                Cocktails_Ingredients.ingredient_id,
+                Cocktails_Ingredients.quantity,
+                Cocktails_Ingredients.is_removed,
+                Ingredient.name,
+            )
+            .join(Ingredient, Ingredient.id == Cocktails_Ingredients.ingredient_id)
+            .filter(Cocktails_Ingredients.cocktail_id.in_(ids))
+            .order_by(Cocktails_Ingredients.id)
+            .all()
+        )
+        for row in rows:
+            rows_by_cocktail.setdefault(row.cocktail_id, []).append(row)
+
+    resolved = []
+    for cocktail in cocktails:
+        own_rows = rows_by_cocktail.get(cocktail.id, [])
+        instructions = cocktail.instructions
+        if cocktail.source_cocktail_id:
+            ingredient_rows = _merge_ingredient_rows(
+                rows_by_cocktail.get(cocktail.source_cocktail_id, []), own_rows
+            )
+            if instructions is None and cocktail.source is not None:
+                instructions = cocktail.source.instructions
+        else:
+            ingredient_rows = own_rows
+        resolved.append({
+            'id': cocktail.id,
+            'name': cocktail.name,
+            'instructions': instructions,
+            'ingredients': [
+                {'ingredient': row.name, 'measure': row.quantity}
+                for row in ingredient_rows
+            ],
+            # Resolve image URL once via the service helper (prefers image_url,
+            # falls back to strDrinkThumb, returns None when neither is set).
+            'image_url': get_cocktail_image_url(cocktail),
+            'image': get_cocktail_image_url(cocktail, srcset=True),
+            # True while a new upload is still being processed in the background.
+            'image_pending': bool(cocktail.pending_image),
+            # Why the last upload was not used, if it was not.
+            'image_rejected': cocktail.image_rejected,
+        })
+    return resolved
+
+
+def apply_variant_edit(variant: Cocktail, name: str, instructions: str,
+                       ingredients: list[dict]) -> None:
+    """Store only the differences between an edited variant and its source.
+
+    Fields equal to the source are reset to ``NULL`` (inherit).  Ingredients
+    equal to the source need no row; changed or added ones get an override
+    row and source ingredients missing from the form get a tombstone.  The
+    caller commits.
+    """
+    source = variant.source
+    variant.name = name
+    variant.instructions = None if instructions == source.instructions else instructions
+
+    base = {ci.ingredient.name: ci for ci in source.ingredients_relation}
+    wanted = {
+        canonical_ingredient_name(item['ingredient']): item['measure']
+        for item in ingredients
+    }
+    desired = {
+        ingredient_name: (measure, False)
+        for ingredient_name, measure in wanted.items()
+        if ingredient_name not in base or base[ingredient_name].quantity != measure
+    }
+    for ingredient_name, ci in base.items():
+        if ingredient_name not in wanted:
+            desired[ingredient_name] = (ci.quantity, True)
+
+    for ci in list(variant.ingredients_relation):
+        change = desired.pop(ci.ingredient.name, None)
+        if change is None:
+            variant.ingredients_relation.remove(ci)
+            db.session.delete(ci)
+        else:
+            ci.quantity, ci.is_removed = change
+
+    added = [ingredient_name for ingredient_name in desired if ingredient_name not in base]
+    added = dict(zip(added, store_or_get_ingredients(added)))
+    for ingredient_name, (measure, is_removed) in desired.items():
+        ingredient = (
+            base[ingredient_name].ingredient if ingredient_name in base
+            else added[ingredient_name]
+        )
+        db.session.add(Cocktails_Ingredients(
+            cocktail=variant, ingredient=ingredient,
+            quantity=measure, is_removed=is_removed,
+        ))
+
+
+@celery.task(name='cocktail_service.collect_orphaned_api_cocktails', ignore_result=True)
+def collect_orphaned_api_cocktails(batch_size=500, max_batches=20):
+    """Delete shared API cocktails that no user references any more.
+
+    Works in batches of *batch_size* rows, each in its own short transaction,
+    and stops after *max_batches* so one run never holds locks for long.
+    Candidate rows are locked (``FOR UPDATE SKIP LOCKED`` on PostgreSQL), and
+    the ``DELETE`` re-checks ``ref_count <= 0`` so a row that gained a
+    reference after it was selected is kept.  A ``link_user_to_cocktail``
+    that waits behind the batch's lock finds the row gone afterwards: its
+    ``UPDATE`` matches nothing, it raises :class:`SharedCocktailGone`, and
+    :func:`process_and_store_new_cocktail` re-creates the shared row.
+    Returns the number of rows removed.
+    """
+    removed = 0
+    for _ in range(max_batches):
+        ids = [
+            row.id for row in (
+                db.session.query(Cocktail.id)
+                .filter(Cocktail.is_api_cocktail == True, Cocktail.ref_count <= 0)  # noqa: E712
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+        ]
+        if not ids:
+            break
+        orphaned = (Cocktail.id.in_(ids), Cocktail.ref_count <= 0)
+        try:
+            # Bulk deletes bypass the ORM cascade, so remove children first.
+            Cocktails_Ingredients.query.filter(
+                Cocktails_Ingredients.cocktail_id.in_(
+                    db.select(Cocktail.id).where(*orphaned)
+                )
+            ).delete(synchronize_session=False)
+            removed += Cocktail.query.filter(*orphaned).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if len(ids) < batch_size:
+            break
+    if removed:
+        logging.info("Orphan collector removed %d unreferenced API cocktails", removed)
+    return removed
 
 
 def _find_existing_api_cocktail(external_id: str | None, name: str) -> Cocktail | None:
@@ -209,73 +986,76 @@ def process_and_store_new_cocktail(cocktail_api: dict, user_id: int) -> None:
     Deduplication uses the stable ``idDrink`` field from TheCocktailDB as the
     primary key; the drink name is used only as a fallback for older rows that
     pre-date the ``api_cocktail_id`` column.
-    Raises on DB error after rolling back.
+    If the shared row is deleted by :func:`collect_orphaned_api_cocktails`
+    between being found and being linked, the transaction is rolled back and
+    run once more, which re-creates it.  Raises on DB error after rolling back.
     """
-    try:
-        external_id = str(cocktail_api.get('idDrink', '')) or None
-        existing = _find_existing_api_cocktail(external_id, cocktail_api['strDrink'])
+    for attempt in (1, 2):
+        try:
+            return _store_and_link_api_cocktail(cocktail_api, user_id)
+        except SharedCocktailGone:
+            db.session.rollback()
+            if attempt == 2:
+                raise
+        except Exception:
+            db.session.rollback()
+            raise
 
-        if existing:
-            new_cocktail = existing
-        else:
-            new_cocktail = Cocktail(
-                name=cocktail_api['strDrink'],
-                instructions=cocktail_api.get('strInstructions'),
-                strDrinkThumb=cocktail_api.get('strDrinkThumb'),
-                is_api_cocktail=True,
-                api_cocktail_id=external_id,
-            )
-            db.session.add(new_cocktail)
-            # Flush to obtain new_cocktail.id before building FK rows.
-            db.session.flush()
-
-            # The CocktailDB API returns ingredients as strIngredient1–15.
-            for i in range(1, 16):
-                name = cocktail_api.get(f'strIngredient{i}')
-                measure = cocktail_api.get(f'strMeasure{i}')
-                if name:
-                    ingredient = store_or_get_ingredient(name)
-                    # Flush so ingredient.id is available for the association row.
-                    db.session.flush()
-                    db.session.add(
-                        Cocktails_Ingredients(
-                            cocktail_id=new_cocktail.id,
-                            ingredient_id=ingredient.id,
-                            quantity=measure or '',
-                        )
-                    )
-
-        # Link the cocktail to the user only if they don't already have it.
-        # Also guard against the case where the user previously edited this
-        # API cocktail (creating a personal copy) which swapped the
-        # Cocktails_Users link away from the shared API record.  Without this
-        # check the guard below would miss the personal copy and create a
-        # duplicate entry in the user's profile.
-        already_linked = Cocktails_Users.query.filter_by(
-            user_id=user_id, cocktail_id=new_cocktail.id
-        ).first()
-        has_personal_copy = (
-            Cocktail.query
-            .join(Cocktails_Users, Cocktails_Users.cocktail_id == Cocktail.id)
-            .filter(
-                Cocktails_Users.user_id == user_id,
-                Cocktail.is_api_cocktail == False,
-                Cocktail.name == new_cocktail.name,
-            )
-            .first()
-        ) if not already_linked else None
 
-        newly_added = False
-        if not already_linked and not has_personal_copy:
+def _store_and_link_api_cocktail(cocktail_api: dict, user_id: int) -> bool:
+    """One attempt of :func:`process_and_store_new_cocktail`; commits on success."""
+    external_id = str(cocktail_api.get('idDrink', '')) or None
+    existing = _find_existing_api_cocktail(external_id, cocktail_api['strDrink'])
+
+    if existing:
+        new_cocktail = existing
+    else:
+        new_cocktail = Cocktail(
+            name=cocktail_api['strDrink'],
+            instructions=cocktail_api.get('strInstructions'),
+            strDrinkThumb=cocktail_api.get('strDrinkThumb'),
+            is_api_cocktail=True,
+            api_cocktail_id=external_id,
+        )
+        db.session.add(new_cocktail)
+        # Flush to obtain new_cocktail.id before building FK rows.
+        db.session.flush()
+
+        # The CocktailDB API returns ingredients as strIngredient1–15.
+        pairs = [
+            (cocktail_api.get(f'strIngredient{i}'), cocktail_api.get(f'strMeasure{i}'))
+            for i in range(1, 16)
+        ]
+        pairs = [(name, measure) for name, measure in pairs if name]
+        ingredients = store_or_get_ingredients([name for name, _ in pairs])
+        for ingredient, (_, measure) in zip(ingredients, pairs):
             db.session.add(
-                Cocktails_Users(user_id=user_id, cocktail_id=new_cocktail.id)
+                Cocktails_Ingredients(
+                    cocktail_id=new_cocktail.id,
+                    ingredient=ingredient,
+                    quantity=measure or '',
+                )
             )
-            newly_added = True
 
-        # Single commit covers all rows prepared above.
-        db.session.commit()
-        return newly_added
+    # Link the cocktail to the user only if they don't already have it.
+    # Also guard against the case where the user previously edited this
+    # API cocktail (creating a personal variant) which swapped the
+    # Cocktails_Users link away from the shared API record.  Without this
+    # check the guard below would miss the variant and create a
+    # duplicate entry in the user's profile.
+    already_linked = Cocktails_Users.query.filter_by(
+        user_id=user_id, cocktail_id=new_cocktail.id
+    ).first()
+    has_personal_copy = (
+        find_personal_variant(user_id, new_cocktail.id)
+        if not already_linked else None
+    )
 
-    except Exception:
-        db.session.rollback()
-        raise
+    newly_added = False
+    if not already_linked and not has_personal_copy:
+        link_user_to_cocktail(user_id, new_cocktail.id)
+        newly_added = True
+
+    # Single commit covers all rows prepared above.
+    db.session.commit()
+    return newly_added
@@ -1,29 +1,188 @@
 """Service layer for all outbound email sending.
 
-Email messages are serialised as JSON and dispatched to a Celery worker
-so the HTTP request returns immediately without waiting for the SMTP
-round-trip.  The worker runs under a pushed Flask application context
-(configured in ``app._celery_init``), giving it full access to
-Flask-Mail and the rest of the app.
+Emails go through a transactional outbox: the public ``send_*`` helpers
+add an :class:`~models.EmailOutbox` row to the current session, so the
+email is committed atomically with the action that triggers it and the
+HTTP request never waits on Redis, the broker or SMTP.  The
+``relay_outbox`` Celery beat task drains due rows in batches over one
+reused :class:`SmtpSession`, retrying failures with exponential backoff.  The worker
+runs under a pushed Flask application context (configured in
+``app._celery_init``), giving it full access to Flask-Mail and the rest of
+the app.
 """
 import logging
+import smtplib
+from datetime import datetime, timedelta, timezone
 
 from flask import url_for
-from flask_mail import Message
+from flask_mail import BadHeaderError, Message
 
 from extensions import celery
+from models import db, EmailOutbox
+
+
+# Give up on a message after this many failed attempts (~2 hours of retries).
+MAX_DELIVERY_ATTEMPTS = 8
+_RETRY_BASE_SECONDS = 30
+_RETRY_MAX_SECONDS = 60 * 60
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue_email(subject, recipients, body, html=None) -> EmailOutbox:
+    """Add an email to the outbox; it is sent once the caller commits."""
+    message = EmailOutbox(subject=subject, recipients=list(recipients), body=body, html=html)
+    db.session.add(message)
+    return message
+
+
+# ---------------------------------------------------------------------------
+# SMTP sessions shared by bulk sends
+# ---------------------------------------------------------------------------
+
+def is_connection_error(exc: Exception) -> bool:
+    """Whether *exc* means the SMTP session itself is unusable."""
+    # Every smtplib error is an OSError; only these concern the connection
+    # rather than the message being sent.
+    return isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                            smtplib.SMTPAuthenticationError)) or (
+        isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+    )
+
+
+def is_permanent_failure(exc: Exception) -> bool:
+    """Whether resending the same message can never succeed (5xx replies)."""
+    if isinstance(exc, BadHeaderError):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _reply in exc.recipients.values()]
+        return bool(codes) and all(code >= 500 for code in codes)
+    if isinstance(exc, smtplib.SMTPDataError):
+        return exc.smtp_code >= 500
+    return False
+
+
+class SmtpSession:
+    """One SMTP session reused across many messages.
+
+    The connection is opened on the first send and reopened, up to
+    *reconnects* times per message, when the server drops it (idle
+    timeouts, per-session limits).  Flask-Mail also recycles it after
+    ``MAIL_MAX_EMAILS`` messages.  Errors about a single message — refused
+    recipients, rejected data — are raised unchanged and leave the session
+    usable for the next one.
+    """
+
+    def __init__(self, reconnects: int = 2):
+        from extensions import mail
+        self._mail = mail
+        self._reconnects = reconnects
+        self._conn = None
+        self.connections = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass  # the server may already have hung up
+
+    def send(self, message: Message) -> None:
+        for attempt in range(self._reconnects + 1):
+            try:
+                if self._conn is None:
+                    self._conn = self._mail.connect().__enter__()
+                    self.connections += 1
+                self._conn.send(message)
+                return
+            except Exception as exc:
+                if not is_connection_error(exc):
+                    raise
+                self.close()
+                if attempt == self._reconnects:
+                    raise
+                logging.warning("SMTP session lost (%s); reconnecting", exc)
 
 
 # ---------------------------------------------------------------------------
-# Celery task — runs in a worker process under the Flask app context
+# Celery tasks — run in a worker process under the Flask app context
 # ---------------------------------------------------------------------------
 
+def _record_failure(row: EmailOutbox, exc: Exception, now: datetime,
+                    permanent: bool = False) -> None:
+    row.attempts += 1
+    row.last_error = str(exc)[:1000]
+    if permanent or row.attempts >= MAX_DELIVERY_ATTEMPTS:
+        row.status = 'failed'
+        logging.error("Giving up on outbox email #%s after %d attempts: %s",
+                      row.id, row.attempts, exc)
+        return
+    delay = min(_RETRY_BASE_SECONDS * 2 ** (row.attempts - 1), _RETRY_MAX_SECONDS)
+    row.next_attempt_at = now + timedelta(seconds=delay)
+    logging.warning("Outbox email #%s failed (attempt %d), retrying in %ds: %s",
+                    row.id, row.attempts, delay, exc)
+
+
+@celery.task(name='email_service.relay_outbox', ignore_result=True)
+def relay_outbox(batch_size=100, max_batches=10) -> int:
+    """Send due outbox emails in batches over one reused SMTP session.
+
+    Due rows are claimed with ``FOR UPDATE SKIP LOCKED`` (on PostgreSQL) so
+    concurrent relays never send the same email twice, and each batch is
+    committed as soon as it has been attempted.  A recipient the server
+    refuses permanently (5xx) fails only that email; if the server cannot
+    be reached the rest of the run is deferred.  Returns the number sent.
+    """
+    sent = 0
+    with SmtpSession() as session:
+        for _ in range(max_batches):
+            now = _utcnow()
+            batch = (
+                EmailOutbox.query
+                .filter(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now)
+                .order_by(EmailOutbox.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not batch:
+                break
+            for index, row in enumerate(batch):
+                try:
+                    session.send(Message(subject=row.subject, recipients=row.recipients,
+                                         body=row.body, html=row.html))
+                except Exception as exc:
+                    if is_connection_error(exc):
+                        for unsent in batch[index:]:
+                            _record_failure(unsent, exc, now)
+                        db.session.commit()
+                        return sent
+                    _record_failure(row, exc, now, permanent=is_permanent_failure(exc))
+                    continue
+                row.status = 'sent'
+                row.sent_at = _utcnow()
+                sent += 1
+            db.session.commit()
+            if len(batch) < batch_size:
+                break
+    return sent
+
+
 @celery.task(name='email_service.deliver', ignore_result=True)
 def _deliver(subject, recipients, body, html=None):
     """Send a plain-text (and optionally HTML) email via Flask-Mail.
 
-    All arguments are plain JSON-serialisable types so the task is
-    compatible with Celery's default JSON serialiser.  When *html* is
+    No longer queued by this module; kept so tasks enqueued by earlier
+    releases are still delivered after an upgrade.  When *html* is
     provided the message is sent as multipart/alternative so email
     clients that support HTML will render the anchor tag instead of the
     raw URL, preventing quoted-printable line-wrapping from breaking the
@@ -38,16 +197,16 @@ def _deliver(subject, recipients, body, html=None):
 
 
 # ---------------------------------------------------------------------------
-# Public send functions — called from request context; enqueue the task
+# Public send functions — called from request context; the caller commits
 # ---------------------------------------------------------------------------
 
 def send_verification_email(user, token):
-    """Queue an email-verification message for a newly registered user."""
+    """Add an email-verification message for a newly registered user to the outbox."""
     from helpers import generate_email_verification_email, generate_email_verification_html
     link = url_for('auth.verify_email', token=token, _external=True)
     body = generate_email_verification_email(user.username, link)
     html = generate_email_verification_html(user.username, link)
-    _deliver.delay(
+    enqueue_email(
         subject="Verify Your Email - Cocktail Chronicles",
         recipients=[user.email],
         body=body,
@@ -56,12 +215,12 @@ def send_verification_email(user, token):
 
 
 def send_resend_verification_email(user, token):
-    """Queue a re-send of the email-verification message."""
+    """Add a re-send of the email-verification message to the outbox."""
     from helpers import generate_email_resend_verification_email, generate_email_verification_html
     link = url_for('auth.verify_email', token=token, _external=True)
     body = generate_email_resend_verification_email(user.username, link)
     html = generate_email_verification_html(user.username, link)
-    _deliver.delay(
+    enqueue_email(
         subject="Verify Your Email - Cocktail Chronicles (Resend)",
         recipients=[user.email],
         body=body,
@@ -70,11 +229,11 @@ def send_resend_verification_email(user, token):
 
 
 def send_ban_notification_email(user):
-    """Queue a suspension notice with an appeal link."""
+    """Add a suspension notice with an appeal link to the outbox."""
     from helpers import generate_ban_appeal_email
     appeal_link = url_for('users.submit_appeal', _external=True)
     body = generate_ban_appeal_email(user.username, appeal_link)
-    _deliver.delay(
+    enqueue_email(
         subject='Account Suspension Notice - Appeal Process Available',
         recipients=[user.email],
         body=body,
@@ -82,21 +241,32 @@ def send_ban_notification_email(user):
 
 
 def send_ban_lifted_email(user):
-    """Queue a notification that the user's suspension has been lifted."""
+    """Add a notification that the user's suspension has been lifted to the outbox."""
     from helpers import generate_ban_lifted_email
     body = generate_ban_lifted_email(user.username)
-    _deliver.delay(
+    enqueue_email(
         subject='Your Account Suspension Has Been Lifted',
         recipients=[user.email],
         body=body,
     )
 
 
+def send_ban_expired_email(user):
+    """Add a notification that the user's temporary suspension has ended to the outbox."""
+    from helpers import generate_ban_expired_email
+    body = generate_ban_expired_email(user.username)
+    enqueue_email(
+        subject='Your Account Suspension Has Ended',
+        recipients=[user.email],
+        body=body,
+    )
+
+
 def send_appeal_rejection_email(user):
-    """Queue a notification that the user's ban appeal was rejected."""
+    """Add a notification that the user's ban appeal was rejected to the outbox."""
     from helpers import generate_appeal_rejection_email
     body = generate_appeal_rejection_email(user.username)
-    _deliver.delay(
+    enqueue_email(
         subject='Your Ban Appeal Has Been Reviewed',
         recipients=[user.email],
         body=body,
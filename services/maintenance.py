@@ -0,0 +1,144 @@
+"""Scheduled maintenance jobs run by Celery beat.
+
+Temporary bans are otherwise only evaluated lazily (``enforce_ban`` and
+``login`` treat a past ``ban_until`` as no ban), and nothing ever removed
+abandoned sign-ups or decided appeals.  The jobs here do that in bounded
+batches: each batch selects at most *batch_size* rows through an index,
+changes them and commits, so no transaction holds locks on ``user`` or
+``user_appeal`` for longer than one batch, and an interrupted run is simply
+continued by the next one.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import delete, insert, literal, select
+
+from extensions import celery
+from models import db, User, UserAppeal, UserAppealArchive
+from services.email_service import send_ban_expired_email
+from services.user_context import invalidate_user_context
+
+
+DECIDED_APPEAL_STATUSES = ('approved', 'rejected', 'expired')
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@celery.task(name='maintenance.lift_expired_bans', ignore_result=True)
+def lift_expired_bans(batch_size=200, max_batches=50) -> int:
+    """Clear bans whose ``ban_until`` has passed and email each user.
+
+    Pending appeals against a ban that has ended are closed as ``expired``.
+    Permanent bans are left alone.  Returns the number of bans lifted.
+    """
+    lifted = 0
+    for _ in range(max_batches):
+        now = _utcnow()
+        users = (
+            User.query
+            .filter(User.ban_until <= now, User.is_permanently_banned == False)
+            .order_by(User.ban_until)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not users:
+            break
+        user_ids = [user.id for user in users]
+        for user in users:
+            user.ban_until = None
+            # Joins the outbox in this batch's commit.
+            send_ban_expired_email(user)
+        (UserAppeal.query
+         .filter(UserAppeal.user_id.in_(user_ids), UserAppeal.status == 'pending')
+         .update({UserAppeal.status: 'expired', UserAppeal.admin_response_date: now},
+                 synchronize_session=False))
+        db.session.commit()
+        for user_id in user_ids:
+            invalidate_user_context(user_id)
+        lifted += len(users)
+        if len(users) < batch_size:
+            break
+    if lifted:
+        logging.info("Lifted %d expired bans", lifted)
+    return lifted
+
+
+@celery.task(name='maintenance.purge_unverified_accounts', ignore_result=True)
+def purge_unverified_accounts(max_age_days=None, batch_size=100, max_batches=50) -> int:
+    """Delete non-admin accounts still unverified *max_age_days* after sign-up.
+
+    Defaults to ``UNVERIFIED_ACCOUNT_TTL_DAYS``.  Returns the number deleted.
+    """
+    if max_age_days is None:
+        max_age_days = current_app.config['UNVERIFIED_ACCOUNT_TTL_DAYS']
+    cutoff = _utcnow() - timedelta(days=max_age_days)
+    purged = 0
+    for _ in range(max_batches):
+        users = (
+            User.query
+            .filter(User.is_email_verified == False, User.created_at < cutoff,
+                    User.is_admin == False)
+            .order_by(User.created_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not users:
+            break
+        # Unverified users can never log in, so they own no cocktails or
+        # messages that need releasing first; the ORM cascades clean up the rest.
+        for user in users:
+            db.session.delete(user)
+        db.session.commit()
+        purged += len(users)
+        if len(users) < batch_size:
+            break
+    if purged:
+        logging.info("Purged %d accounts unverified for over %d days", purged, max_age_days)
+    return purged
+
+
+@celery.task(name='maintenance.archive_decided_appeals', ignore_result=True)
+def archive_decided_appeals(older_than_days=None, batch_size=500, max_batches=50) -> int:
+    """Move appeals decided over *older_than_days* ago to ``user_appeal_archive``.
+
+    Defaults to ``APPEAL_ARCHIVE_AFTER_DAYS``.  Each batch is copied with
+    ``INSERT ... SELECT`` and deleted in the same transaction.  Returns the
+    number archived.
+    """
+    if older_than_days is None:
+        older_than_days = current_app.config['APPEAL_ARCHIVE_AFTER_DAYS']
+    cutoff = _utcnow() - timedelta(days=older_than_days)
+    decided = (
+        select(UserAppeal.id)
+        .where(UserAppeal.status.in_(DECIDED_APPEAL_STATUSES),
+               UserAppeal.admin_response_date < cutoff)
+        .order_by(UserAppeal.id)
+        .limit(batch_size)
+    )
+    columns = ['id', 'user_id', 'appeal_text', 'created_at', 'status',
+               'admin_response', 'admin_response_date']
+    archived = 0
+    for _ in range(max_batches):
+        appeal_ids = db.session.scalars(decided).all()
+        if not appeal_ids:
+            break
+        db.session.execute(
+            insert(UserAppealArchive).from_select(
+                columns + ['archived_at'],
+                select(*(getattr(UserAppeal, c) for c in columns), literal(_utcnow()))
+                .where(UserAppeal.id.in_(appeal_ids)),
+            )
+        )
+        db.session.execute(delete(UserAppeal).where(UserAppeal.id.in_(appeal_ids)))
+        db.session.commit()
+        archived += len(appeal_ids)
+        if len(appeal_ids) < batch_size:
+            break
+    if archived:
+        logging.info("Archived %d decided appeals", archived)
+    return archived
@@ -0,0 +1,133 @@
+"""Service layer for the admin/user message inboxes.
+
+Provides keyset (cursor) pagination over ``AdminMessage`` and the O(1)
+unread counters that back the inbox badges.
+
+Pagination walks the ``(created_at, id)`` key newest-first, so fetching
+page *n* costs the same index range scan as page 1 — unlike ``OFFSET``,
+which has to skip every earlier row.  Cursors are opaque, URL-safe tokens
+that encode the last row seen.
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from models import db, User, AdminMessage, InboxCounter
+
+
+ADMIN_UNREAD_COUNTER = 'admin_unread'
+
+
+# ---------------------------------------------------------------------------
+# Keyset pagination
+# ---------------------------------------------------------------------------
+
+def encode_cursor(message: AdminMessage) -> str:
+    """Return an opaque cursor pointing just past *message*."""
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str | None) -> tuple[datetime, int] | None:
+    """Decode a cursor into ``(created_at, id)``; ``None`` if absent or malformed.
+
+    A tampered or stale cursor simply restarts from the first page rather
+    than raising, so a bad query string can never produce a 500.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        created_at, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def paginate_messages(query, cursor: str | None, per_page: int):
+    """Return ``(messages, next_cursor)`` for one newest-first page of *query*.
+
+    *query* may carry extra filters (e.g. ``user_id``); ordering and the
+    keyset predicate are applied here.  One extra row is fetched to learn
+    whether another page exists without issuing a COUNT.
+    """
+    position = decode_cursor(cursor)
+    if position:
+        created_at, message_id = position
+        query = query.filter(or_(
+            AdminMessage.created_at < created_at,
+            and_(AdminMessage.created_at == created_at, AdminMessage.id < message_id),
+        ))
+    rows = (
+        query
+        .order_by(AdminMessage.created_at.desc(), AdminMessage.id.desc())
+        .limit(per_page + 1)
+        .all()
+    )
+    next_cursor = encode_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+    return rows[:per_page], next_cursor
+
+
+# ---------------------------------------------------------------------------
+# Unread counters
+# ---------------------------------------------------------------------------
+
+def get_counter(name: str) -> int:
+    """Return the current value of the named counter (0 when never set)."""
+    counter = db.session.get(InboxCounter, name)
+    return counter.value if counter else 0
+
+
+def adjust_counter(name: str, delta: int) -> None:
+    """Atomically add *delta* to the named counter, creating it if absent.
+
+    Uses ``UPDATE ... SET value = value + :delta`` so concurrent requests
+    never lose an increment.  The caller commits.
+    """
+    if not delta:
+        return
+    updated = (
+        InboxCounter.query
+        .filter_by(name=name)
+        .update({InboxCounter.value: InboxCounter.value + delta},
+                synchronize_session=False)
+    )
+    if not updated:
+        db.session.add(InboxCounter(name=name, value=max(delta, 0)))
+
+
+def mark_admin_message_read(message_id: int) -> None:
+    """Flag a message as read by an admin and decrement the admin badge.
+
+    The guarded UPDATE only matches an unread row, so two admins opening
+    the same message concurrently decrement the counter exactly once.
+    """
+    flipped = (
+        AdminMessage.query
+        .filter_by(id=message_id, is_read=False)
+        .update({AdminMessage.is_read: True}, synchronize_session='fetch')
+    )
+    adjust_counter(ADMIN_UNREAD_COUNTER, -flipped)
+
+
+def record_admin_response(message: AdminMessage) -> None:
+    """Count a new admin response as unread for the message's author."""
+    if message.response_is_read:
+        message.response_is_read = False
+        User.query.filter_by(id=message.user_id).update(
+            {User.unread_response_count: User.unread_response_count + 1},
+            synchronize_session='fetch',
+        )
+
+
+def mark_responses_read(user: User) -> None:
+    """Clear *user*'s unread-response badge once their inbox is opened."""
+    if not user.unread_response_count:
+        return
+    AdminMessage.query.filter_by(user_id=user.id, response_is_read=False).update(
+        {AdminMessage.response_is_read: True}, synchronize_session=False
+    )
+    user.unread_response_count = 0
@@ -0,0 +1,206 @@
+"""Password hashing on a bounded thread pool with an adaptive bcrypt cost.
+
+bcrypt is slow on purpose, and a login or registration spends most of its
+time inside it.  Every hash and check here runs on a small pool of
+``PASSWORD_HASH_WORKERS`` threads (bcrypt releases the GIL, so they hash
+in parallel).  A burst of logins therefore queues for those threads
+instead of taking every request thread and CPU core at once.  A caller
+that waits longer than ``PASSWORD_HASH_TIMEOUT`` seconds gets
+:class:`PasswordHasherBusy`, and :func:`pool_stats` reports how long
+callers have queued.
+
+The work factor is ``BCRYPT_LOG_ROUNDS``, pinned so every process hashes
+at the same cost.  When it is unset, :func:`init_app` picks the highest
+cost whose hash takes at most ``BCRYPT_TARGET_MS`` on this machine, but only
+under ``DEBUG``; elsewhere it falls back to 12 and warns, because processes
+on different CPUs would each choose their own.  A hash made at a lower cost
+is replaced on the user's next successful login (see ``User.authenticate``).
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import lru_cache
+
+from flask import current_app, has_app_context
+from flask_bcrypt import Bcrypt
+
+
+bcrypt = Bcrypt()
+
+# Bounds for the calibrated cost; each extra round doubles the work.
+MIN_LOG_ROUNDS = 10
+MAX_LOG_ROUNDS = 15
+
+# Used outside an application context (scripts, shells).
+_DEFAULTS = {
+    'BCRYPT_LOG_ROUNDS': 12,
+    'PASSWORD_HASH_WORKERS': 2,
+    'PASSWORD_HASH_TIMEOUT': 5.0,
+}
+
+
+class PasswordHasherBusy(RuntimeError):
+    """No hashing thread became free within ``PASSWORD_HASH_TIMEOUT``."""
+
+
+def _setting(key):
+    if has_app_context() and current_app.config.get(key) is not None:
+        return current_app.config[key]
+    return _DEFAULTS[key]
+
+
+# ---------------------------------------------------------------------------
+# Work factor
+# ---------------------------------------------------------------------------
+
+def _time_hash(rounds: int) -> float:
+    started = time.perf_counter()
+    bcrypt.generate_password_hash(b'calibration', rounds)
+    return time.perf_counter() - started
+
+
+@lru_cache(maxsize=None)
+def calibrate_rounds(target_ms: int, minimum=MIN_LOG_ROUNDS, maximum=MAX_LOG_ROUNDS) -> int:
+    """Highest cost in [*minimum*, *maximum*] that hashes within *target_ms* here.
+
+    Times the cheapest cost (best of three) and doubles from there, so
+    startup pays for three hashes at *minimum* rather than one at each cost.
+    """
+    elapsed = min(_time_hash(minimum) for _ in range(3))
+    rounds = minimum
+    while rounds < maximum and elapsed * 2 <= target_ms / 1000:
+        rounds += 1
+        elapsed *= 2
+    return rounds
+
+
+def hash_rounds(pw_hash: str) -> int | None:
+    """Cost a ``$2b$<cost>$...`` hash was made with, or ``None`` if unreadable."""
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(pw_hash: str) -> bool:
+    """True when *pw_hash* was made below the current ``BCRYPT_LOG_ROUNDS``.
+
+    A stronger hash is kept, so lowering the cost never weakens stored hashes.
+    """
+    rounds = hash_rounds(pw_hash)
+    return rounds is None or rounds < _setting('BCRYPT_LOG_ROUNDS')
+
+
+# ---------------------------------------------------------------------------
+# Bounded pool
+# ---------------------------------------------------------------------------
+
+class _PoolStats:
+    """Counters for the hashing pool, updated from caller and pool threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.submitted = self.started = self.completed = self.rejected = 0
+            self.wait_seconds_total = self.wait_seconds_max = 0.0
+            self.hash_seconds_total = 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'queued': self.submitted - self.started - self.rejected,
+                'running': self.started - self.completed,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'hash_seconds_total': self.hash_seconds_total,
+            }
+
+
+_stats = _PoolStats()
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool, _pool_size
+    workers = _setting('PASSWORD_HASH_WORKERS')
+    with _pool_lock:
+        if _pool is None or _pool_size != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+            _pool_size = workers
+        return _pool
+
+
+def _timed(fn, args, queued_at):
+    started = time.perf_counter()
+    wait = started - queued_at
+    with _stats._lock:
+        _stats.started += 1
+        _stats.wait_seconds_total += wait
+        _stats.wait_seconds_max = max(_stats.wait_seconds_max, wait)
+    try:
+        return fn(*args)
+    finally:
+        with _stats._lock:
+            _stats.completed += 1
+            _stats.hash_seconds_total += time.perf_counter() - started
+
+
+def _run(fn, *args):
+    timeout = _setting('PASSWORD_HASH_TIMEOUT')
+    executor = _executor()
+    with _stats._lock:
+        _stats.submitted += 1
+    future = executor.submit(_timed, fn, args, time.perf_counter())
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeout:
+        # Only a hash still waiting for a thread can be cancelled; one
+        # already running finishes and its result is discarded.
+        if future.cancel():
+            with _stats._lock:
+                _stats.rejected += 1
+        logging.warning("Password hashing pool busy: waited over %.1fs", timeout)
+        raise PasswordHasherBusy("Password hashing is busy; try again shortly") from None
+
+
+def hash_password(password: str) -> str:
+    """bcrypt hash of *password* at the current cost, made on the pool."""
+    rounds = _setting('BCRYPT_LOG_ROUNDS')
+    return _run(bcrypt.generate_password_hash, password, rounds).decode('UTF-8')
+
+
+def check_password(pw_hash: str, password: str) -> bool:
+    """Whether *password* matches *pw_hash*, checked on the pool."""
+    return _run(bcrypt.check_password_hash, pw_hash, password)
+
+
+def pool_stats() -> dict:
+    """Pool size plus queueing and hashing counters since start-up."""
+    return {'workers': _setting('PASSWORD_HASH_WORKERS'), **_stats.snapshot()}
+
+
+def init_app(app) -> None:
+    """Resolve an unset ``BCRYPT_LOG_ROUNDS``: calibrated under ``DEBUG``, else 12."""
+    if not app.config.get('BCRYPT_LOG_ROUNDS'):
+        if app.debug:
+            app.config['BCRYPT_LOG_ROUNDS'] = calibrate_rounds(app.config['BCRYPT_TARGET_MS'])
+            logging.info("bcrypt cost calibrated to %d for a %d ms target",
+                         app.config['BCRYPT_LOG_ROUNDS'], app.config['BCRYPT_TARGET_MS'])
+        else:
+            app.config['BCRYPT_LOG_ROUNDS'] = _DEFAULTS['BCRYPT_LOG_ROUNDS']
+            logging.warning("BCRYPT_LOG_ROUNDS is unset; hashing at cost %d. Pin it "
+                            "(calibrate_rounds() suggests one) so all processes agree.",
+                            app.config['BCRYPT_LOG_ROUNDS'])
+    if not app.config.get('PASSWORD_HASH_WORKERS'):
+        app.config['PASSWORD_HASH_WORKERS'] = max(1, (os.cpu_count() or 2) // 2)
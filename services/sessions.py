@@ -0,0 +1,326 @@
+"""Server-side sessions in Redis.
+
+The session cookie carries only ``<id>.<version>``: a random 192-bit id
+and a write counter.  The session data itself lives in Redis under
+``session:<id>`` for ``PERMANENT_SESSION_LIFETIME`` seconds of idleness.
+
+* **Lazy** — nothing is read until a view, hook or template touches
+  ``session``, so static files, thumbnails and heartbeats cost no round
+  trip.  Each process also keeps recently read sessions for
+  ``SESSION_LOCAL_CACHE_TTL`` seconds.  The cache is keyed by id *and*
+  version, so it never serves data older than the browser's cookie.
+* **Write-back** — Redis is written, and the cookie re-sent, only when the
+  session was modified.  Reads refresh the idle expiry with ``GETEX``.
+* **Revocable** — every logged-in session is indexed under
+  ``user_sessions:<user_id>``.  :func:`revoke_user_sessions` deletes them
+  all, so a ban signs the user out everywhere at once.  Processes that
+  cached one of those sessions keep serving it for at most
+  ``SESSION_LOCAL_CACHE_TTL`` seconds.
+
+If Redis cannot be reached, a modified session is saved as Flask's usual
+signed cookie, and such cookies are read back as before.  These fallback
+sessions are not revocable, so ``get_current_user`` never trusts account
+flags stored in them.  The next change made once Redis is back moves the
+session into Redis.
+"""
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from flask import current_app, has_request_context, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import (
+    SecureCookieSession,
+    SecureCookieSessionInterface,
+    SessionInterface,
+    SessionMixin,
+)
+
+from extensions import redis_pool
+
+
+_SESSION_KEY = 'session:{}'
+_USER_SESSIONS_KEY = 'user_sessions:{}'
+# Sessions kept per process by the local read cache.
+LOCAL_CACHE_SIZE = 1024
+
+_serializer = TaggedJSONSerializer()
+
+
+def _parse_cookie(value: str):
+    """``(sid, version)`` for a server-side session cookie, else ``None``."""
+    sid, sep, version = value.rpartition('.')
+    if sep and sid and '.' not in sid and version.isdigit():
+        return sid, int(version)
+    return None
+
+
+class ServerSession(SessionMixin):
+    """Session dict loaded from Redis the first time it is used."""
+
+    def __init__(self, interface, sid=None, version=0):
+        self.interface = interface
+        self.sid = sid
+        self.version = version
+        self._data = None if sid else {}
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        # Set when the store could not be read; the session then behaves as
+        # new and is saved as a signed cookie.
+        self.revocable = True
+        self.stale_cookie = False
+        self.loaded_user_id = None
+
+    @property
+    def data(self) -> dict:
+        self.accessed = True
+        if self._data is None:
+            self.interface.load(self)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"<ServerSession {self.sid!r} v{self.version}>"
+
+
+class RedisSessionInterface(SessionInterface):
+    """Flask session interface storing :class:`ServerSession` data in Redis."""
+
+    def __init__(self, client, local_ttl=5.0):
+        self.client = client
+        self.local_ttl = local_ttl
+        self._cookie = SecureCookieSessionInterface()
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    # -- local read cache -------------------------------------------------
+
+    def _local_get(self, sid, version):
+        with self._lock:
+            entry = self._local.get(sid)
+            if entry is None:
+                return None
+            cached_version, payload, cached_at = entry
+            if cached_version != version or time.monotonic() - cached_at > self.local_ttl:
+                return None
+            self._local.move_to_end(sid)
+            return payload
+
+    def _local_put(self, sid, version, payload):
+        with self._lock:
+            self._local[sid] = (version, payload, time.monotonic())
+            self._local.move_to_end(sid)
+            while len(self._local) > LOCAL_CACHE_SIZE:
+                self._local.popitem(last=False)
+
+    def _local_drop(self, *sids):
+        with self._lock:
+            for sid in sids:
+                self._local.pop(sid, None)
+
+    # -- load / store ------------------------------------------------------
+
+    def load(self, sess: ServerSession) -> None:
+        payload = self._local_get(sess.sid, sess.version)
+        if payload is None:
+            ttl = int(current_app.permanent_session_lifetime.total_seconds())
+            try:
+                payload = self.client.getex(_SESSION_KEY.format(sess.sid), ex=ttl)
+            except redis.RedisError as exc:
+                logging.warning("Session store unavailable, starting a fresh session: %s", exc)
+                sess.sid, sess._data, sess.new, sess.revocable = None, {}, True, False
+                return
+            if payload is None:
+                # Expired or revoked: start over and drop the dead cookie.
+                sess.sid, sess._data, sess.new, sess.stale_cookie = None, {}, True, True
+                return
+        stored = _serializer.loads(payload)
+        sess.version = stored['v']
+        sess._data = stored['d']
+        sess.loaded_user_id = sess._data.get('user_id')
+        self._local_put(sess.sid, sess.version, payload)
+
+    def _store(self, app, sess: ServerSession, data: dict):
+        """Write *data*; return the ``(sid, version)`` stored, or ``None`` if revoked."""
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        user_id = data.get('user_id')
+        # A new id whenever the logged-in user changes (e.g. on login)
+        # stops a planted session id from being carried into an account.
+        rotate = sess.sid is None or user_id != sess.loaded_user_id
+        if rotate:
+            sid, version = secrets.token_urlsafe(24), 1
+        else:
+            sid, version = sess.sid, sess.version + 1
+        payload = _serializer.dumps({'v': version, 'd': data})
+        pipe = self.client.pipeline(transaction=False)
+        if rotate:
+            pipe.set(_SESSION_KEY.format(sid), payload, ex=ttl, nx=True)
+            if sess.sid is not None:
+                pipe.delete(_SESSION_KEY.format(sess.sid))
+        else:
+            # XX: a session revoked while this request ran stays revoked.
+            pipe.set(_SESSION_KEY.format(sid), payload, ex=ttl, xx=True)
+        if user_id is not None:
+            pipe.sadd(_USER_SESSIONS_KEY.format(user_id), sid)
+            pipe.expire(_USER_SESSIONS_KEY.format(user_id), ttl)
+        if not pipe.execute()[0]:
+            self._local_drop(sid)
+            return None
+        if rotate and sess.sid is not None:
+            self._local_drop(sess.sid)
+        self._local_put(sid, version, payload)
+        return sid, version
+
+    # -- SessionInterface ----------------------------------------------------
+
+    def open_session(self, app, request):
+        value = request.cookies.get(self.get_cookie_name(app))
+        if value:
+            parsed = _parse_cookie(value)
+            if parsed:
+                return ServerSession(self, *parsed)
+            # A signed cookie from the fallback path or an older release.
+            cookie_session = self._cookie.open_session(app, request)
+            if cookie_session is not None:
+                cookie_session.revocable = False
+                return cookie_session
+        return ServerSession(self)
+
+    def save_session(self, app, sess, response):
+        if sess.accessed:
+            response.vary.add('Cookie')
+        if not isinstance(sess, ServerSession):
+            if sess.modified and self._migrate(app, sess, response):
+                return
+            self._cookie.save_session(app, sess, response)
+            return
+
+        if not sess.modified:
+            if sess.stale_cookie:
+                self._delete_cookie(app, response)
+            return
+        data = dict(sess._data)
+        if not data:
+            if sess.sid is not None:
+                try:
+                    self.client.delete(_SESSION_KEY.format(sess.sid))
+                except redis.RedisError as exc:
+                    logging.warning("Could not delete session: %s", exc)
+                self._local_drop(sess.sid)
+            if sess.sid is not None or sess.stale_cookie:
+                self._delete_cookie(app, response)
+            return
+        try:
+            stored = self._store(app, sess, data)
+        except redis.RedisError as exc:
+            logging.warning("Session store unavailable, using a signed cookie: %s", exc)
+            self._save_signed(app, data, response)
+            return
+        if stored is None:
+            self._delete_cookie(app, response)
+            return
+        self._set_cookie(app, sess, response, '%s.%d' % stored)
+
+    def _migrate(self, app, cookie_session, response) -> bool:
+        """Move a modified signed-cookie session into Redis if possible."""
+        sess = ServerSession(self)
+        sess._data = dict(cookie_session)
+        if not sess._data:
+            return False
+        try:
+            stored = self._store(app, sess, sess._data)
+        except redis.RedisError:
+            return False
+        self._set_cookie(app, sess, response, '%s.%d' % stored)
+        return True
+
+    def _save_signed(self, app, data, response):
+        data.pop('_ctx', None)
+        cookie_session = SecureCookieSession(data)
+        cookie_session.modified = True
+        self._cookie.save_session(app, cookie_session, response)
+
+    def _set_cookie(self, app, sess, response, value):
+        response.set_cookie(
+            self.get_cookie_name(app),
+            value,
+            expires=self.get_expiration_time(app, sess),
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def _delete_cookie(self, app, response):
+        response.delete_cookie(
+            self.get_cookie_name(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            httponly=self.get_cookie_httponly(app),
+        )
+
+    def revoke_user(self, user_id, keep=None) -> int:
+        """Delete every stored session of *user_id* except *keep*; return how many."""
+        key = _USER_SESSIONS_KEY.format(user_id)
+        sids = {sid.decode() if isinstance(sid, bytes) else sid
+                for sid in self.client.smembers(key)}
+        sids.discard(keep)
+        if sids:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.delete(*(_SESSION_KEY.format(sid) for sid in sids))
+            pipe.srem(key, *sids)
+            pipe.execute()
+            self._local_drop(*sids)
+        return len(sids)
+
+
+def revoke_user_sessions(user_id: int) -> int:
+    """Sign *user_id* out of every session; return how many were deleted.
+
+    When called from a request made by that same user, their current
+    session is kept and only its cached account flags are dropped.
+    """
+    interface = current_app.session_interface
+    if not isinstance(interface, RedisSessionInterface):
+        return 0
+    keep = None
+    if has_request_context() and isinstance(session, ServerSession) \
+            and session.get('user_id') == user_id:
+        keep = session.sid
+        session.pop('_ctx', None)
+    try:
+        return interface.revoke_user(user_id, keep=keep)
+    except redis.RedisError as exc:
+        logging.warning("Could not revoke sessions for user %s: %s", user_id, exc)
+        return 0
+
+
+def init_app(app) -> None:
+    """Store sessions in Redis unless ``SESSION_STORE`` is ``'cookie'``."""
+    if app.config['SESSION_STORE'] != 'redis':
+        return
+    app.session_interface = RedisSessionInterface(
+        redis_pool.client(app), local_ttl=app.config['SESSION_LOCAL_CACHE_TTL'])
@@ -0,0 +1,355 @@
+"""Storage backends for user-uploaded images.
+
+Uploads are addressed by *key* — the path relative to the uploads root,
+always ``/``-separated (e.g. ``ab/cd/abcd….jpg``).  Two drivers implement
+the same small interface:
+
+* :class:`LocalStorage` keeps files under ``static/uploads`` on this node's
+  disk and serves them from Flask, or hands them to nginx / Apache via
+  ``X-Accel-Redirect`` / ``X-Sendfile``.
+* :class:`S3Storage` keeps them in an S3-compatible bucket (AWS S3, MinIO,
+  Ceph, R2 …) so any number of web nodes can share one store.  Reads are
+  redirects to a presigned URL, or to ``S3_PUBLIC_URL`` when the bucket
+  sits behind a CDN.
+
+``UPLOAD_STORAGE`` selects the driver; :func:`get_upload_storage` returns
+the one configured for the current app, and :func:`get_staging_storage`
+the one raw uploads wait in for the image worker.
+"""
+import io
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from flask import abort, current_app, redirect, request, send_file
+from werkzeug.security import safe_join
+
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Raw uploads awaiting the image worker, below the S3 upload prefix.
+STAGING_PREFIX = '_staging/'
+
+# DeleteObjects accepts at most this many keys per request.
+_S3_DELETE_BATCH = 1000
+
+# One listed upload: storage key, size in bytes, last-modified epoch time.
+StoredObject = namedtuple('StoredObject', 'key size modified')
+
+
+def _mimetype(key: str) -> str:
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+def _etag(key: str) -> str:
+    # Upload names are content hashes (or legacy UUIDs) and are never
+    # reused for different bytes, so the name is a strong validator.
+    return os.path.splitext(key.rsplit('/', 1)[-1])[0]
+
+
+class LocalStorage:
+    """Uploads on the local filesystem below *root*."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str | None:
+        return safe_join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        path = self._path(key)
+        return path is not None and os.path.isfile(path)
+
+    def save(self, key: str, stream) -> None:
+        """Stream *stream* to *key*; readers never see a partial file."""
+        path = self._path(key)
+        if path is None:
+            raise ValueError(f"Invalid storage key {key!r}")
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, key: str):
+        """Binary file object reading *key*; ``FileNotFoundError`` if absent."""
+        path = self._path(key)
+        if path is None:
+            raise ValueError(f"Invalid storage key {key!r}")
+        return open(path, 'rb')
+
+    def delete_many(self, keys) -> None:
+        for key in keys:
+            path = self._path(key)
+            try:
+                if path is not None:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                logging.warning("Could not delete upload %r: %s", key, exc)
+
+    def iter_objects(self, prefix: str = ''):
+        """Yield a :class:`StoredObject` per file below *prefix*, lazily.
+
+        Directories are walked with ``os.scandir`` one at a time, so memory
+        stays flat however many uploads there are.
+        """
+        start = self._path(prefix.rstrip('/')) if prefix else self.root
+        if start is None:
+            return
+        stack = [(start, prefix.rstrip('/'))]
+        while stack:
+            directory, key_prefix = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    key = f"{key_prefix}/{entry.name}" if key_prefix else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, key))
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat()
+                            yield StoredObject(key, st.st_size, st.st_mtime)
+                    except FileNotFoundError:
+                        continue  # removed while listing
+
+    def move(self, src: str, dst: str) -> None:
+        """Rename *src* to *dst*; *dst*'s modified time becomes now."""
+        src_path, dst_path = self._path(src), self._path(dst)
+        if src_path is None or dst_path is None:
+            raise ValueError(f"Invalid storage key {src!r} or {dst!r}")
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        os.replace(src_path, dst_path)
+        os.utime(dst_path)
+
+    def send(self, key: str):
+        """Response serving *key* with immutable caching and a strong ETag."""
+        path = self._path(key)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        etag = _etag(key)
+
+        offload = current_app.config['UPLOAD_SENDFILE']
+        if offload not in ('x-accel-redirect', 'x-sendfile'):
+            # send_file answers If-None-Match / If-Modified-Since with 304
+            # and Range requests with 206.
+            response = send_file(path, conditional=True, etag=etag)
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+            return response
+
+        # The fronting server streams the bytes (and serves Range requests);
+        # this worker only answers revalidations and sets the headers.
+        response = current_app.response_class(mimetype=_mimetype(key))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response = response.make_conditional(request)
+        if response.status_code != 304:
+            if offload == 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = (
+                    current_app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] + key
+                )
+            else:
+                response.headers['X-Sendfile'] = path
+        return response
+
+
+class S3Storage:
+    """Uploads in an S3-compatible bucket, optionally under *prefix*.
+
+    ``boto3`` is only imported when the driver is first used, so
+    deployments on local storage do not need it installed.
+    """
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str | None = None,
+                 region: str | None = None, access_key: str | None = None,
+                 secret_key: str | None = None, presign_ttl: int = 3600,
+                 public_url: str | None = None, client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presign_ttl = presign_ttl
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self._client = client
+        self._client_kwargs = {
+            'endpoint_url': endpoint_url or None,
+            'region_name': region or None,
+            # Fall back to boto3's usual credential chain when unset.
+            'aws_access_key_id': access_key or None,
+            'aws_secret_access_key': secret_key or None,
+        }
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', **self._client_kwargs)
+        return self._client
+
+    def _object_key(self, key: str) -> str:
+        return self.prefix + key
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def save(self, key: str, stream) -> None:
+        """Stream *stream* to *key* (multipart for large bodies)."""
+        # The object carries the same caching headers the local driver sends,
+        # so clients following a redirect cache it just as long.
+        self.client.upload_fileobj(
+            stream, self.bucket, self._object_key(key),
+            ExtraArgs={'ContentType': _mimetype(key), 'CacheControl': IMMUTABLE_CACHE_CONTROL},
+        )
+
+    def open(self, key: str):
+        """Seekable copy of *key* in memory; ``FileNotFoundError`` if absent.
+
+        Only used for staged uploads, whose size ``MAX_CONTENT_LENGTH`` caps.
+        """
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(key) from exc
+            raise
+        return io.BytesIO(response['Body'].read())
+
+    def delete_many(self, keys) -> None:
+        keys = [self._object_key(k) for k in keys]
+        for start in range(0, len(keys), _S3_DELETE_BATCH):
+            batch = keys[start:start + _S3_DELETE_BATCH]
+            try:
+                result = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True},
+                )
+            except Exception as exc:
+                logging.warning("Could not delete %d uploads: %s", len(batch), exc)
+                continue
+            for error in result.get('Errors', []):
+                logging.warning("Could not delete upload %r: %s",
+                                error.get('Key'), error.get('Message'))
+
+    def iter_objects(self, prefix: str = ''):
+        """Yield a :class:`StoredObject` per object below *prefix*, page by page."""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix)):
+            for obj in page.get('Contents', []):
+                yield StoredObject(
+                    obj['Key'][len(self.prefix):], obj['Size'], obj['LastModified'].timestamp()
+                )
+
+    def move(self, src: str, dst: str) -> None:
+        """Copy *src* to *dst* server-side, then delete *src*."""
+        # The copy gets a fresh LastModified, which dates the move.
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=self._object_key(dst),
+            CopySource={'Bucket': self.bucket, 'Key': self._object_key(src)},
+        )
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(src))
+
+    def send(self, key: str):
+        """Redirect to the object; the bytes never pass through this worker."""
+        if self.public_url:
+            response = redirect(f"{self.public_url}/{self._object_key(key)}")
+            # The target never changes for a given upload name.
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+            return response
+        url = self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self._object_key(key)},
+            ExpiresIn=self.presign_ttl,
+        )
+        response = redirect(url)
+        # Let browsers reuse the redirect while the signature is still valid.
+        response.headers['Cache-Control'] = f'private, max-age={self.presign_ttl // 2}'
+        return response
+
+
+def upload_origin(config) -> str | None:
+    """Origin upload reads redirect to, for the CSP ``img-src`` list.
+
+    ``None`` for local storage, which is served from our own origin.
+    """
+    if config['UPLOAD_STORAGE'] != 's3':
+        return None
+    base = config['S3_PUBLIC_URL'] or config['S3_ENDPOINT_URL']
+    if not base:
+        # AWS presigned URLs use a bucket- or region-specific host.
+        return 'https://*.amazonaws.com'
+    parts = urlsplit(base)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _s3_storage(config, prefix: str) -> S3Storage:
+    return S3Storage(
+        bucket=config['S3_BUCKET'],
+        prefix=prefix,
+        endpoint_url=config['S3_ENDPOINT_URL'],
+        region=config['S3_REGION'],
+        access_key=config['S3_ACCESS_KEY_ID'],
+        secret_key=config['S3_SECRET_ACCESS_KEY'],
+        presign_ttl=config['S3_PRESIGN_TTL'],
+        public_url=config['S3_PUBLIC_URL'],
+    )
+
+
+def create_upload_storage(app):
+    """Build the driver selected by ``app.config['UPLOAD_STORAGE']``."""
+    config = app.config
+    if config['UPLOAD_STORAGE'] == 's3':
+        return _s3_storage(config, config['S3_PREFIX'])
+    return LocalStorage(os.path.join(app.root_path, config['UPLOADED_PHOTOS_DEST']))
+
+
+def create_staging_storage(app):
+    """Build the driver raw uploads are staged in until the image worker runs.
+
+    On S3 that is the upload bucket under :data:`STAGING_PREFIX`, so a
+    worker on any node reads what any web node staged.  Local storage uses
+    ``UPLOAD_STAGING_DEST``, outside the served ``static/`` tree; with
+    several nodes it must sit on the same shared disk as the uploads.
+    """
+    config = app.config
+    if config['UPLOAD_STORAGE'] == 's3':
+        return _s3_storage(config, config['S3_PREFIX'] + STAGING_PREFIX)
+    return LocalStorage(config['UPLOAD_STAGING_DEST'])
+
+
+def get_upload_storage():
+    """Return the current app's upload storage driver, creating it once."""
+    app = current_app._get_current_object()
+    storage = app.extensions.get('upload_storage')
+    if storage is None:
+        storage = app.extensions['upload_storage'] = create_upload_storage(app)
+    return storage
+
+
+def get_staging_storage():
+    """Return the current app's staging driver, creating it once."""
+    app = current_app._get_current_object()
+    storage = app.extensions.get('upload_staging_storage')
+    if storage is None:
+        storage = app.extensions['upload_staging_storage'] = create_staging_storage(app)
+    return storage
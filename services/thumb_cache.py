@@ -0,0 +1,176 @@
+"""Local caching proxy for TheCocktailDB drink thumbnails.
+
+API cocktails store ``strDrinkThumb`` as an absolute URL on
+``www.thecocktaildb.com``.  Instead of every browser fetching those from
+the third-party CDN, pages point at the ``cocktails.remote_thumb`` route,
+which serves a copy from local disk with long-lived cache headers.
+
+On a miss the route redirects to the upstream image (so the page still
+renders immediately) and queues :func:`fetch_thumb` to download it in the
+background; every later view is served locally.  Cached files live under
+``THUMB_CACHE_DIR`` in two levels of hash-prefix directories so no single
+directory grows large.  :func:`prune_thumb_cache` keeps the total size
+under ``THUMB_CACHE_MAX_BYTES`` by evicting the least-recently-served
+files (recency is tracked through each file's mtime).
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+import requests
+from flask import current_app, url_for
+
+from extensions import cache, celery
+
+
+UPSTREAM_ORIGIN = 'https://www.thecocktaildb.com'
+_UPSTREAM_PREFIX = f'{UPSTREAM_ORIGIN}/images/'
+
+# Only drink thumbnails and their pre-scaled renditions are proxied, so the
+# route can never be used to make the server fetch an arbitrary URL.
+_THUMB_PATH = re.compile(
+    r'^media/drink/[A-Za-z0-9_-]+\.(jpe?g|png)(?:/(?:preview|small|medium|large))?$'
+)
+
+_FETCH_TIMEOUT = (5, 10)
+# Upstream thumbnails are well under this; anything larger is not cached.
+_MAX_THUMB_BYTES = 2 * 1024 * 1024
+# Refresh a hit's mtime at most this often, to avoid a write per request.
+_TOUCH_INTERVAL = 60 * 60
+# Evict down to this fraction of the limit so pruning is not re-triggered
+# by the very next fetch.
+_PRUNE_TARGET = 0.9
+
+
+def is_thumb_path(path: str) -> bool:
+    return bool(_THUMB_PATH.match(path or ''))
+
+
+def thumb_mimetype(path: str) -> str:
+    return 'image/png' if _THUMB_PATH.match(path).group(1) == 'png' else 'image/jpeg'
+
+
+def upstream_url(path: str) -> str:
+    return _UPSTREAM_PREFIX + path
+
+
+def proxied_thumb_url(url: str) -> str:
+    """Return the local proxy URL for an upstream thumbnail, else *url*."""
+    if url.startswith(_UPSTREAM_PREFIX):
+        path = url[len(_UPSTREAM_PREFIX):]
+        if is_thumb_path(path):
+            return url_for('cocktails.remote_thumb', path=path)
+    return url
+
+
+def _cache_file(path: str) -> str:
+    digest = hashlib.sha256(path.encode()).hexdigest()
+    return os.path.join(
+        current_app.config['THUMB_CACHE_DIR'], digest[:2], digest[2:4], digest
+    )
+
+
+def cached_thumb(path: str) -> str | None:
+    """Return the on-disk copy of *path* if cached, marking it recently used."""
+    cache_file = _cache_file(path)
+    try:
+        mtime = os.stat(cache_file).st_mtime
+    except OSError:
+        return None
+    if time.time() - mtime > _TOUCH_INTERVAL:
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+    return cache_file
+
+
+def request_thumb_fetch(path: str) -> None:
+    """Queue a background download of *path*, at most once per minute."""
+    try:
+        # cache.add is atomic in Redis: only the first miss enqueues.
+        if not cache.add(f'thumb_fetch:{path}', 1, timeout=60):
+            return
+    except Exception as exc:
+        logging.debug("Thumbnail fetch de-duplication unavailable: %s", exc)
+    try:
+        fetch_thumb.apply_async((path,), retry=False)
+    except Exception as exc:
+        # The miss is already served by the upstream redirect.
+        logging.warning("Could not queue thumbnail fetch for %r: %s", path, exc)
+
+
+# The miss is already served by a redirect, so pacing the downloads (per
+# worker) only delays caching and keeps us polite to the upstream CDN.
+# While the broker is down the download runs in-process (task_fallback.py).
+@celery.task(name='thumb_cache.fetch_thumb', ignore_result=True, rate_limit='20/s',
+             broker_fallback='local')
+def fetch_thumb(path: str) -> None:
+    """Download one upstream thumbnail into the on-disk cache."""
+    if not is_thumb_path(path):
+        return
+    cache_file = _cache_file(path)
+    if os.path.exists(cache_file):
+        return
+    try:
+        with requests.get(upstream_url(path), timeout=_FETCH_TIMEOUT, stream=True) as resp:
+            resp.raise_for_status()
+            if not resp.headers.get('Content-Type', '').startswith('image/'):
+                logging.warning("Upstream thumbnail %r is not an image", path)
+                return
+            data = resp.raw.read(_MAX_THUMB_BYTES + 1, decode_content=True)
+    except requests.RequestException as exc:
+        logging.warning("Could not fetch thumbnail %r: %s", path, exc)
+        return
+    if len(data) > _MAX_THUMB_BYTES:
+        logging.warning("Upstream thumbnail %r exceeds %d bytes", path, _MAX_THUMB_BYTES)
+        return
+    directory = os.path.dirname(cache_file)
+    os.makedirs(directory, exist_ok=True)
+    # Write then rename so a reader never sees a partial file.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@celery.task(name='thumb_cache.prune_thumb_cache', ignore_result=True)
+def prune_thumb_cache() -> int:
+    """Evict least-recently-served thumbnails until under the size limit.
+
+    Returns the number of bytes freed.
+    """
+    root = current_app.config['THUMB_CACHE_DIR']
+    limit = current_app.config['THUMB_CACHE_MAX_BYTES']
+    entries, total = [], 0
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+            total += st.st_size
+    if total <= limit:
+        return 0
+    freed = 0
+    target = limit * _PRUNE_TARGET
+    for _mtime, size, full in sorted(entries):
+        if total - freed <= target:
+            break
+        try:
+            os.remove(full)
+            freed += size
+        except OSError:
+            continue
+    logging.info("Pruned %d bytes from the thumbnail cache", freed)
+    return freed
@@ -0,0 +1,141 @@
+"""Garbage collector for uploaded images nothing refers to any more.
+
+Normal deletes release uploads through ``delete_uploaded_image``, but a
+failed commit after an upload was stored, a crashed worker, or rows removed
+by a database cascade can leave files in storage that no row names.
+:func:`collect_orphaned_uploads` finds and removes them in two phases:
+
+1. Listed files older than *min_age* (so uploads whose transaction is
+   still in flight are never touched) are checked against the database in
+   batches; unreferenced ones are moved under ``_quarantine/``.
+2. Every run moves a quarantined file back as soon as a row refers to it
+   again, and deletes unreferenced ones older than *quarantine_for*.
+
+Storage is listed lazily and each batch is resolved with one indexed
+``IN`` query, so memory use is bounded by *batch_size* however many
+uploads exist.
+"""
+import logging
+import re
+import time
+from itertools import islice
+
+from sqlalchemy import select, union
+
+from extensions import celery
+from models import db, Cocktail, UploadBlob
+from services.cocktail_service import upload_relpath
+from services.storage import STAGING_PREFIX, get_upload_storage
+
+
+QUARANTINE_PREFIX = '_quarantine/'
+
+# Extensions an original upload can have; variants carry their own.
+_ORIGINAL_EXTS = ('jpg', 'jpeg', 'png')
+_VARIANT_SUFFIX = re.compile(r'-\d+w$')
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _dirname(key: str) -> str:
+    return key.rsplit('/', 1)[0] if '/' in key else ''
+
+
+def _referenced_keys(keys) -> set[str]:
+    """Return the subset of storage *keys* some row still refers to.
+
+    A variant (``<stem>-320w.webp``) counts as referenced when its original
+    is.  A file only counts when it sits where :func:`upload_relpath` puts
+    that name; a stray copy elsewhere is an orphan.
+    """
+    dependants = {}
+    for key in keys:
+        stem = key.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        base = _VARIANT_SUFFIX.sub('', stem)
+        for ext in _ORIGINAL_EXTS:
+            dependants.setdefault(f"{base}.{ext}", []).append(key)
+    if not dependants:
+        return set()
+    names = list(dependants)
+    query = union(
+        select(UploadBlob.filename).where(UploadBlob.filename.in_(names)),
+        select(Cocktail.image_url).where(Cocktail.image_url.in_(names)),
+        # Legacy user edits stored the upload name in strDrinkThumb.
+        select(Cocktail.strDrinkThumb).where(Cocktail.strDrinkThumb.in_(names)),
+    )
+    referenced = set()
+    for (name,) in db.session.execute(query):
+        directory = _dirname(upload_relpath(name))
+        referenced.update(k for k in dependants[name] if _dirname(k) == directory)
+    return referenced
+
+
+@celery.task(name='upload_gc.collect_orphaned_uploads', ignore_result=True)
+def collect_orphaned_uploads(batch_size=500, min_age=60 * 60,
+                             quarantine_for=7 * 24 * 60 * 60) -> dict:
+    """Quarantine unreferenced uploads and delete expired quarantined ones.
+
+    Returns a report with the number of files quarantined, deleted and
+    restored, and the bytes quarantined and reclaimed.
+    """
+    storage = get_upload_storage()
+    now = time.time()
+    report = {'quarantined': 0, 'quarantined_bytes': 0,
+              'deleted': 0, 'reclaimed_bytes': 0, 'restored': 0}
+
+    # Phase 2 first, so files quarantined by this run get their full window.
+    # Every quarantined file is checked whatever its age, so one a row refers
+    # to again is restored on the next run rather than after the window.
+    for batch in _batches(storage.iter_objects(QUARANTINE_PREFIX), batch_size):
+        quarantined = {obj.key[len(QUARANTINE_PREFIX):]: obj for obj in batch}
+        referenced = _referenced_keys(quarantined)
+        expired = []
+        for key, obj in quarantined.items():
+            if key in referenced:
+                if not storage.exists(key):
+                    try:
+                        storage.move(obj.key, key)
+                    except Exception as exc:
+                        logging.warning("Could not restore upload %r: %s", key, exc)
+                        continue
+                    report['restored'] += 1
+                    logging.warning("Restored quarantined upload %r: it is referenced again", key)
+                    continue
+                # The upload was stored again; this copy is a spare and
+                # expires like an unreferenced one.
+            if now - obj.modified >= quarantine_for:
+                expired.append(obj)
+        storage.delete_many([obj.key for obj in expired])
+        report['deleted'] += len(expired)
+        report['reclaimed_bytes'] += sum(obj.size for obj in expired)
+        db.session.rollback()  # end the read transaction between batches
+
+    # Staged raw uploads (in the bucket on S3) belong to the image worker.
+    live = (obj for obj in storage.iter_objects()
+            if not obj.key.startswith((QUARANTINE_PREFIX, STAGING_PREFIX)))
+    for batch in _batches(live, batch_size):
+        candidates = [obj for obj in batch if now - obj.modified >= min_age]
+        referenced = _referenced_keys(obj.key for obj in candidates)
+        for obj in candidates:
+            if obj.key in referenced:
+                continue
+            try:
+                storage.move(obj.key, QUARANTINE_PREFIX + obj.key)
+            except Exception as exc:
+                logging.warning("Could not quarantine upload %r: %s", obj.key, exc)
+                continue
+            report['quarantined'] += 1
+            report['quarantined_bytes'] += obj.size
+        db.session.rollback()
+
+    if report['quarantined'] or report['deleted'] or report['restored']:
+        logging.info(
+            "Upload GC: quarantined %(quarantined)d files (%(quarantined_bytes)d bytes), "
+            "deleted %(deleted)d (%(reclaimed_bytes)d bytes reclaimed), "
+            "restored %(restored)d", report,
+        )
+    return report
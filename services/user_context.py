@@ -0,0 +1,135 @@
+"""Request-scoped current-user context.
+
+Most requests only need a handful of account flags — is the user an admin,
+banned, verified?  Instead of every hook, decorator and view calling
+``db.session.get(User, ...)`` on its own, :func:`get_current_user` loads
+those flags once per request into ``g.current_user``.  The flags are also
+kept in the user's server-side session (``_ctx``), or cached in Redis for
+a short TTL when the session is a signed cookie, so a typical
+authenticated request does no user lookup in the database at all.
+
+Any route that changes one of the cached flags must call
+:func:`invalidate_user_context` after committing.  That drops the cached
+copy and revokes the user's other sessions, so the change applies at once
+everywhere rather than when a TTL expires.
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from flask import current_app, g, session
+
+from extensions import cache
+from models import db, User
+from services.sessions import revoke_user_sessions
+
+
+_CACHE_KEY = 'user_ctx:{}'
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """Snapshot of the account flags hooks and decorators need."""
+    id: int
+    username: str
+    is_admin: bool
+    is_permanently_banned: bool
+    ban_until: datetime | None
+    is_email_verified: bool
+
+    @classmethod
+    def from_model(cls, user: User) -> 'CurrentUser':
+        return cls(
+            id=user.id,
+            username=user.username,
+            is_admin=bool(user.is_admin),
+            is_permanently_banned=bool(user.is_permanently_banned),
+            ban_until=user.ban_until,
+            is_email_verified=bool(user.is_email_verified),
+        )
+
+    def to_session(self) -> dict:
+        return {**self.__dict__,
+                'ban_until': self.ban_until.isoformat() if self.ban_until else None}
+
+    @classmethod
+    def from_session(cls, data: dict) -> 'CurrentUser':
+        ban_until = data['ban_until']
+        return cls(**{**data,
+                      'ban_until': datetime.fromisoformat(ban_until) if ban_until else None})
+
+    @property
+    def is_temporarily_banned(self) -> bool:
+        # Evaluated at read time, so an expired ban needs no invalidation.
+        return bool(
+            self.ban_until
+            and self.ban_until > datetime.now(timezone.utc).replace(tzinfo=None)
+        )
+
+
+def _cache_get(user_id: int) -> dict | None:
+    try:
+        return cache.get(_CACHE_KEY.format(user_id))
+    except Exception as exc:
+        # A cache outage must never break authentication; fall back to the DB.
+        logging.debug("User-context cache read failed: %s", exc)
+        return None
+
+
+def _cache_set(user_id: int, ctx: CurrentUser) -> None:
+    try:
+        cache.set(
+            _CACHE_KEY.format(user_id),
+            ctx.__dict__.copy(),
+            timeout=current_app.config['USER_CONTEXT_CACHE_TTL'],
+        )
+    except Exception as exc:
+        logging.debug("User-context cache write failed: %s", exc)
+
+
+def get_current_user() -> CurrentUser | None:
+    """Return the logged-in user's flags, loading them at most once per request.
+
+    Returns ``None`` for anonymous requests and for sessions whose user no
+    longer exists.
+    """
+    if 'current_user' in g:
+        return g.current_user
+    ctx = None
+    user_id = session.get('user_id')
+    # Only a server-side session is revoked when the flags change, so only
+    # its copy can be trusted; signed-cookie sessions use the Redis cache.
+    revocable = getattr(session, 'revocable', False)
+    if user_id:
+        stored = session.get('_ctx') if revocable else None
+        if stored is not None and stored['id'] == user_id:
+            ctx = CurrentUser.from_session(stored)
+        else:
+            cached = _cache_get(user_id)
+            if cached is not None:
+                ctx = CurrentUser(**cached)
+            else:
+                user = db.session.get(User, user_id)
+                if user:
+                    ctx = CurrentUser.from_model(user)
+                    _cache_set(user_id, ctx)
+            if ctx is not None and revocable:
+                session['_ctx'] = ctx.to_session()
+    g.current_user = ctx
+    return ctx
+
+
+def invalidate_user_context(user_id: int) -> None:
+    """Drop the cached flags for *user_id* after they change in the DB.
+
+    The user's sessions carry a copy of the flags, so they are revoked as
+    well; a user changing their own flags keeps the current session.
+    """
+    try:
+        cache.delete(_CACHE_KEY.format(user_id))
+    except Exception as exc:
+        logging.warning("Could not invalidate user context for %s: %s", user_id, exc)
+    revoke_user_sessions(user_id)
+    # Keep this request's view consistent too when acting on oneself.
+    if g.get('current_user') is not None and g.current_user.id == user_id:
+        g.pop('current_user')
@@ -0,0 +1,146 @@
+"""Celery publishing that degrades instead of blocking while Redis is down.
+
+``apply_async`` normally hands a task to the Redis broker.  Publishing
+goes through kombu rather than the shared pool, so :class:`FallbackTask`
+reports each publish to the pool's :class:`~redis_pool.CircuitBreaker`
+and, while the breaker is open, does not try the broker at all.  What
+happens to the task then depends on its ``broker_fallback`` option:
+
+* ``'local'`` — it runs on a per-process pool of ``CELERY_LOCAL_WORKERS``
+  threads.  When ``CELERY_LOCAL_BACKLOG`` tasks are already waiting it is
+  dropped with a warning, so an outage cannot pile up unbounded work in a
+  web process.  Meant for best-effort work such as thumbnail downloads.
+* ``None`` (the default) — the publish error is raised and the caller
+  decides: staged images are processed inline, and broadcasts go back to
+  ``queued`` in the database for the next dispatcher run.  Emails never
+  need the broker from a request; they wait in the DB outbox.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from flask import current_app, has_app_context
+from kombu.exceptions import OperationalError
+
+import metrics
+from extensions import redis_pool
+
+
+# Used outside an application context (scripts, shells).
+_DEFAULTS = {'CELERY_LOCAL_WORKERS': 2, 'CELERY_LOCAL_BACKLOG': 100}
+
+BROKER_ERRORS = (OperationalError, redis.RedisError, OSError)
+
+
+def _setting(key):
+    if has_app_context() and current_app.config.get(key) is not None:
+        return current_app.config[key]
+    return _DEFAULTS[key]
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.published = self.publish_errors = 0
+            self.run_locally = self.dropped = self.pending = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, delta in counts.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'published': self.published,
+                'publish_errors': self.publish_errors,
+                'run_locally': self.run_locally,
+                'dropped': self.dropped,
+                'pending': self.pending,
+            }
+
+
+_stats = _Stats()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=_setting('CELERY_LOCAL_WORKERS'),
+                                       thread_name_prefix='celery-local')
+        return _pool
+
+
+def _run_local(task, args, kwargs):
+    try:
+        task(*args, **kwargs)
+    except Exception:
+        logging.exception("Local fallback run of %s failed", task.name)
+    finally:
+        _stats.add(pending=-1)
+
+
+def submit_local(task, args=(), kwargs=None) -> bool:
+    """Run *task* on the local pool; False if the backlog is full and it was dropped."""
+    with _stats._lock:
+        if _stats.pending >= _setting('CELERY_LOCAL_BACKLOG'):
+            _stats.dropped += 1
+            full = True
+        else:
+            _stats.pending += 1
+            _stats.run_locally += 1
+            full = False
+    if full:
+        logging.warning("Local task backlog full; dropping %s", task.name)
+        return False
+    _executor().submit(_run_local, task, tuple(args or ()), dict(kwargs or {}))
+    return True
+
+
+class FallbackTask:
+    """Task mixin: publish through the breaker, falling back per ``broker_fallback``."""
+
+    broker_fallback = None
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        breaker = redis_pool.breaker()
+        started = time.perf_counter()
+        if breaker is not None and not breaker.allow():
+            error = OperationalError("Redis marked unavailable; waiting to reconnect")
+            outcome = 'skipped'
+        else:
+            try:
+                result = super().apply_async(args, kwargs, **options)
+            except BROKER_ERRORS as exc:
+                if breaker is not None:
+                    breaker.record_failure()
+                error, outcome = exc, 'error'
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                _stats.add(published=1)
+                metrics.CELERY_ENQUEUE_LATENCY.labels(self.name, 'published').observe(
+                    time.perf_counter() - started)
+                return result
+        metrics.CELERY_ENQUEUE_LATENCY.labels(self.name, outcome).observe(
+            time.perf_counter() - started)
+        _stats.add(publish_errors=1)
+        if self.broker_fallback != 'local':
+            raise error
+        logging.info("Broker unavailable, running %s in-process: %s", self.name, error)
+        submit_local(self, args, kwargs)
+        return None
+
+
+def stats() -> dict:
+    """Publish outcomes and local fallback counters for this process."""
+    return {'workers': _setting('CELERY_LOCAL_WORKERS'), **_stats.snapshot()}
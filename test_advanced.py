@@ -21,19 +21,47 @@ Covers 20 distinct test classes that exercise:
   - Image-upload edge cases (BMP, wrong extension, zero-byte)
   - delete_uploaded_image path-traversal guard
   - Homepage redirect logic
+  - Keyset-paginated inboxes and O(1) unread counters
+  - Reference-counted shared API cocktails and the orphan collector
+  - Copy-on-write personal variants of API cocktails
+  - Request-scoped, Redis-cached current-user context
+  - Shared moving-window rate limits, local flood pre-check, in-memory fallback
+  - Background (staged) re-encoding of uploaded images
+  - Responsive WebP/JPEG image variants and srcset data
+  - Local caching proxy for TheCocktailDB thumbnails
+  - Content-addressed, reference-counted upload storage
+  - Immutable caching and sendfile offload when serving uploads
+  - Pluggable local / S3-compatible upload storage backends
+  - Orphaned-upload garbage collector with quarantine
+  - Streaming upload validation and JPEG draft-mode decoding
+  - Transactional email outbox and its SMTP relay
+  - Admin broadcasts with chunked background fan-out
+  - Beat maintenance jobs: expired bans, unverified accounts, appeal archive
+  - Celery queue routing, rate limits and per-queue worker profiles
+  - Adaptive bcrypt cost, rehash on login and the bounded hashing pool
+  - Server-side Redis sessions: lazy loads, write-back, revocation, fallback
+  - One shared, bounded Redis connection pool for every Redis consumer
+  - Redis outage handling: circuit breaker, failover cache, task fallback
+  - Server-Timing header and timing log line for sampled requests
+  - Prometheus /metrics: latency, DB pool, cache ratio, CocktailDB, Celery
+  - Per-route query budgets and N+1 checks against a seeded dataset
 """
 
 import io
+import os
+import shutil
+import tempfile
 import unittest
 from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
 
 from app import app
-from extensions import limiter
+from extensions import limiter, flood_guard
 from models import (
     db, User, Ingredient, Cocktail, Cocktails_Users,
     Cocktails_Ingredients, UserFavoriteIngredients,
-    AdminMessage, UserAppeal, AdminAuditLog,
+    AdminMessage, UserAppeal, AdminAuditLog, InboxCounter, UploadBlob,
+    EmailOutbox, Broadcast, BroadcastDelivery, UserAppealArchive,
 )
 
 
@@ -1201,5 +1229,2699 @@ class HomepageTests(_BaseSuite):
         self.assertIn(b"Cocktail Chronicles", resp.data)
 
 
+# ===========================================================================
+# 21. Keyset-Paginated Inboxes and Unread Counters
+# ===========================================================================
+
+class MessageInboxPaginationTests(_BaseSuite):
+
+    def _seed_messages(self, user_id, count):
+        base = datetime(2026, 1, 1)
+        for i in range(count):
+            db.session.add(AdminMessage(
+                user_id=user_id, subject=f"Subject {i:03d}",
+                message="A sufficiently long message body.",
+                created_at=base + timedelta(minutes=i),
+            ))
+        db.session.commit()
+
+    def test_pages_walk_every_message_once_newest_first(self):
+        from services.message_service import paginate_messages
+        with app.app_context():
+            user = _make_user()
+            self._seed_messages(user.id, 7)
+            seen, cursor = [], None
+            while True:
+                page, cursor = paginate_messages(AdminMessage.query, cursor, 3)
+                seen.extend(m.subject for m in page)
+                if not cursor:
+                    break
+            self.assertEqual(seen, [f"Subject {i:03d}" for i in range(6, -1, -1)])
+
+    def test_equal_timestamps_are_ordered_by_id(self):
+        from services.message_service import paginate_messages
+        with app.app_context():
+            user = _make_user()
+            stamp = datetime(2026, 1, 1)
+            for i in range(4):
+                db.session.add(AdminMessage(user_id=user.id, subject=f"S{i}",
+                                            message="x" * 20, created_at=stamp))
+            db.session.commit()
+            first, cursor = paginate_messages(AdminMessage.query, None, 2)
+            second, cursor = paginate_messages(AdminMessage.query, cursor, 2)
+            ids = [m.id for m in first + second]
+            self.assertEqual(ids, sorted(ids, reverse=True))
+            self.assertEqual(len(set(ids)), 4)
+            self.assertIsNone(cursor)
+
+    def test_malformed_cursor_restarts_from_first_page(self):
+        with app.app_context():
+            admin = _make_user(username="pgadm", email="pgadm@example.com", is_admin=True)
+            admin_id = admin.id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = admin_id
+        resp = self.client.get("/admin/messages?cursor=not-a-cursor!!")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_user_thread_shows_older_link_when_more_pages(self):
+        with app.app_context():
+            user = _make_user()
+            uid = user.id
+            self._seed_messages(uid, app.config["MESSAGES_PER_PAGE"] + 1)
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        resp = self.client.get("/user/messages")
+        self.assertIn(b"Older messages", resp.data)
+
+    def test_admin_unread_counter_tracks_send_and_open(self):
+        from services.message_service import ADMIN_UNREAD_COUNTER, get_counter
+        with app.app_context():
+            user = _make_user()
+            admin = _make_user(username="cntadm", email="cntadm@example.com", is_admin=True)
+            uid, admin_id = user.id, admin.id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        for _ in range(2):
+            self.client.post("/user/send-message", data={
+                "message_type": "suggestion",
+                "subject": "Valid subject line",
+                "message": "This is a sufficiently long message body for testing.",
+            })
+        with app.app_context():
+            self.assertEqual(get_counter(ADMIN_UNREAD_COUNTER), 2)
+            message_id = AdminMessage.query.first().id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = admin_id
+        # Opening the same message twice must only decrement once.
+        self.client.get(f"/admin/message/{message_id}/respond")
+        self.client.get(f"/admin/message/{message_id}/respond")
+        with app.app_context():
+            self.assertEqual(get_counter(ADMIN_UNREAD_COUNTER), 1)
+            self.assertEqual(db.session.get(InboxCounter, ADMIN_UNREAD_COUNTER).value, 1)
+
+    def test_user_unread_response_count_cleared_on_inbox_visit(self):
+        with app.app_context():
+            user = _make_user()
+            admin = _make_user(username="rspadm", email="rspadm@example.com", is_admin=True)
+            uid, admin_id = user.id, admin.id
+            self._seed_messages(uid, 1)
+            message_id = AdminMessage.query.first().id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = admin_id
+        self.client.post(f"/admin/message/{message_id}/respond",
+                         data={"message": "Thanks, we will look into it."})
+        with app.app_context():
+            self.assertEqual(db.session.get(User, uid).unread_response_count, 1)
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        self.client.get("/user/messages")
+        with app.app_context():
+            self.assertEqual(db.session.get(User, uid).unread_response_count, 0)
+            self.assertTrue(db.session.get(AdminMessage, message_id).response_is_read)
+
+
+# ===========================================================================
+# 22. Reference-Counted Shared API Cocktails
+# ===========================================================================
+
+class CocktailRefCountTests(_BaseSuite):
+
+    API_DATA = {
+        "idDrink": "77777",
+        "strDrink": "Refcount Sour",
+        "strInstructions": "Shake.",
+        "strDrinkThumb": None,
+        "strIngredient1": "Gin",
+        "strMeasure1": "2 oz",
+    }
+
+    def _add_for_users(self, *names):
+        from services.cocktail_service import process_and_store_new_cocktail
+        ids = []
+        for name in names:
+            user = _make_user(username=name, email=f"{name}@example.com")
+            process_and_store_new_cocktail(self.API_DATA, user.id)
+            ids.append(user.id)
+        cocktail = Cocktail.query.filter_by(api_cocktail_id="77777").one()
+        return ids, cocktail.id
+
+    def test_ref_count_tracks_each_linking_user(self):
+        with app.app_context():
+            _, cid = self._add_for_users("rc1", "rc2")
+            self.assertEqual(db.session.get(Cocktail, cid).ref_count, 2)
+
+    def test_delete_leaves_unreferenced_api_row_for_collector(self):
+        with app.app_context():
+            (uid,), cid = self._add_for_users("rcdel")
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        self.client.post(f"/delete-cocktail/{cid}", follow_redirects=True)
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertIsNotNone(cocktail)
+            self.assertEqual(cocktail.ref_count, 0)
+            self.assertIsNone(Cocktails_Users.query.filter_by(user_id=uid).first())
+
+    def test_collector_removes_orphans_and_their_ingredients(self):
+        from services.cocktail_service import collect_orphaned_api_cocktails
+        with app.app_context():
+            _, cid = self._add_for_users("rcgc")
+            keep = Cocktail(name="Still Linked", is_api_cocktail=True, ref_count=1)
+            orphan = db.session.get(Cocktail, cid)
+            orphan.ref_count = 0
+            db.session.add(keep)
+            db.session.commit()
+            keep_id = keep.id
+            removed = collect_orphaned_api_cocktails.run(batch_size=1)
+            self.assertEqual(removed, 1)
+            self.assertIsNone(db.session.get(Cocktail, cid))
+            self.assertIsNotNone(db.session.get(Cocktail, keep_id))
+            self.assertIsNone(Cocktails_Ingredients.query.filter_by(cocktail_id=cid).first())
+
+    def test_collector_keeps_row_linked_after_selection(self):
+        from sqlalchemy import event
+        from services.cocktail_service import collect_orphaned_api_cocktails
+        with app.app_context():
+            _, cid = self._add_for_users("rcrace")
+            db.session.get(Cocktail, cid).ref_count = 0
+            db.session.commit()
+
+            def link_before_delete(conn, cursor, statement, *args):
+                # A user links the row between the collector's SELECT and DELETE.
+                if statement.startswith("DELETE FROM cocktails_ingredients"):
+                    cursor.connection.execute(
+                        "UPDATE cocktails SET ref_count = 1 WHERE id = ?", (cid,))
+
+            event.listen(db.engine, "before_cursor_execute", link_before_delete)
+            try:
+                removed = collect_orphaned_api_cocktails.run()
+            finally:
+                event.remove(db.engine, "before_cursor_execute", link_before_delete)
+            self.assertEqual(removed, 0)
+            self.assertIsNotNone(db.session.get(Cocktail, cid))
+            self.assertIsNotNone(Cocktails_Ingredients.query.filter_by(cocktail_id=cid).first())
+
+    def test_link_to_deleted_cocktail_raises_without_staging_row(self):
+        from services.cocktail_service import SharedCocktailGone, link_user_to_cocktail
+        with app.app_context():
+            user = _make_user(username="rcgone2", email="rcgone2@example.com")
+            with self.assertRaises(SharedCocktailGone):
+                link_user_to_cocktail(user.id, 999999)
+            self.assertEqual(len(db.session.new), 0)
+
+    def test_add_recreates_shared_row_collected_mid_request(self):
+        from services import cocktail_service
+        real_find = cocktail_service._find_existing_api_cocktail
+        with app.app_context():
+            self._add_for_users("rcold")
+            user = _make_user(username="rcnew", email="rcnew@example.com")
+            calls = []
+
+            def find_then_collect(external_id, name):
+                found = real_find(external_id, name)
+                if not calls:
+                    # The collector deletes the row right after it was found.
+                    calls.append(found.id)
+                    Cocktails_Ingredients.query.filter_by(cocktail_id=found.id).delete()
+                    Cocktails_Users.query.filter_by(cocktail_id=found.id).delete()
+                    Cocktail.query.filter_by(id=found.id).delete()
+                    db.session.commit()
+                    return Cocktail(id=calls[0], name=name, is_api_cocktail=True)
+                return found
+
+            with patch.object(cocktail_service, "_find_existing_api_cocktail",
+                              side_effect=find_then_collect):
+                self.assertTrue(cocktail_service.process_and_store_new_cocktail(
+                    self.API_DATA, user.id))
+            self.assertEqual(len(calls), 1)
+            cocktail = Cocktail.query.filter_by(api_cocktail_id="77777").one()
+            self.assertEqual(cocktail.ref_count, 1)
+            self.assertEqual(len(cocktail.ingredients_relation), 1)
+            self.assertIsNotNone(Cocktails_Users.query.filter_by(
+                user_id=user.id, cocktail_id=cocktail.id).first())
+
+    def test_deleting_user_releases_references(self):
+        with app.app_context():
+            admin = _make_user(username="rcadm", email="rcadm@example.com", is_admin=True)
+            admin_id = admin.id
+            (uid, _other), cid = self._add_for_users("rcgone", "rcstay")
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = admin_id
+        self.client.post(f"/admin/user/{uid}/delete", follow_redirects=True)
+        with app.app_context():
+            self.assertEqual(db.session.get(Cocktail, cid).ref_count, 1)
+
+
+# ===========================================================================
+# 23. Copy-on-Write Personal Variants
+# ===========================================================================
+
+class PersonalVariantTests(_BaseSuite):
+
+    API_DATA = {
+        "idDrink": "66666",
+        "strDrink": "Variant Collins",
+        "strInstructions": "Build over ice.",
+        "strDrinkThumb": "https://www.thecocktaildb.com/images/media/drink/x.jpg",
+        "strIngredient1": "Gin",
+        "strMeasure1": "2 oz",
+        "strIngredient2": "Lemon Juice",
+        "strMeasure2": "1 oz",
+        "strIngredient3": "Soda Water",
+        "strMeasure3": "Top",
+    }
+
+    def _setup_variant(self):
+        from services.cocktail_service import process_and_store_new_cocktail
+        with app.app_context():
+            user = _make_user()
+            process_and_store_new_cocktail(self.API_DATA, user.id)
+            uid = user.id
+            api_id = Cocktail.query.filter_by(api_cocktail_id="66666").one().id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        resp = self.client.get(f"/edit-cocktail/{api_id}")
+        variant_id = int(resp.headers["Location"].rsplit("/", 1)[1])
+        return uid, api_id, variant_id
+
+    def test_first_edit_creates_reference_without_copying(self):
+        uid, api_id, variant_id = self._setup_variant()
+        with app.app_context():
+            variant = db.session.get(Cocktail, variant_id)
+            self.assertEqual(variant.source_cocktail_id, api_id)
+            self.assertIsNone(variant.instructions)
+            self.assertEqual(variant.ingredients_relation, [])
+            # The user's reference moved from the join row to the source FK.
+            self.assertEqual(db.session.get(Cocktail, api_id).ref_count, 1)
+            self.assertIsNone(
+                Cocktails_Users.query.filter_by(user_id=uid, cocktail_id=api_id).first()
+            )
+
+    def test_edit_stores_only_ingredient_deltas(self):
+        _uid, api_id, variant_id = self._setup_variant()
+        self.client.post(f"/edit-cocktail/{variant_id}", data={
+            "name": "Variant Collins",
+            "instructions": "Build over ice.",
+            "ingredients-0-ingredient": "Gin",
+            "ingredients-0-measure": "2 oz",
+            "ingredients-1-ingredient": "Lemon Juice",
+            "ingredients-1-measure": "1.5 oz",
+            "ingredients-2-ingredient": "Simple Syrup",
+            "ingredients-2-measure": "0.5 oz",
+        })
+        with app.app_context():
+            variant = db.session.get(Cocktail, variant_id)
+            self.assertIsNone(variant.instructions)
+            deltas = {ci.ingredient.name: (ci.quantity, ci.is_removed)
+                      for ci in variant.ingredients_relation}
+            self.assertEqual(deltas, {
+                "Lemon Juice": ("1.5 oz", False),
+                "Simple Syrup": ("0.5 oz", False),
+                "Soda Water": ("Top", True),
+            })
+            # The shared record is untouched.
+            self.assertEqual(len(db.session.get(Cocktail, api_id).ingredients_relation), 3)
+        body = self.client.get("/my-cocktails").data.decode()
+        self.assertIn("Lemon Juice - 1.5 oz", body)
+        self.assertIn("Simple Syrup - 0.5 oz", body)
+        self.assertNotIn("Soda Water", body)
+        self.assertIn("Build over ice.", body)
+        self.assertIn("/thumbs/media/drink/x.jpg", body)
+
+    def test_readding_api_cocktail_does_not_duplicate_variant(self):
+        from services.cocktail_service import process_and_store_new_cocktail
+        uid, api_id, _variant_id = self._setup_variant()
+        with app.app_context():
+            self.assertFalse(process_and_store_new_cocktail(self.API_DATA, uid))
+            self.assertEqual(Cocktails_Users.query.filter_by(user_id=uid).count(), 1)
+
+    def test_deleting_variant_releases_source_reference(self):
+        _uid, api_id, variant_id = self._setup_variant()
+        self.client.post(f"/delete-cocktail/{variant_id}")
+        with app.app_context():
+            self.assertIsNone(db.session.get(Cocktail, variant_id))
+            self.assertEqual(db.session.get(Cocktail, api_id).ref_count, 0)
+
+
+
+# ===========================================================================
+# 24. Request-Scoped Current-User Context
+# ===========================================================================
+
+class _DictCache:
+    """Minimal stand-in for the Redis cache so cache hits can be exercised."""
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.store[key] = value
+
+    def add(self, key, value, timeout=None):
+        if key in self.store:
+            return False
+        self.store[key] = value
+        return True
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+class UserContextTests(_BaseSuite):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = _DictCache()
+        patcher = patch("services.user_context.cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _login_as(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess["user_id"] = user_id
+
+    def test_user_loaded_once_per_request(self):
+        from services.user_context import CurrentUser
+        with app.app_context():
+            admin_id = _make_user(username="ctxadm", email="ctxadm@example.com",
+                                  is_admin=True).id
+        self._login_as(self.client, admin_id)
+        # enforce_ban and admin_required both consult the context.
+        with patch.object(CurrentUser, "from_model",
+                          wraps=CurrentUser.from_model) as loader:
+            resp = self.client.get("/admin/panel")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(loader.call_count, 1)
+
+    def test_cached_context_skips_database(self):
+        from services.user_context import CurrentUser
+        with app.app_context():
+            admin_id = _make_user(username="ctxhit", email="ctxhit@example.com",
+                                  is_admin=True).id
+        self._login_as(self.client, admin_id)
+        self.client.get("/admin/panel")
+        self.assertIn(f"user_ctx:{admin_id}", self.cache.store)
+        with patch.object(CurrentUser, "from_model") as loader:
+            resp = self.client.get("/admin/panel")
+        self.assertEqual(resp.status_code, 200)
+        loader.assert_not_called()
+
+    def test_ban_invalidates_cached_context(self):
+        with app.app_context():
+            admin_id = _make_user(username="ctxbadm", email="ctxbadm@example.com",
+                                  is_admin=True).id
+            target_id = _make_user(username="ctxbtgt", email="ctxbtgt@example.com").id
+        target_client = app.test_client()
+        self._login_as(target_client, target_id)
+        self.assertEqual(target_client.get("/my-cocktails").status_code, 200)
+        self.assertIn(f"user_ctx:{target_id}", self.cache.store)
+
+        self._login_as(self.client, admin_id)
+        with patch("services.email_service.send_ban_notification_email"):
+            self.client.post(f"/admin/user/{target_id}/ban-permanent")
+        self.assertNotIn(f"user_ctx:{target_id}", self.cache.store)
+        resp = target_client.get("/my-cocktails")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("/appeal", resp.headers["Location"])
+
+    def test_demote_takes_effect_before_ttl(self):
+        with app.app_context():
+            admin_id = _make_user(username="ctxdadm", email="ctxdadm@example.com",
+                                  is_admin=True).id
+            other_id = _make_user(username="ctxdoth", email="ctxdoth@example.com",
+                                  is_admin=True).id
+        other_client = app.test_client()
+        self._login_as(other_client, other_id)
+        self.assertEqual(other_client.get("/admin/panel").status_code, 200)
+
+        self._login_as(self.client, admin_id)
+        self.client.post(f"/admin/user/{other_id}/demote")
+        resp = other_client.get("/admin/panel", follow_redirects=True)
+        self.assertIn(b"admin access required", resp.data.lower())
+
+    def test_cache_outage_falls_back_to_database(self):
+        with app.app_context():
+            uid = _make_user(username="ctxdown", email="ctxdown@example.com").id
+        self._login_as(self.client, uid)
+        with patch.object(self.cache, "get", side_effect=ConnectionError), \
+                patch.object(self.cache, "set", side_effect=ConnectionError):
+            resp = self.client.get("/my-cocktails")
+        self.assertEqual(resp.status_code, 200)
+
+
+
+# ===========================================================================
+# 25. Shared Rate Limits, Local Pre-Check and In-Memory Fallback
+# ===========================================================================
+
+class RateLimitStorageTests(_BaseSuite):
+
+    def setUp(self):
+        super().setUp()
+        app.config["RATELIMIT_ENABLED"] = True
+        limiter.enabled = True
+        # Stand in for a healthy Redis so no test depends on a live server.
+        patcher = patch.object(limiter._limiter, "hit", return_value=True)
+        self.redis_hit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        limiter._storage_dead = False
+        limiter._fallback_storage.reset()
+        flood_guard._window.storage.reset()
+        super().tearDown()
+
+    def test_limiter_uses_redis_moving_window(self):
+        self.assertEqual(app.config["RATELIMIT_STORAGE_URI"], app.config["REDIS_URL"])
+        self.assertEqual(app.config["RATELIMIT_STRATEGY"], "moving-window")
+        from extensions import redis_pool
+        self.assertIs(app.config["RATELIMIT_STORAGE_OPTIONS"]["connection_pool"],
+                      redis_pool.pool(app))
+        self.assertEqual(limiter.storage.__class__.__name__, "RedisStorage")
+
+    def test_limited_route_consults_shared_store(self):
+        self.client.get("/login")
+        self.assertEqual(self.redis_hit.call_count, 1)
+
+    def test_local_precheck_rejects_without_redis_round_trip(self):
+        from limits import parse
+        with patch.object(flood_guard, "_limit", parse("3 per minute")):
+            statuses = [self.client.get("/login").status_code for _ in range(4)]
+        self.assertEqual(statuses[:3], [200, 200, 200])
+        self.assertEqual(statuses[3], 429)
+        self.assertEqual(self.redis_hit.call_count, 3)
+
+    def test_precheck_skipped_when_rate_limiting_disabled(self):
+        from limits import parse
+        limiter.enabled = False
+        with patch.object(flood_guard, "_limit", parse("1 per minute")):
+            statuses = [self.client.get("/login").status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 200])
+
+    def test_falls_back_to_memory_when_redis_unreachable(self):
+        self.redis_hit.side_effect = ConnectionError("redis down")
+        with patch.object(limiter.storage, "check", return_value=False):
+            statuses = [self.client.get("/login").status_code for _ in range(11)]
+        # login is limited to 10 per minute; the fallback keeps enforcing it.
+        self.assertEqual(statuses[:10], [200] * 10)
+        self.assertEqual(statuses[10], 429)
+
+
+
+# ===========================================================================
+# 26. Background Re-Encoding of Uploaded Images
+# ===========================================================================
+
+def _png_bytes(size=(4, 4), mode="RGB"):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128)[:len(mode)]).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class _StagedUploadSuite(_BaseSuite):
+    """Upload fixtures shared by sections 26, 27 and 29 (no tests of its own)."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            self.uid = _make_user(username="imgstage", email="imgstage@example.com").id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = self.uid
+        # Keep uploads queued rather than processed so the pending state is visible.
+        patcher = patch("services.cocktail_service.process_staged_image.apply_async")
+        self.enqueue = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        from services.cocktail_service import delete_uploaded_image
+        with app.app_context():
+            for cocktail in Cocktail.query.filter(Cocktail.image_url.isnot(None)):
+                delete_uploaded_image(cocktail.image_url, cocktail.image_variants)
+        super().tearDown()
+
+    def _post_cocktail(self, data_bytes, filename="drink.png"):
+        return self.client.post("/add-original-cocktails", data={
+            "name": "Staged Sour",
+            "instructions": "Shake.",
+            "ingredients-0": "Gin",
+            "measures-0": "2 oz",
+            "image": (io.BytesIO(data_bytes), filename),
+        }, content_type="multipart/form-data")
+
+    def _staged_cocktail(self):
+        self._post_cocktail(_png_bytes())
+        with app.app_context():
+            cocktail = Cocktail.query.filter_by(name="Staged Sour").one()
+            return cocktail.id, cocktail.pending_image
+
+    def _processed_cocktail(self, size, mode="RGB"):
+        from services.cocktail_service import process_staged_image
+        self._post_cocktail(_png_bytes(size, mode))
+        with app.app_context():
+            cocktail = Cocktail.query.filter_by(name="Staged Sour").one()
+            cid, staged = cocktail.id, cocktail.pending_image
+        process_staged_image(cid, staged)
+        return cid
+
+    def _upload_path(self, name):
+        import os
+        from services.cocktail_service import upload_relpath
+        return os.path.join(app.root_path, app.config["UPLOADED_PHOTOS_DEST"],
+                            upload_relpath(name))
+
+
+class StagedImageProcessingTests(_StagedUploadSuite):
+
+    def test_upload_is_staged_not_decoded_in_request(self):
+        import os
+        cid, staged = self._staged_cocktail()
+        self.assertIsNotNone(staged)
+        self.enqueue.assert_called_once_with((cid, staged), retry=False)
+        with app.app_context():
+            self.assertIsNone(db.session.get(Cocktail, cid).image_url)
+            staged_path = os.path.join(app.config["UPLOAD_STAGING_DEST"], staged)
+            self.assertTrue(os.path.isfile(staged_path))
+            # Raw bytes are never staged under the publicly served tree.
+            self.assertFalse(staged_path.startswith(os.path.join(app.root_path, "static")))
+        body = self.client.get("/my-cocktails").data.decode()
+        self.assertIn("being processed", body)
+
+    def test_worker_publishes_clean_image_and_clears_pending(self):
+        import os
+        from services.cocktail_service import process_staged_image, upload_relpath
+        cid, staged = self._staged_cocktail()
+        process_staged_image(cid, staged)
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertIsNone(cocktail.pending_image)
+            self.assertTrue(cocktail.image_url.endswith(".jpg"))
+            self.assertTrue(os.path.isfile(os.path.join(
+                app.root_path, app.config["UPLOADED_PHOTOS_DEST"],
+                upload_relpath(cocktail.image_url))))
+            self.assertFalse(os.path.exists(
+                os.path.join(app.config["UPLOAD_STAGING_DEST"], staged)))
+
+    def test_superseded_upload_is_discarded(self):
+        from services.cocktail_service import process_staged_image
+        cid, staged = self._staged_cocktail()
+        with app.app_context():
+            db.session.get(Cocktail, cid).pending_image = "newer"
+            db.session.commit()
+        process_staged_image(cid, staged)
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertEqual(cocktail.pending_image, "newer")
+            self.assertIsNone(cocktail.image_url)
+
+    def test_undecodable_pixels_clear_pending_without_publishing(self):
+        from services.cocktail_service import process_staged_image
+        # A valid header with truncated pixel data passes the request-time
+        # gates but must still fail the worker's full decode (gate 3).
+        truncated = _png_bytes((64, 64))[:-40]
+        self._post_cocktail(truncated)
+        with app.app_context():
+            cocktail = Cocktail.query.filter_by(name="Staged Sour").one()
+            cid, staged = cocktail.id, cocktail.pending_image
+        self.assertIsNotNone(staged)
+        process_staged_image(cid, staged)
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertIsNone(cocktail.pending_image)
+            self.assertIsNone(cocktail.image_url)
+            self.assertIn("not a valid or supported image", cocktail.image_rejected)
+        body = self.client.get("/my-cocktails").data.decode()
+        self.assertIn("Your last image upload was not used", body)
+
+    def test_store_error_is_retried_with_staged_file_kept(self):
+        from services import cocktail_service
+        cid, staged = self._staged_cocktail()
+        real_store = cocktail_service.store_upload
+        calls = []
+
+        def flaky_store(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise RuntimeError("database unavailable")
+            return real_store(*args)
+
+        with patch.object(cocktail_service, "store_upload", side_effect=flaky_store):
+            cocktail_service.process_staged_image.apply((cid, staged))
+        self.assertEqual(len(calls), 2)
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertIsNone(cocktail.pending_image)
+            self.assertIsNotNone(cocktail.image_url)
+            self.assertIsNone(cocktail.image_rejected)
+
+    def test_store_error_after_last_retry_is_reported(self):
+        import os
+        from services import cocktail_service
+        cid, staged = self._staged_cocktail()
+        with patch.object(cocktail_service, "store_upload",
+                          side_effect=RuntimeError("database unavailable")) as store:
+            cocktail_service.process_staged_image.apply((cid, staged))
+        self.assertEqual(store.call_count, cocktail_service.process_staged_image.max_retries + 1)
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertIsNone(cocktail.pending_image)
+            self.assertIsNone(cocktail.image_url)
+            self.assertEqual(cocktail.image_rejected, cocktail_service._IMAGE_NOT_SAVED)
+            self.assertFalse(os.path.exists(
+                os.path.join(app.config["UPLOAD_STAGING_DEST"], staged)))
+
+    def test_new_upload_clears_previous_rejection(self):
+        cid, _staged = self._staged_cocktail()
+        with app.app_context():
+            db.session.get(Cocktail, cid).image_rejected = "Unreadable."
+            db.session.commit()
+        self.client.post(f"/edit-cocktail/{cid}", data={
+            "name": "Staged Sour",
+            "instructions": "Shake.",
+            "ingredients-0-ingredient": "Gin",
+            "ingredients-0-measure": "2 oz",
+            "image": (io.BytesIO(_png_bytes()), "again.png"),
+        }, content_type="multipart/form-data")
+        with app.app_context():
+            self.assertIsNone(db.session.get(Cocktail, cid).image_rejected)
+
+    def test_request_time_gates_still_reject(self):
+        resp = self._post_cocktail(b"GIF89a" + b"\x00" * 60, filename="drink.png")
+        self.assertIn(b"does not appear to be a valid image", resp.data)
+        with app.app_context():
+            self.assertIsNone(Cocktail.query.filter_by(name="Staged Sour").first())
+        self.enqueue.assert_not_called()
+
+    def test_broker_outage_processes_inline(self):
+        self.enqueue.side_effect = ConnectionError("broker down")
+        self._post_cocktail(_png_bytes())
+        with app.app_context():
+            cocktail = Cocktail.query.filter_by(name="Staged Sour").one()
+            self.assertIsNone(cocktail.pending_image)
+            self.assertIsNotNone(cocktail.image_url)
+
+
+
+# ===========================================================================
+# 27. Responsive Image Variants
+# ===========================================================================
+
+class ResponsiveImageVariantTests(_StagedUploadSuite):
+
+    def test_variants_generated_once_at_ingest(self):
+        import os
+        from PIL import Image
+        cid = self._processed_cocktail((1200, 600))
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            manifest = cocktail.image_variants
+            stem = cocktail.image_url.rsplit(".", 1)[0]
+        self.assertEqual(manifest["width"], 1200)
+        self.assertEqual(manifest["widths"], [320, 640, 1024])
+        self.assertIn("webp", manifest["formats"])
+        self.assertIn("jpg", manifest["formats"])
+        for width in manifest["widths"]:
+            for ext in manifest["formats"]:
+                path = self._upload_path(f"{stem}-{width}w.{ext}")
+                self.assertTrue(os.path.isfile(path), path)
+                with Image.open(path) as img:
+                    self.assertEqual(img.size, (width, width // 2))
+
+    def test_srcset_data_lists_every_candidate(self):
+        from services.cocktail_service import get_cocktail_image_url
+        cid = self._processed_cocktail((1200, 600))
+        with app.test_request_context():
+            cocktail = db.session.get(Cocktail, cid)
+            image = get_cocktail_image_url(cocktail, srcset=True)
+            self.assertEqual(image["src"], get_cocktail_image_url(cocktail))
+        self.assertIn("-320w.jpg 320w", image["srcset"])
+        self.assertIn(f"{image['src']} 1200w", image["srcset"])
+        webp = next(s for s in image["sources"] if s["type"] == "image/webp")
+        self.assertIn("-640w.webp 640w", webp["srcset"])
+        body = self.client.get("/my-cocktails").data.decode()
+        self.assertIn("<picture>", body)
+        self.assertIn('type="image/webp"', body)
+
+    def test_small_image_gets_no_variants(self):
+        from services.cocktail_service import get_cocktail_image_url
+        cid = self._processed_cocktail((100, 100))
+        with app.test_request_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertIsNone(cocktail.image_variants)
+            image = get_cocktail_image_url(cocktail, srcset=True)
+        self.assertIsNone(image["srcset"])
+        self.assertEqual(image["sources"], [])
+
+    def test_transparent_upload_jpeg_fallback_is_flattened(self):
+        from PIL import Image
+        cid = self._processed_cocktail((800, 400), mode="RGBA")
+        with app.app_context():
+            stem = db.session.get(Cocktail, cid).image_url.rsplit(".", 1)[0]
+        with Image.open(self._upload_path(f"{stem}-320w.jpg")) as img:
+            self.assertEqual(img.mode, "RGB")
+        with Image.open(self._upload_path(f"{stem}-320w.webp")) as img:
+            self.assertEqual(img.mode, "RGBA")
+
+    def test_delete_removes_variants(self):
+        import os
+        cid = self._processed_cocktail((700, 700))
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            stem = cocktail.image_url.rsplit(".", 1)[0]
+        variant = self._upload_path(f"{stem}-320w.webp")
+        self.assertTrue(os.path.isfile(variant))
+        self.client.post(f"/delete-cocktail/{cid}")
+        self.assertFalse(os.path.exists(variant))
+
+    def test_api_thumbnail_uses_remote_sizes(self):
+        from services.cocktail_service import api_image_sources
+        url = "https://www.thecocktaildb.com/images/media/drink/x.jpg"
+        with app.test_request_context():
+            image = api_image_sources(url)
+            self.assertIsNone(api_image_sources(None))
+        self.assertEqual(image["src"], "/thumbs/media/drink/x.jpg")
+        self.assertIn("/thumbs/media/drink/x.jpg/small 200w", image["srcset"])
+        self.assertIn("/thumbs/media/drink/x.jpg/large 500w", image["srcset"])
+
+
+
+# ===========================================================================
+# 28. Local Caching Proxy for TheCocktailDB Thumbnails
+# ===========================================================================
+
+class ThumbCacheProxyTests(_BaseSuite):
+
+    THUMB = "media/drink/abc123.jpg"
+
+    def setUp(self):
+        import tempfile
+        super().setUp()
+        self._saved = (app.config["THUMB_CACHE_DIR"], app.config["THUMB_CACHE_MAX_BYTES"])
+        self.cache_dir = tempfile.mkdtemp()
+        app.config["THUMB_CACHE_DIR"] = self.cache_dir
+        patcher = patch("services.thumb_cache.cache", _DictCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        app.config["THUMB_CACHE_DIR"], app.config["THUMB_CACHE_MAX_BYTES"] = self._saved
+        super().tearDown()
+
+    def _fetch(self, body=b"\xff\xd8\xff fake jpeg", content_type="image/jpeg"):
+        from unittest.mock import MagicMock
+        from services.thumb_cache import fetch_thumb
+        resp = MagicMock()
+        resp.__enter__.return_value = resp
+        resp.headers = {"Content-Type": content_type}
+        resp.raw.read.return_value = body
+        with patch("services.thumb_cache.requests.get", return_value=resp) as get:
+            fetch_thumb(self.THUMB)
+        return get
+
+    def test_miss_redirects_upstream_and_queues_one_fetch(self):
+        with patch("services.thumb_cache.fetch_thumb.apply_async") as enqueue:
+            first = self.client.get(f"/thumbs/{self.THUMB}")
+            self.client.get(f"/thumbs/{self.THUMB}")
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(first.headers["Location"],
+                         f"https://www.thecocktaildb.com/images/{self.THUMB}")
+        self.assertEqual(first.headers["Cache-Control"], "no-store")
+        enqueue.assert_called_once_with((self.THUMB,), retry=False)
+
+    def test_hit_served_locally_with_immutable_cache_headers(self):
+        import os
+        get = self._fetch()
+        get.assert_called_once()
+        # Sharded two levels deep by hash prefix.
+        files = [os.path.join(d, f) for d, _s, fs in os.walk(self.cache_dir) for f in fs]
+        self.assertEqual(len(files), 1)
+        self.assertEqual(len(os.path.relpath(files[0], self.cache_dir).split(os.sep)), 3)
+
+        resp = self.client.get(f"/thumbs/{self.THUMB}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"\xff\xd8\xff fake jpeg")
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        again = self.client.get(f"/thumbs/{self.THUMB}",
+                                headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(again.status_code, 304)
+
+    def test_non_image_upstream_response_not_cached(self):
+        import os
+        self._fetch(body=b"<html>", content_type="text/html")
+        self.assertEqual([f for _d, _s, f in os.walk(self.cache_dir) if f], [])
+
+    def test_only_drink_thumbnails_are_proxied(self):
+        for path in ("media/drink/x.gif", "media/ingredient/x.jpg",
+                     "media/drink/x.jpg/huge", "..%2F..%2Fetc%2Fpasswd"):
+            self.assertEqual(self.client.get(f"/thumbs/{path}").status_code, 404, path)
+
+    def test_prune_evicts_least_recently_served(self):
+        import os
+        from services.thumb_cache import prune_thumb_cache
+        paths = []
+        for i in range(4):
+            path = os.path.join(self.cache_dir, "ab", "cd", f"thumb{i}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"x" * 100)
+            os.utime(path, (1000 + i, 1000 + i))
+            paths.append(path)
+        app.config["THUMB_CACHE_MAX_BYTES"] = 300
+        with app.app_context():
+            freed = prune_thumb_cache()
+        self.assertEqual(freed, 200)
+        self.assertEqual([os.path.exists(p) for p in paths], [False, False, True, True])
+
+    def test_image_url_and_csp_use_local_proxy(self):
+        from services.cocktail_service import get_cocktail_image_url
+        with app.test_request_context():
+            cocktail = Cocktail(
+                name="Proxy", is_api_cocktail=True,
+                strDrinkThumb=f"https://www.thecocktaildb.com/images/{self.THUMB}",
+            )
+            self.assertEqual(get_cocktail_image_url(cocktail), f"/thumbs/{self.THUMB}")
+            other = Cocktail(name="Other", strDrinkThumb="http://external.com/img.jpg")
+            self.assertEqual(get_cocktail_image_url(other), "http://external.com/img.jpg")
+        csp = self.client.get("/login").headers["Content-Security-Policy"]
+        self.assertIn("img-src 'self' data: https://www.thecocktaildb.com;", csp)
+
+
+
+# ===========================================================================
+# 29. Content-Addressed Upload Storage
+# ===========================================================================
+
+class ContentAddressedUploadTests(_StagedUploadSuite):
+
+    def _second_user_cocktail(self, data):
+        from services.cocktail_service import process_staged_image
+        with app.app_context():
+            uid = _make_user(username="imgdup", email="imgdup@example.com").id
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = uid
+        client.post("/add-original-cocktails", data={
+            "name": "Duplicate Sour",
+            "instructions": "Shake.",
+            "ingredients-0": "Gin",
+            "measures-0": "2 oz",
+            "image": (io.BytesIO(data), "copy.png"),
+        }, content_type="multipart/form-data")
+        with app.app_context():
+            cocktail = Cocktail.query.filter_by(name="Duplicate Sour").one()
+            cid, staged = cocktail.id, cocktail.pending_image
+        process_staged_image(cid, staged)
+        return client, cid
+
+    def test_identical_uploads_share_one_blob(self):
+        import os
+        cid = self._processed_cocktail((700, 350))
+        _client, dup_id = self._second_user_cocktail(_png_bytes((700, 350)))
+        with app.app_context():
+            first = db.session.get(Cocktail, cid)
+            second = db.session.get(Cocktail, dup_id)
+            self.assertEqual(first.image_url, second.image_url)
+            self.assertRegex(first.image_url, r"^[0-9a-f]{64}\.jpg$")
+            self.assertEqual(db.session.get(UploadBlob, first.image_url).ref_count, 2)
+            name = first.image_url
+        # Sharded into two prefix directories; still served at a flat URL.
+        self.assertTrue(self._upload_path(name).endswith(
+            os.path.join(name[:2], name[2:4], name)))
+        resp = self.client.get(f"/static/uploads/{name}")
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+
+    def test_duplicate_upload_reuses_variants(self):
+        from services import cocktail_service
+        self._processed_cocktail((700, 350))
+        with patch.object(cocktail_service, "generate_image_variants",
+                          wraps=cocktail_service.generate_image_variants) as gen:
+            _client, dup_id = self._second_user_cocktail(_png_bytes((700, 350)))
+        gen.assert_not_called()
+        with app.app_context():
+            self.assertEqual(db.session.get(Cocktail, dup_id).image_variants["widths"], [320, 640])
+
+    def test_blob_deleted_only_with_last_reference(self):
+        import os
+        cid = self._processed_cocktail((700, 350))
+        client, dup_id = self._second_user_cocktail(_png_bytes((700, 350)))
+        with app.app_context():
+            name = db.session.get(Cocktail, cid).image_url
+        path, variant = self._upload_path(name), self._upload_path(
+            name.replace(".jpg", "-320w.webp"))
+
+        self.client.post(f"/delete-cocktail/{cid}")
+        self.assertTrue(os.path.isfile(path))
+        self.assertTrue(os.path.isfile(variant))
+        with app.app_context():
+            self.assertEqual(db.session.get(UploadBlob, name).ref_count, 1)
+
+        client.post(f"/delete-cocktail/{dup_id}")
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(variant))
+        with app.app_context():
+            self.assertIsNone(db.session.get(UploadBlob, name))
+
+    def test_failed_release_commit_keeps_files(self):
+        import os
+        from sqlalchemy.exc import OperationalError
+        from services.cocktail_service import delete_uploaded_image
+        cid = self._processed_cocktail((700, 350))
+        with app.app_context():
+            name = db.session.get(Cocktail, cid).image_url
+            with patch.object(db.session, "commit",
+                              side_effect=OperationalError("COMMIT", {}, Exception("down"))):
+                delete_uploaded_image(name)
+            self.assertEqual(db.session.get(UploadBlob, name).ref_count, 1)
+        self.assertTrue(os.path.isfile(self._upload_path(name)))
+        self.assertTrue(os.path.isfile(self._upload_path(name.replace(".jpg", "-320w.webp"))))
+
+    def test_replacing_image_releases_previous_blob(self):
+        import os
+        from services.cocktail_service import process_staged_image
+        cid = self._processed_cocktail((700, 350))
+        with app.app_context():
+            old_name = db.session.get(Cocktail, cid).image_url
+        self.client.post(f"/edit-cocktail/{cid}", data={
+            "name": "Staged Sour",
+            "instructions": "Shake.",
+            "ingredients-0-ingredient": "Gin",
+            "ingredients-0-measure": "2 oz",
+            "image": (io.BytesIO(_png_bytes((500, 500))), "new.png"),
+        }, content_type="multipart/form-data")
+        with app.app_context():
+            staged = db.session.get(Cocktail, cid).pending_image
+        process_staged_image(cid, staged)
+        with app.app_context():
+            self.assertNotEqual(db.session.get(Cocktail, cid).image_url, old_name)
+            self.assertIsNone(db.session.get(UploadBlob, old_name))
+        self.assertFalse(os.path.exists(self._upload_path(old_name)))
+
+    def test_legacy_uuid_upload_deleted_directly(self):
+        import os
+        from services.cocktail_service import delete_uploaded_image
+        name = "0123456789abcdef0123456789abcdef.jpg"
+        path = self._upload_path(name)
+        self.assertEqual(os.path.dirname(path),
+                         os.path.join(app.root_path, app.config["UPLOADED_PHOTOS_DEST"]))
+        with open(path, "wb") as f:
+            f.write(b"legacy")
+        with app.app_context():
+            delete_uploaded_image(name)
+        self.assertFalse(os.path.exists(path))
+
+    def test_reference_added_to_blob_row_committed_elsewhere(self):
+        import hashlib
+        import os
+        from services import cocktail_service
+        data = b"bytes another request stored first"
+        name = f"{hashlib.sha256(data).hexdigest()}.jpg"
+        # With the upsert, and with the update-then-insert fallback.
+        for dialects in (dict(cocktail_service._UPSERT_INSERTS), {}):
+            with self.subTest(upsert=bool(dialects)), app.app_context(), \
+                    patch.dict(cocktail_service._UPSERT_INSERTS, dialects, clear=True):
+                db.session.add(UploadBlob(filename=name, ref_count=1, size=len(data)))
+                db.session.commit()
+                db.session.expunge_all()
+                self.assertEqual(cocktail_service.store_upload(data, "jpg"), name)
+                db.session.commit()
+                self.assertEqual(db.session.get(UploadBlob, name).ref_count, 2)
+                cocktail_service.delete_uploaded_image(name)
+                cocktail_service.delete_uploaded_image(name)
+                self.assertIsNone(db.session.get(UploadBlob, name))
+        self.assertFalse(os.path.exists(self._upload_path(name)))
+
+    def test_fallback_insert_conflict_retries_as_update(self):
+        from services import cocktail_service
+        name = "f" * 64 + ".jpg"
+        real_begin_nested = db.session.begin_nested
+
+        def rival_inserts_first():
+            # A concurrent upload stores the row between our UPDATE and INSERT.
+            db.session.execute(UploadBlob.__table__.insert().values(
+                filename=name, ref_count=1, size=3, created_at=datetime(2024, 1, 1)))
+            return real_begin_nested()
+
+        with app.app_context(), patch.dict(cocktail_service._UPSERT_INSERTS, clear=True), \
+                patch.object(db.session, "begin_nested", side_effect=rival_inserts_first):
+            cocktail_service._take_blob_reference(name, 3)
+            db.session.commit()
+        with app.app_context():
+            self.assertEqual(db.session.get(UploadBlob, name).ref_count, 2)
+
+
+# ===========================================================================
+# 30. Immutable, Offloadable Serving of Uploads
+# ===========================================================================
+
+class UploadServingTests(_StagedUploadSuite):
+
+    def setUp(self):
+        super().setUp()
+        cid = self._processed_cocktail((400, 200))
+        with app.app_context():
+            self.name = db.session.get(Cocktail, cid).image_url
+        self.url = f"/static/uploads/{self.name}"
+        self.addCleanup(app.config.__setitem__, "UPLOAD_SENDFILE",
+                        app.config["UPLOAD_SENDFILE"])
+
+    def test_served_with_immutable_cache_and_strong_etag(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=31536000, immutable")
+        etag, weak = resp.get_etag()
+        self.assertFalse(weak)
+        self.assertEqual(etag, self.name.rsplit(".", 1)[0])
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        with open(self._upload_path(self.name), "rb") as f:
+            self.assertEqual(resp.data, f.read())
+
+    def test_if_none_match_returns_not_modified(self):
+        etag = self.client.get(self.url).headers["ETag"]
+        resp = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+
+    def test_range_request_returns_partial_content(self):
+        resp = self.client.get(self.url, headers={"Range": "bytes=0-9"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(len(resp.data), 10)
+        self.assertTrue(resp.headers["Content-Range"].startswith("bytes 0-9/"))
+
+    def test_x_accel_redirect_offloads_body(self):
+        from services.cocktail_service import upload_relpath
+        app.config["UPLOAD_SENDFILE"] = "x-accel-redirect"
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["X-Accel-Redirect"],
+                         app.config["UPLOAD_ACCEL_REDIRECT_PREFIX"] + upload_relpath(self.name))
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        # A revalidation is answered here and never handed to the front server.
+        resp = self.client.get(self.url, headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, 304)
+        self.assertNotIn("X-Accel-Redirect", resp.headers)
+
+    def test_x_sendfile_offloads_body(self):
+        app.config["UPLOAD_SENDFILE"] = "x-sendfile"
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["X-Sendfile"], self._upload_path(self.name))
+
+    def test_missing_upload_is_404(self):
+        resp = self.client.get("/static/uploads/" + "0" * 64 + ".jpg")
+        self.assertEqual(resp.status_code, 404)
+
+
+# ===========================================================================
+# 31. Pluggable Upload Storage Backends
+# ===========================================================================
+
+def _s3_client():
+    import boto3
+    return boto3.client("s3", region_name="us-east-1",
+                        aws_access_key_id="test", aws_secret_access_key="test")
+
+
+class UploadStorageBackendTests(unittest.TestCase):
+    """Driver behaviour; the S3 driver runs against botocore's Stubber."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+
+    def test_local_save_streams_and_delete_many_removes(self):
+        from services.storage import LocalStorage
+        storage = LocalStorage(self.tmp)
+        storage.save("ab/cd/abcd.jpg", io.BytesIO(b"x" * 100_000))
+        self.assertTrue(storage.exists("ab/cd/abcd.jpg"))
+        self.assertEqual(os.path.getsize(os.path.join(self.tmp, "ab", "cd", "abcd.jpg")), 100_000)
+        # No temp files are left behind by the atomic write.
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "ab", "cd")), ["abcd.jpg"])
+        storage.delete_many(["ab/cd/abcd.jpg", "ab/cd/missing.jpg"])
+        self.assertFalse(storage.exists("ab/cd/abcd.jpg"))
+
+    def test_local_rejects_keys_outside_root(self):
+        from services.storage import LocalStorage
+        storage = LocalStorage(self.tmp)
+        with self.assertRaises(ValueError):
+            storage.save("../escape.jpg", io.BytesIO(b"x"))
+        self.assertFalse(storage.exists("../escape.jpg"))
+
+    def test_s3_save_uploads_under_prefix(self):
+        from botocore.stub import Stubber
+        from services.storage import S3Storage
+        client = _s3_client()
+        storage = S3Storage("bucket", prefix="uploads/", client=client)
+        with Stubber(client) as stub:
+            stub.add_response("put_object", {})
+            storage.save("ab/cd/abcd.jpg", io.BytesIO(b"jpeg"))
+            stub.assert_no_pending_responses()
+
+    def test_s3_exists_maps_404_to_false(self):
+        from botocore.stub import Stubber
+        from services.storage import S3Storage
+        client = _s3_client()
+        storage = S3Storage("bucket", prefix="uploads/", client=client)
+        with Stubber(client) as stub:
+            stub.add_response("head_object", {}, {"Bucket": "bucket", "Key": "uploads/a.jpg"})
+            stub.add_client_error("head_object", "404", http_status_code=404)
+            self.assertTrue(storage.exists("a.jpg"))
+            self.assertFalse(storage.exists("b.jpg"))
+
+    def test_s3_open_reads_object_and_maps_404(self):
+        from botocore.response import StreamingBody
+        from botocore.stub import Stubber
+        from services.storage import S3Storage
+        client = _s3_client()
+        storage = S3Storage("bucket", prefix="uploads/_staging/", client=client)
+        with Stubber(client) as stub:
+            stub.add_response("get_object", {"Body": StreamingBody(io.BytesIO(b"raw"), 3)},
+                              {"Bucket": "bucket", "Key": "uploads/_staging/abc"})
+            stub.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+            with storage.open("abc") as staged:
+                self.assertEqual(staged.read(), b"raw")
+            with self.assertRaises(FileNotFoundError):
+                storage.open("gone")
+
+    def test_s3_staging_shares_bucket_under_prefix(self):
+        from types import SimpleNamespace
+        from services.storage import S3Storage, create_staging_storage
+        config = dict(app.config, UPLOAD_STORAGE="s3", S3_BUCKET="bucket", S3_PREFIX="uploads/")
+        storage = create_staging_storage(SimpleNamespace(config=config))
+        self.assertIsInstance(storage, S3Storage)
+        self.assertEqual((storage.bucket, storage.prefix), ("bucket", "uploads/_staging/"))
+
+    def test_s3_delete_many_batches_per_request_limit(self):
+        from botocore.stub import Stubber
+        from services.storage import S3Storage
+        client = _s3_client()
+        storage = S3Storage("bucket", prefix="uploads/", client=client)
+        batches = []
+        client.meta.events.register(
+            "provide-client-params.s3.DeleteObjects",
+            lambda params, **kw: batches.append([o["Key"] for o in params["Delete"]["Objects"]]),
+        )
+        with Stubber(client) as stub:
+            stub.add_response("delete_objects", {})
+            stub.add_response("delete_objects", {})
+            storage.delete_many([f"k{i}.jpg" for i in range(1500)])
+            stub.assert_no_pending_responses()
+        self.assertEqual([len(b) for b in batches], [1000, 500])
+        self.assertEqual(batches[0][0], "uploads/k0.jpg")
+
+    def test_s3_iter_objects_and_move(self):
+        from datetime import datetime, timezone
+        from botocore.stub import Stubber
+        from services.storage import S3Storage, StoredObject
+        client = _s3_client()
+        storage = S3Storage("bucket", prefix="uploads/", client=client)
+        stamp = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        with Stubber(client) as stub:
+            stub.add_response("list_objects_v2", {
+                "Contents": [{"Key": "uploads/ab/cd/a.jpg", "Size": 12, "LastModified": stamp}],
+                "IsTruncated": False,
+            }, {"Bucket": "bucket", "Prefix": "uploads/ab/"})
+            stub.add_response("copy_object", {}, {
+                "Bucket": "bucket", "Key": "uploads/_quarantine/ab/cd/a.jpg",
+                "CopySource": {"Bucket": "bucket", "Key": "uploads/ab/cd/a.jpg"},
+            })
+            stub.add_response("delete_object", {},
+                              {"Bucket": "bucket", "Key": "uploads/ab/cd/a.jpg"})
+            self.assertEqual(list(storage.iter_objects("ab/")),
+                             [StoredObject("ab/cd/a.jpg", 12, stamp.timestamp())])
+            storage.move("ab/cd/a.jpg", "_quarantine/ab/cd/a.jpg")
+            stub.assert_no_pending_responses()
+
+    def test_s3_send_redirects_to_presigned_url(self):
+        from services.storage import S3Storage
+        storage = S3Storage("bucket", prefix="uploads/", presign_ttl=600, client=_s3_client())
+        with app.test_request_context():
+            resp = storage.send("ab/cd/abcd.jpg")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("/uploads/ab/cd/abcd.jpg", resp.location)
+        self.assertIn("Signature", resp.location)
+        self.assertEqual(resp.headers["Cache-Control"], "private, max-age=300")
+
+    def test_s3_send_prefers_public_url(self):
+        from services.storage import S3Storage
+        storage = S3Storage("bucket", prefix="uploads/", public_url="https://cdn.example.com/",
+                            client=_s3_client())
+        with app.test_request_context():
+            resp = storage.send("ab/cd/abcd.jpg")
+        self.assertEqual(resp.location, "https://cdn.example.com/uploads/ab/cd/abcd.jpg")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+
+    def test_csp_allows_object_storage_origin(self):
+        from services.storage import upload_origin
+        config = {"UPLOAD_STORAGE": "s3", "S3_PUBLIC_URL": "",
+                  "S3_ENDPOINT_URL": "http://minio.local:9000"}
+        self.assertEqual(upload_origin(config), "http://minio.local:9000")
+        config["S3_PUBLIC_URL"] = "https://cdn.example.com/uploads"
+        self.assertEqual(upload_origin(config), "https://cdn.example.com")
+        self.assertIsNone(upload_origin({"UPLOAD_STORAGE": "local"}))
+
+
+@unittest.skipUnless(os.environ.get("S3_TEST_ENDPOINT_URL"),
+                     "set S3_TEST_ENDPOINT_URL (e.g. a local MinIO) to run")
+class S3StorageIntegrationTests(unittest.TestCase):
+    """Round trip against a real S3-compatible server such as MinIO.
+
+    Uses ``S3_TEST_ENDPOINT_URL``, ``S3_TEST_BUCKET`` (default
+    ``cocktail-test``) and the ``S3_ACCESS_KEY_ID`` / ``S3_SECRET_ACCESS_KEY``
+    credentials; the bucket is created when missing.
+    """
+
+    def setUp(self):
+        from services.storage import S3Storage
+        self.storage = S3Storage(
+            os.environ.get("S3_TEST_BUCKET", "cocktail-test"),
+            prefix="test-uploads/",
+            endpoint_url=os.environ["S3_TEST_ENDPOINT_URL"],
+            region="us-east-1",
+            access_key=os.environ.get("S3_ACCESS_KEY_ID", "minioadmin"),
+            secret_key=os.environ.get("S3_SECRET_ACCESS_KEY", "minioadmin"),
+        )
+        client = self.storage.client
+        try:
+            client.head_bucket(Bucket=self.storage.bucket)
+        except Exception:
+            client.create_bucket(Bucket=self.storage.bucket)
+
+    def test_save_exists_send_delete_round_trip(self):
+        import requests
+        key = "ab/cd/roundtrip.jpg"
+        self.storage.save(key, io.BytesIO(b"\xff\xd8\xff minio"))
+        self.assertTrue(self.storage.exists(key))
+        with app.test_request_context():
+            location = self.storage.send(key).location
+        fetched = requests.get(location, timeout=10)
+        self.assertEqual(fetched.content, b"\xff\xd8\xff minio")
+        self.assertEqual(fetched.headers["Content-Type"], "image/jpeg")
+        self.storage.delete_many([key])
+        self.assertFalse(self.storage.exists(key))
+
+
+# ===========================================================================
+# 32. Orphaned-Upload Garbage Collector
+# ===========================================================================
+
+class UploadGarbageCollectorTests(_BaseSuite):
+
+    HASH = "ab" * 32
+    OLD = 2 * 24 * 60 * 60
+
+    def setUp(self):
+        from services.storage import LocalStorage
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.storage = LocalStorage(self.tmp)
+        previous = app.extensions.get("upload_storage")
+        app.extensions["upload_storage"] = self.storage
+        self.addCleanup(app.extensions.__setitem__, "upload_storage", previous)
+
+    def _put(self, key, size=10, age=OLD):
+        import time
+        self.storage.save(key, io.BytesIO(b"x" * size))
+        stamp = time.time() - age
+        os.utime(os.path.join(self.tmp, *key.split("/")), (stamp, stamp))
+
+    def _collect(self, **kwargs):
+        from services.upload_gc import collect_orphaned_uploads
+        with app.app_context():
+            return collect_orphaned_uploads(**kwargs)
+
+    def test_quarantines_only_old_unreferenced_files(self):
+        orphan = "cd" * 32
+        with app.app_context():
+            db.session.add(UploadBlob(filename=f"{self.HASH}.jpg", ref_count=1, size=10))
+            db.session.add(Cocktail(name="Legacy", instructions="Mix.", strDrinkThumb="legacy.png"))
+            db.session.commit()
+        self._put(f"ab/ab/{self.HASH}.jpg")
+        self._put(f"ab/ab/{self.HASH}-320w.webp")   # variant of a referenced blob
+        self._put("legacy.png")                     # legacy strDrinkThumb upload
+        self._put(f"cd/cd/{orphan}.jpg", size=40)
+        self._put(f"cd/cd/{orphan}-320w.webp", size=5)
+        self._put("fresh.jpg", age=0)               # transaction may be in flight
+        self._put(f"{self.HASH}.jpg", size=7)       # referenced name, wrong place
+
+        report = self._collect(batch_size=2)
+
+        self.assertEqual(report["quarantined"], 3)
+        self.assertEqual(report["quarantined_bytes"], 52)
+        remaining = {obj.key for obj in self.storage.iter_objects()}
+        self.assertEqual(remaining, {
+            f"ab/ab/{self.HASH}.jpg", f"ab/ab/{self.HASH}-320w.webp", "legacy.png", "fresh.jpg",
+            f"_quarantine/cd/cd/{orphan}.jpg", f"_quarantine/cd/cd/{orphan}-320w.webp",
+            f"_quarantine/{self.HASH}.jpg",
+        })
+
+    def test_quarantined_files_deleted_after_window(self):
+        self._put("orphan.jpg", size=30)
+        self.assertEqual(self._collect()["quarantined"], 1)
+        # Still inside the quarantine window: kept.
+        self.assertEqual(self._collect()["deleted"], 0)
+        self.assertTrue(self.storage.exists("_quarantine/orphan.jpg"))
+        report = self._collect(quarantine_for=0)
+        self.assertEqual((report["deleted"], report["reclaimed_bytes"]), (1, 30))
+        self.assertEqual(list(self.storage.iter_objects()), [])
+
+    def test_quarantined_file_restored_when_referenced_again(self):
+        self._put("revived.jpg")
+        self._collect()
+        with app.app_context():
+            db.session.add(Cocktail(name="Revived", instructions="Mix.", image_url="revived.jpg"))
+            db.session.commit()
+        report = self._collect(quarantine_for=0)
+        self.assertEqual((report["restored"], report["deleted"]), (1, 0))
+        self.assertTrue(self.storage.exists("revived.jpg"))
+        self.assertFalse(self.storage.exists("_quarantine/revived.jpg"))
+
+    def test_quarantined_file_restored_before_window_ends(self):
+        self._put("early.jpg")
+        self._collect()
+        with app.app_context():
+            db.session.add(Cocktail(name="Early", instructions="Mix.", image_url="early.jpg"))
+            db.session.commit()
+        report = self._collect()
+        self.assertEqual((report["restored"], report["deleted"]), (1, 0))
+        self.assertTrue(self.storage.exists("early.jpg"))
+        self.assertFalse(self.storage.exists("_quarantine/early.jpg"))
+
+    def test_staged_uploads_in_bucket_are_skipped(self):
+        self._put("_staging/" + "f" * 32)
+        self.assertEqual(self._collect()["quarantined"], 0)
+        self.assertTrue(self.storage.exists("_staging/" + "f" * 32))
+
+
+# ===========================================================================
+# 33. Streaming Upload Validation and Draft-Mode Decoding
+# ===========================================================================
+
+def _png_header(width, height):
+    """PNG header declaring *width* x *height*, up to the start of IDAT (no pixels)."""
+    import struct
+    import zlib
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr
+            + struct.pack(">I", zlib.crc32(b"IHDR" + ihdr))
+            + struct.pack(">I", 1 << 20) + b"IDAT")
+
+
+class StreamingUploadValidationTests(_StagedUploadSuite):
+
+    def _sniffed(self, chunks):
+        from upload_stream import SniffedUpload
+        upload = SniffedUpload(io.BytesIO())
+        for chunk in chunks:
+            upload.write(chunk)
+        return upload
+
+    def test_bad_signature_rejected_and_rest_discarded(self):
+        upload = self._sniffed([b"GIF89a" + b"\x00" * 100] + [b"\x00" * 65536] * 10)
+        self.assertIn("does not appear to be a valid image", upload.rejected)
+        self.assertEqual(upload.getbuffer().nbytes, 0)
+
+    def test_valid_image_passes_through_unchanged(self):
+        data = _png_bytes((64, 64))
+        # Arrives a few bytes at a time, so the header completes mid-stream.
+        upload = self._sniffed([data[i:i + 5] for i in range(0, len(data), 5)])
+        self.assertIsNone(upload.rejected)
+        self.assertEqual(upload.getvalue(), data)
+
+    def test_declared_bomb_rejected_from_header(self):
+        upload = self._sniffed([_png_header(30000, 30000)])
+        self.assertIn("too large", upload.rejected)
+        resp = self._post_cocktail(_png_header(5000, 5000) + b"\x00" * 200_000)
+        self.assertIn(b"too large to process safely", resp.data)
+        with app.app_context():
+            self.assertIsNone(Cocktail.query.filter_by(name="Staged Sour").first())
+        self.enqueue.assert_not_called()
+
+    def test_oversized_content_length_refused_before_reading(self):
+        resp = self.client.post(
+            "/add-original-cocktails", data=b"",
+            content_type="multipart/form-data; boundary=x",
+            environ_overrides={"CONTENT_LENGTH": str(app.config["MAX_CONTENT_LENGTH"] + 1)},
+        )
+        self.assertEqual(resp.status_code, 413)
+
+    def test_jpeg_decoded_in_draft_mode(self):
+        from PIL import Image, JpegImagePlugin
+        from services.cocktail_service import _decode_image
+        buf = io.BytesIO()
+        Image.new("RGB", (4000, 2000), (10, 120, 200)).save(buf, format="JPEG")
+        buf.seek(0)
+        real_draft = JpegImagePlugin.JpegImageFile.draft
+        with patch.object(JpegImagePlugin.JpegImageFile, "draft", autospec=True,
+                          side_effect=real_draft) as draft:
+            img = _decode_image(buf, max_dimension=1000)
+        draft.assert_called_once_with(img, None, (1000, 500))
+        self.assertEqual(img.size, (1000, 500))
+
+    def test_processed_upload_capped_at_max_dimension(self):
+        cid = self._processed_cocktail((2000, 1000))
+        with app.app_context():
+            cocktail = db.session.get(Cocktail, cid)
+            self.assertEqual(cocktail.image_variants["width"], app.config["IMAGE_MAX_DIMENSION"])
+
+
+# ===========================================================================
+# 34. Transactional Email Outbox
+# ===========================================================================
+
+class EmailOutboxTests(_BaseSuite):
+
+    def setUp(self):
+        super().setUp()
+        mail = app.extensions["mail"]
+        suppress = patch.object(mail, "suppress", True)
+        suppress.start()
+        self.addCleanup(suppress.stop)
+        self.mail = mail
+
+    def _queue(self, count=1):
+        from services.email_service import enqueue_email
+        with app.app_context():
+            for i in range(count):
+                enqueue_email(f"Subject {i}", [f"user{i}@example.com"], "Body")
+            db.session.commit()
+
+    def _relay(self, **kwargs):
+        from services.email_service import relay_outbox
+        with app.app_context():
+            return relay_outbox(**kwargs)
+
+    def _rows(self):
+        with app.app_context():
+            return [(r.status, r.attempts, r.next_attempt_at, r.last_error)
+                    for r in EmailOutbox.query.order_by(EmailOutbox.id)]
+
+    def test_email_committed_with_the_action(self):
+        with app.app_context():
+            admin_id = _make_user("admin", "admin@example.com", is_admin=True).id
+            target_id = _make_user("target", "target@example.com").id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = admin_id
+        with patch("services.email_service._deliver.delay") as delay:
+            self.client.post(f"/admin/user/{target_id}/ban")
+        delay.assert_not_called()
+        with app.app_context():
+            queued = EmailOutbox.query.one()
+            self.assertEqual(queued.recipients, ["target@example.com"])
+            self.assertIsNotNone(db.session.get(User, target_id).ban_until)
+
+    def test_rolled_back_action_leaves_no_email(self):
+        from services.email_service import enqueue_email
+        with app.app_context():
+            enqueue_email("Subject", ["a@example.com"], "Body")
+            db.session.rollback()
+            self.assertEqual(EmailOutbox.query.count(), 0)
+
+    def test_relay_sends_due_emails_in_batches(self):
+        self._queue(5)
+        with self.mail.record_messages() as outbox:
+            self.assertEqual(self._relay(batch_size=2), 5)
+        self.assertEqual([m.recipients for m in outbox],
+                         [[f"user{i}@example.com"] for i in range(5)])
+        self.assertTrue(all(status == "sent" for status, *_ in self._rows()))
+        with app.app_context():
+            self.assertTrue(all(r.sent_at for r in EmailOutbox.query))
+        self.assertEqual(self._relay(), 0)
+
+    def test_failed_send_retried_with_backoff(self):
+        import smtplib
+        self._queue(2)
+        before = datetime.now(timezone.utc).replace(tzinfo=None)
+        calls = []
+
+        def flaky(message):
+            calls.append(message.recipients)
+            if len(calls) == 1:
+                raise smtplib.SMTPRecipientsRefused({})
+
+        with patch("flask_mail.Connection.send", side_effect=flaky):
+            self.assertEqual(self._relay(), 1)
+        (status, attempts, next_at, error), sent = self._rows()
+        self.assertEqual((status, attempts, sent[0]), ("pending", 1, "sent"))
+        self.assertGreaterEqual(next_at, before + timedelta(seconds=30))
+        self.assertIsNotNone(error)
+        # Not due yet, so the next run leaves it alone.
+        self.assertEqual(self._relay(), 0)
+
+    def test_connection_failure_defers_whole_batch(self):
+        self._queue(3)
+        with patch("extensions.mail.connect", side_effect=OSError("refused")):
+            self.assertEqual(self._relay(), 0)
+        self.assertEqual([(s, a, e) for s, a, _n, e in self._rows()],
+                         [("pending", 1, "refused")] * 3)
+
+    def test_gives_up_after_max_attempts(self):
+        from services.email_service import MAX_DELIVERY_ATTEMPTS
+        self._queue()
+        with app.app_context():
+            EmailOutbox.query.one().attempts = MAX_DELIVERY_ATTEMPTS - 1
+            db.session.commit()
+        with patch("extensions.mail.connect", side_effect=OSError("refused")):
+            self._relay()
+        self.assertEqual(self._rows()[0][:2], ("failed", MAX_DELIVERY_ATTEMPTS))
+
+    def test_one_session_reused_and_reopened_when_dropped(self):
+        import smtplib
+        from extensions import mail
+        self._queue(4)
+        calls = []
+
+        def drops_once(message):
+            calls.append(message.recipients)
+            if len(calls) == 2:
+                raise smtplib.SMTPServerDisconnected("idle timeout")
+
+        with patch("flask_mail.Connection.send", side_effect=drops_once), \
+                patch.object(mail, "connect", wraps=mail.connect) as connect:
+            self.assertEqual(self._relay(), 4)
+        self.assertEqual(connect.call_count, 2)
+        # The message that hit the dropped session is resent, not lost.
+        self.assertEqual(calls[1], calls[2])
+        self.assertTrue(all(status == "sent" for status, *_ in self._rows()))
+
+    def test_permanently_refused_recipient_fails_only_that_email(self):
+        import smtplib
+
+        def refuse_user1(message):
+            if message.recipients == ["user1@example.com"]:
+                raise smtplib.SMTPRecipientsRefused(
+                    {"user1@example.com": (550, b"5.1.1 No such user")})
+
+        self._queue(3)
+        with patch("flask_mail.Connection.send", side_effect=refuse_user1):
+            self.assertEqual(self._relay(), 2)
+        rows = self._rows()
+        self.assertEqual([r[:2] for r in rows],
+                         [("sent", 0), ("failed", 1), ("sent", 0)])
+        self.assertIn("No such user", rows[1][3])
+
+
+# ===========================================================================
+# 35. Admin Broadcasts
+# ===========================================================================
+
+class BroadcastTests(_BaseSuite):
+
+    def setUp(self):
+        super().setUp()
+        suppress = patch.object(app.extensions["mail"], "suppress", True)
+        suppress.start()
+        self.addCleanup(suppress.stop)
+        with app.app_context():
+            self.admin_id = _make_user("admin", "admin@example.com", is_admin=True).id
+            _make_user("verified", "verified@example.com")
+            _make_user("pending", "pending@example.com", verified=False)
+            banned = _make_user("banned", "banned@example.com")
+            banned.ban_until = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(days=1)
+            expired = _make_user("expired", "expired@example.com")
+            expired.ban_until = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=1)
+            _make_user("forever", "forever@example.com").is_permanently_banned = True
+            db.session.commit()
+
+    def _create(self, audience="all"):
+        from services.broadcast_service import create_broadcast
+        with app.app_context():
+            broadcast = create_broadcast(self.admin_id, "Announcement", "Hello everyone!", audience)
+            db.session.commit()
+            return broadcast.id
+
+    def _recipients(self, broadcast_id):
+        with app.app_context():
+            return sorted(
+                email for (email,) in db.session.query(User.email)
+                .join(BroadcastDelivery, BroadcastDelivery.user_id == User.id)
+                .filter(BroadcastDelivery.broadcast_id == broadcast_id)
+            )
+
+    def _dispatch(self, run_chunks=True):
+        from celery.exceptions import Retry
+        from services.broadcast_service import dispatch_broadcasts, send_broadcast_chunk
+        chunks = []
+
+        def enqueue(args):
+            chunks.append(args)
+            if run_chunks:
+                try:
+                    send_broadcast_chunk(*args)
+                except Retry:
+                    pass  # a worker would run it again later
+
+        with patch.object(send_broadcast_chunk, "apply_async", side_effect=enqueue):
+            with app.app_context():
+                dispatch_broadcasts()
+        return chunks
+
+    def _progress(self, broadcast_id):
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = self.admin_id
+        return self.client.get(f"/admin/broadcast/{broadcast_id}/progress").get_json()
+
+    def test_audiences_resolved_with_one_insert_select(self):
+        self.assertEqual(self._recipients(self._create("unverified")), ["pending@example.com"])
+        self.assertEqual(self._recipients(self._create("banned")),
+                         ["banned@example.com", "forever@example.com"])
+        everyone = self._create("all")
+        self.assertEqual(len(self._recipients(everyone)), 6)
+        with app.app_context():
+            self.assertEqual(db.session.get(Broadcast, everyone).total_recipients, 6)
+
+    def test_route_queues_without_sending(self):
+        from services.broadcast_service import send_broadcast_chunk
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = self.admin_id
+        with app.extensions["mail"].record_messages() as outbox, \
+                patch.object(send_broadcast_chunk, "apply_async") as enqueue:
+            resp = self.client.post("/admin/broadcasts", data={
+                "audience": "verified", "subject": "Maintenance", "body": "Down for an hour tonight.",
+            }, follow_redirects=True)
+        self.assertIn(b"Broadcast queued for 5 users", resp.data)
+        self.assertEqual((outbox, enqueue.call_count), ([], 0))
+        with app.app_context():
+            broadcast = Broadcast.query.one()
+            self.assertEqual((broadcast.status, broadcast.total_recipients), ("queued", 5))
+            self.assertEqual(AdminAuditLog.query.filter_by(action="broadcast").count(), 1)
+
+    def test_dispatch_splits_pending_deliveries_into_chunks(self):
+        broadcast_id = self._create()
+        with app.app_context():
+            ids = sorted(d.user_id for d in BroadcastDelivery.query)
+        with patch("services.broadcast_service.CHUNK_SIZE", 4):
+            chunks = self._dispatch(run_chunks=False)
+        self.assertEqual(chunks, [(broadcast_id, None, ids[3]), (broadcast_id, ids[3], None)])
+        self.assertEqual(self._progress(broadcast_id)["status"], "sending")
+
+    def test_chunks_send_every_email_and_complete(self):
+        broadcast_id = self._create("banned")
+        with app.extensions["mail"].record_messages() as outbox, \
+                patch("services.broadcast_service.CHUNK_SIZE", 1):
+            self._dispatch()
+        self.assertEqual(sorted(m.recipients[0] for m in outbox),
+                         ["banned@example.com", "forever@example.com"])
+        self.assertEqual(self._progress(broadcast_id), {
+            "id": broadcast_id, "status": "done", "total": 2, "sent": 2, "failed": 0, "percent": 100,
+        })
+        # A redelivered chunk finds nothing pending and sends nothing.
+        from services.broadcast_service import send_broadcast_chunk
+        with app.extensions["mail"].record_messages() as outbox:
+            with app.app_context():
+                send_broadcast_chunk(broadcast_id, None, None)
+        self.assertEqual(outbox, [])
+
+    def test_refused_recipient_fails_and_transient_error_retries(self):
+        import smtplib
+        from celery.exceptions import Retry
+        from services.broadcast_service import send_broadcast_chunk
+
+        def refuse(message):
+            code = {"pending@example.com": 550, "banned@example.com": 451}.get(message.recipients[0])
+            if code:
+                raise smtplib.SMTPRecipientsRefused({message.recipients[0]: (code, b"no")})
+
+        broadcast_id = self._create()
+        with patch("flask_mail.Connection.send", side_effect=refuse), \
+                patch.object(send_broadcast_chunk, "retry", side_effect=Retry()) as retry:
+            self._dispatch()
+        retry.assert_called_once()
+        progress = self._progress(broadcast_id)
+        self.assertEqual((progress["status"], progress["sent"], progress["failed"]),
+                         ("sending", 4, 1))
+        with app.app_context():
+            still_pending = BroadcastDelivery.query.filter_by(status="pending").one()
+            self.assertEqual(db.session.get(User, still_pending.user_id).email, "banned@example.com")
+
+    def test_chunk_commits_sends_in_batches(self):
+        from services.broadcast_service import send_broadcast_chunk
+
+        class WorkerLost(BaseException):
+            pass
+
+        calls = []
+
+        def send(message):
+            calls.append(message.recipients[0])
+            if len(calls) == 3:
+                raise WorkerLost()
+
+        broadcast_id = self._create()
+        with patch("services.broadcast_service.COMMIT_EVERY", 2), \
+                patch("flask_mail.Connection.send", side_effect=send):
+            with app.app_context():
+                with self.assertRaises(WorkerLost):
+                    send_broadcast_chunk(broadcast_id, None, None)
+                db.session.rollback()
+        with app.app_context():
+            sent = BroadcastDelivery.query.filter_by(status="sent").count()
+            self.assertEqual((sent, db.session.get(Broadcast, broadcast_id).sent_count), (2, 2))
+        # The redelivered chunk picks up after the committed batch.
+        with app.extensions["mail"].record_messages() as outbox, \
+                patch("services.broadcast_service.COMMIT_EVERY", 2):
+            with app.app_context():
+                self.assertEqual(send_broadcast_chunk(broadcast_id, None, None), 4)
+        self.assertNotIn(calls[0], [m.recipients[0] for m in outbox])
+        self.assertEqual(self._progress(broadcast_id)["sent"], 6)
+
+    def test_dispatch_requeues_broadcast_when_broker_down(self):
+        from services.broadcast_service import dispatch_broadcasts, send_broadcast_chunk
+        broadcast_id = self._create()
+        with patch.object(send_broadcast_chunk, "apply_async", side_effect=OSError("broker down")):
+            with app.app_context():
+                self.assertEqual(dispatch_broadcasts(), 0)
+        self.assertEqual(self._progress(broadcast_id)["status"], "queued")
+
+
+# ===========================================================================
+# 36. Beat Maintenance Jobs
+# ===========================================================================
+
+class MaintenanceJobTests(_BaseSuite):
+
+    def _now(self):
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def _run(self, job, **kwargs):
+        import services.maintenance as maintenance
+        with app.app_context():
+            return getattr(maintenance, job)(**kwargs)
+
+    def test_expired_bans_lifted_in_batches_with_email(self):
+        now = self._now()
+        with app.app_context():
+            expired = [_make_user(f"expired{i}", f"expired{i}@example.com") for i in range(3)]
+            for user in expired:
+                user.ban_until = now - timedelta(minutes=5)
+            _make_user("active", "active@example.com").ban_until = now + timedelta(days=1)
+            permanent = _make_user("forever", "forever@example.com")
+            permanent.ban_until, permanent.is_permanently_banned = now - timedelta(days=1), True
+            db.session.add(UserAppeal(user_id=expired[0].id, appeal_text="x" * 60))
+            db.session.commit()
+            appellant_id = expired[0].id
+
+        self.assertEqual(self._run("lift_expired_bans", batch_size=2), 3)
+
+        with app.app_context():
+            self.assertEqual(User.query.filter(User.ban_until.isnot(None)).count(), 2)
+            self.assertTrue(User.query.filter_by(username="forever").one().is_permanently_banned)
+            self.assertEqual(sorted(r for e in EmailOutbox.query for r in e.recipients),
+                             [f"expired{i}@example.com" for i in range(3)])
+            self.assertEqual(UserAppeal.query.one().status, "expired")
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = appellant_id
+        self.assertIn(b"Suspension Ended", self.client.get("/appeal/status").data)
+        self.assertEqual(self._run("lift_expired_bans"), 0)
+
+    def test_only_stale_unverified_non_admins_purged(self):
+        old = self._now() - timedelta(days=app.config["UNVERIFIED_ACCOUNT_TTL_DAYS"] + 1)
+        with app.app_context():
+            for name, verified, is_admin, created in [
+                ("stale", False, False, old), ("stale2", False, False, old),
+                ("recent", False, False, self._now()),
+                ("verified", True, False, old), ("admin", False, True, old),
+            ]:
+                _make_user(name, f"{name}@example.com", verified=verified,
+                           is_admin=is_admin).created_at = created
+            db.session.commit()
+
+        self.assertEqual(self._run("purge_unverified_accounts", batch_size=1), 2)
+
+        with app.app_context():
+            self.assertEqual(sorted(u.username for u in User.query),
+                             ["admin", "recent", "verified"])
+
+    def test_decided_appeals_archived_after_window(self):
+        window = app.config["APPEAL_ARCHIVE_AFTER_DAYS"]
+        old = self._now() - timedelta(days=window + 1)
+        with app.app_context():
+            user_id = _make_user().id
+            appeals = [
+                UserAppeal(user_id=user_id, appeal_text="a" * 60, status="rejected",
+                           admin_response="No.", admin_response_date=old),
+                UserAppeal(user_id=user_id, appeal_text="b" * 60, status="approved",
+                           admin_response_date=old),
+                UserAppeal(user_id=user_id, appeal_text="c" * 60, status="rejected",
+                           admin_response_date=self._now()),
+                UserAppeal(user_id=user_id, appeal_text="d" * 60, status="pending"),
+            ]
+            db.session.add_all(appeals)
+            db.session.commit()
+            archived_ids = [appeals[0].id, appeals[1].id]
+
+        self.assertEqual(self._run("archive_decided_appeals", batch_size=1), 2)
+
+        with app.app_context():
+            self.assertEqual(sorted(a.appeal_text[0] for a in UserAppeal.query), ["c", "d"])
+            rows = UserAppealArchive.query.order_by(UserAppealArchive.id).all()
+            self.assertEqual([r.id for r in rows], archived_ids)
+            self.assertEqual((rows[0].status, rows[0].admin_response, rows[0].user_id),
+                             ("rejected", "No.", user_id))
+            self.assertIsNotNone(rows[0].archived_at)
+
+
+# ===========================================================================
+# 37. Celery Queue Routing and Worker Profiles
+# ===========================================================================
+
+class CeleryQueueRoutingTests(unittest.TestCase):
+    """Tasks land on their queue and each queue has a worker profile."""
+
+    @classmethod
+    def setUpClass(cls):
+        import celery_worker
+        cls.worker = celery_worker
+
+    def _queue(self, task_name):
+        from extensions import celery
+        return celery.amqp.router.route({}, task_name)['queue'].name
+
+    def test_every_task_routes_to_a_declared_queue(self):
+        from app import CELERY_QUEUES
+        from extensions import celery
+        app_tasks = [name for name in celery.tasks if not name.startswith('celery.')]
+        self.assertGreater(len(app_tasks), 5)
+        for name in app_tasks:
+            self.assertIn(self._queue(name), CELERY_QUEUES, name)
+
+    def test_verification_email_separated_from_bulk_and_sweeps(self):
+        self.assertEqual(self._queue('email_service.relay_outbox'), 'transactional')
+        self.assertEqual(self._queue('broadcast_service.send_broadcast_chunk'), 'bulk')
+        self.assertEqual(self._queue('thumb_cache.fetch_thumb'), 'bulk')
+        self.assertEqual(self._queue('cocktail_service.collect_orphaned_api_cocktails'), 'maintenance')
+        self.assertEqual(self._queue('maintenance.lift_expired_bans'), 'maintenance')
+        for entry in self.worker.celery.conf.beat_schedule.values():
+            self.assertIn(self._queue(entry['task']), ('transactional', 'bulk', 'maintenance'))
+
+    def test_bulk_sends_rate_limited_but_transactional_relay_not(self):
+        from extensions import celery
+        self.assertEqual(celery.tasks['broadcast_service.send_broadcast_chunk'].rate_limit, '10/m')
+        self.assertIsNone(celery.tasks['email_service.relay_outbox'].rate_limit)
+
+    def test_each_queue_has_a_dedicated_profile(self):
+        from app import CELERY_QUEUES
+        for queue in CELERY_QUEUES:
+            self.assertEqual(self.worker.WORKER_PROFILES[queue]['queues'], (queue,))
+
+    def test_worker_argv_applies_profile_then_extra_options(self):
+        argv = self.worker.worker_argv('bulk', ['--concurrency', '8'])
+        self.assertEqual(argv[:7], ['worker', '--queues', 'bulk', '--concurrency', '2',
+                                    '--prefetch-multiplier', '1'])
+        self.assertEqual(argv[-2:], ['--concurrency', '8'])
+        self.assertIn('bulk@%h', argv)
+
+
+# ===========================================================================
+# 38. Password Hashing Pool and Adaptive Cost
+# ===========================================================================
+
+class PasswordHashingTests(_BaseSuite):
+
+    def setUp(self):
+        super().setUp()
+        self._saved = {k: app.config[k] for k in (
+            "BCRYPT_LOG_ROUNDS", "PASSWORD_HASH_WORKERS", "PASSWORD_HASH_TIMEOUT")}
+        app.config["BCRYPT_LOG_ROUNDS"] = 5
+
+    def tearDown(self):
+        app.config.update(self._saved)
+        super().tearDown()
+
+    def test_calibration_doubles_up_to_target_within_bounds(self):
+        from services import passwords
+        calibrate = passwords.calibrate_rounds.__wrapped__
+        with patch("services.passwords._time_hash", return_value=0.05):
+            self.assertEqual(calibrate(250), passwords.MIN_LOG_ROUNDS + 2)
+            self.assertEqual(calibrate(1), passwords.MIN_LOG_ROUNDS)
+            self.assertEqual(calibrate(10 ** 6), passwords.MAX_LOG_ROUNDS)
+
+    def test_login_rehashes_password_made_at_old_cost(self):
+        from services.passwords import bcrypt, hash_rounds
+        with app.app_context():
+            user = _make_user()
+            user.password = bcrypt.generate_password_hash("Testpass1", 4).decode()
+            db.session.commit()
+
+        self.assertEqual(_login(self.client).status_code, 200)
+
+        with app.app_context():
+            stored = User.query.one().password
+            self.assertEqual(hash_rounds(stored), 5)
+            self.assertTrue(User.authenticate("testuser", "Testpass1"))
+            self.assertFalse(User.authenticate("testuser", "wrong"))
+            self.assertEqual(User.query.one().password, stored)
+
+    def test_stronger_hash_is_kept(self):
+        from services.passwords import bcrypt, needs_rehash
+        with app.app_context():
+            self.assertFalse(needs_rehash(bcrypt.generate_password_hash("x", 6).decode()))
+            self.assertFalse(needs_rehash(bcrypt.generate_password_hash("x", 5).decode()))
+            self.assertTrue(needs_rehash(bcrypt.generate_password_hash("x", 4).decode()))
+            self.assertTrue(needs_rehash("not-a-bcrypt-hash"))
+
+    def test_unset_cost_calibrated_only_in_debug(self):
+        from flask import Flask
+        from services import passwords
+        for debug, expected in ((False, 12), (True, 11)):
+            other = Flask(__name__)
+            other.config.update(DEBUG=debug, BCRYPT_LOG_ROUNDS=0, BCRYPT_TARGET_MS=250,
+                                PASSWORD_HASH_WORKERS=1)
+            with patch.object(passwords, "calibrate_rounds", return_value=11) as calibrate:
+                passwords.init_app(other)
+            self.assertEqual(other.config["BCRYPT_LOG_ROUNDS"], expected)
+            self.assertEqual(calibrate.called, debug)
+
+    def test_saturated_pool_refuses_login_with_503(self):
+        import threading
+        from services import passwords
+        with app.app_context():
+            _make_user()
+        app.config.update(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_TIMEOUT=0.05)
+        release = threading.Event()
+        with app.app_context():
+            blocker = passwords._executor().submit(release.wait, 5)
+        rejected = passwords.pool_stats()["rejected"]
+        try:
+            resp = _login(self.client)
+        finally:
+            release.set()
+            blocker.result()
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn(b"Please try again in a moment", resp.data)
+        self.assertEqual(passwords.pool_stats()["rejected"], rejected + 1)
+        app.config["PASSWORD_HASH_TIMEOUT"] = 5
+        self.assertEqual(_login(self.client).status_code, 200)
+
+    def test_pool_stats_record_queue_wait(self):
+        from services import passwords
+        before = passwords.pool_stats()
+        with app.app_context():
+            passwords.check_password(passwords.hash_password("Testpass1"), "Testpass1")
+        after = passwords.pool_stats()
+        self.assertEqual(after["completed"], before["completed"] + 2)
+        self.assertGreaterEqual(after["wait_seconds_total"], before["wait_seconds_total"])
+        self.assertEqual((after["queued"], after["running"]), (0, 0))
+
+
+# ===========================================================================
+# 39. Server-Side Sessions
+# ===========================================================================
+
+class _FakeRedis:
+    """Dict-backed stand-in for the Redis commands the session store uses."""
+
+    def __init__(self):
+        self.store, self.sets = {}, {}
+        self.reads = 0
+        self.down = False
+
+    def _check(self):
+        if self.down:
+            import redis
+            raise redis.ConnectionError("Connection refused")
+
+    def getex(self, key, ex=None):
+        self._check()
+        self.reads += 1
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None, nx=False, xx=False):
+        self._check()
+        if (nx and key in self.store) or (xx and key not in self.store):
+            return None
+        self.store[key] = value
+        return True
+
+    def delete(self, *keys):
+        self._check()
+        return sum(self.store.pop(key, None) is not None for key in keys)
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def srem(self, key, *members):
+        self.sets.get(key, set()).difference_update(members)
+
+    def smembers(self, key):
+        self._check()
+        return {m.encode() for m in self.sets.get(key, ())}
+
+    def expire(self, key, ttl):
+        return True
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+
+    def __init__(self, client):
+        self.client, self.calls = client, []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class ServerSessionTests(_BaseSuite):
+
+    def setUp(self):
+        from services.sessions import RedisSessionInterface
+        super().setUp()
+        if not isinstance(app.session_interface, RedisSessionInterface):
+            self.skipTest("SESSION_STORE is not 'redis'")
+        self.redis = _FakeRedis()
+        for patcher in (patch.object(app.session_interface, "client", self.redis),
+                        patch("services.user_context.cache", _DictCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        app.session_interface._local.clear()
+        self.addCleanup(app.session_interface._local.clear)
+
+    def _sid(self, client):
+        cookie = client.get_cookie("session")
+        return cookie.value.split(".")[0] if cookie else None
+
+    def test_login_stores_compact_id_and_writes_back_only_changes(self):
+        with app.app_context():
+            uid = _make_user().id
+        _login(self.client)
+        value = self.client.get_cookie("session").value
+        self.assertRegex(value, r"^[\w-]{32}\.\d+$")
+        self.assertIn(f"session:{self._sid(self.client)}", self.redis.store)
+        self.assertEqual(self.redis.sets[f"user_sessions:{uid}"], {self._sid(self.client)})
+
+        self.client.get("/my-cocktails")
+        resp = self.client.get("/my-cocktails")
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(any(h.startswith("session=") for h in resp.headers.getlist("Set-Cookie")))
+
+    def test_session_loaded_lazily_and_cached_locally(self):
+        with app.app_context():
+            _make_user()
+        _login(self.client)
+        self.client.get("/my-cocktails")
+        app.session_interface._local.clear()
+        self.redis.reads = 0
+        self.client.get("/static/app.css")
+        self.assertEqual(self.redis.reads, 0)
+        self.client.get("/my-cocktails")
+        self.client.get("/my-cocktails")
+        self.assertEqual(self.redis.reads, 1)
+
+    def test_session_snapshot_skips_user_lookup(self):
+        from services.user_context import CurrentUser
+        with app.app_context():
+            _make_user()
+        _login(self.client)
+        self.client.get("/my-cocktails")
+        with patch.object(CurrentUser, "from_model") as loader, \
+                patch("services.user_context._cache_get") as cache_get:
+            resp = self.client.get("/my-cocktails")
+        self.assertEqual(resp.status_code, 200)
+        loader.assert_not_called()
+        cache_get.assert_not_called()
+
+    def test_login_rotates_session_id(self):
+        with app.app_context():
+            _make_user()
+        with self.client.session_transaction() as sess:
+            sess["pending_verification_user_id"] = 99
+        before = self._sid(self.client)
+        _login(self.client)
+        self.assertNotEqual(self._sid(self.client), before)
+        self.assertNotIn(f"session:{before}", self.redis.store)
+
+    def test_ban_revokes_active_sessions(self):
+        with app.app_context():
+            _make_user(username="sessadm", email="sessadm@example.com", is_admin=True)
+            target_id = _make_user().id
+        target = app.test_client()
+        _login(target)
+        self.assertEqual(target.get("/my-cocktails").status_code, 200)
+        target_sid = self._sid(target)
+
+        _login(self.client, username="sessadm")
+        self.client.post(f"/admin/user/{target_id}/ban-permanent")
+
+        self.assertNotIn(f"session:{target_sid}", self.redis.store)
+        resp = target.get("/my-cocktails")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("/login", resp.headers["Location"])
+        # Logging back in lands on the appeal form, as before.
+        self.assertIn(b"appeal", _login(target).data.lower())
+
+    def test_own_flag_change_keeps_current_session_only(self):
+        from config import ADMIN_PASSWORD_KEY
+        with app.app_context():
+            _make_user()
+        other = app.test_client()
+        _login(other)
+        _login(self.client)
+        other_sid = self._sid(other)
+
+        self.client.post("/admin/unlock", data={"admin_key": ADMIN_PASSWORD_KEY})
+
+        self.assertNotIn(f"session:{other_sid}", self.redis.store)
+        self.assertEqual(self.client.get("/admin/panel").status_code, 200)
+
+    def test_store_outage_falls_back_to_signed_cookie(self):
+        with app.app_context():
+            _make_user()
+        self.redis.down = True
+        _login(self.client)
+        self.assertGreaterEqual(self.client.get_cookie("session").value.count("."), 2)
+        self.assertEqual(self.client.get("/my-cocktails").status_code, 200)
+
+        self.redis.down = False
+        self.client.post("/logout")
+        _login(self.client)
+        self.assertIsNotNone(self._sid(self.client))
+        self.assertIn(f"session:{self._sid(self.client)}", self.redis.store)
+
+
+# ===========================================================================
+# 40. Shared Redis Connection Pool
+# ===========================================================================
+
+class RedisPoolTests(unittest.TestCase):
+    """Cache, limiter and sessions borrow from one bounded pool."""
+
+    def test_consumers_share_one_pool(self):
+        from extensions import cache, redis_pool
+        pool = redis_pool.pool(app)
+        with app.app_context():
+            self.assertIs(cache.cache.redis._write_client.connection_pool, pool)
+        self.assertIs(app.config["RATELIMIT_STORAGE_OPTIONS"]["connection_pool"], pool)
+        if hasattr(app.session_interface, "client"):
+            self.assertIs(app.session_interface.client.connection_pool, pool)
+
+    def test_pool_bounded_with_keepalive_and_health_checks(self):
+        from extensions import redis_pool
+        pool = redis_pool.pool(app)
+        self.assertEqual(pool.max_connections, app.config["REDIS_MAX_CONNECTIONS"])
+        self.assertTrue(pool.connection_kwargs["socket_keepalive"])
+        self.assertEqual(pool.connection_kwargs["health_check_interval"],
+                         app.config["REDIS_HEALTH_CHECK_INTERVAL"])
+
+    def test_celery_connections_capped_to_same_size(self):
+        from extensions import celery
+        size = app.config["REDIS_MAX_CONNECTIONS"]
+        self.assertEqual(celery.conf.broker_pool_limit, size)
+        self.assertEqual(celery.conf.broker_transport_options["max_connections"], size)
+        self.assertEqual(celery.conf.redis_max_connections, size)
+
+    def test_stats_count_checkouts_and_failures(self):
+        import redis
+        from redis_pool import RedisPool
+        fake_app = type("FakeApp", (), {"extensions": {}, "config": {
+            "REDIS_URL": "redis://127.0.0.1:1/0", "REDIS_MAX_CONNECTIONS": 2,
+            "REDIS_POOL_TIMEOUT": 0.1, "REDIS_SOCKET_TIMEOUT": 0.1,
+            "REDIS_HEALTH_CHECK_INTERVAL": 30, "REDIS_BREAKER_THRESHOLD": 3,
+            "REDIS_RECONNECT_MAX": 30,
+        }})()
+        pool = RedisPool()
+        pool.init_app(fake_app)
+        with self.assertRaises(redis.ConnectionError):
+            pool.client(fake_app).get("key")
+        stats = pool.stats(fake_app)
+        self.assertEqual((stats["max_connections"], stats["errors"], stats["in_use"]), (2, 1, 0))
+
+
+# ===========================================================================
+# 41. Redis Outage Handling
+# ===========================================================================
+
+class RedisFailoverTests(unittest.TestCase):
+    """Breaker, per-process cache and task fallback while Redis is down."""
+
+    def _breaker(self, **kwargs):
+        from redis_pool import CircuitBreaker
+        return CircuitBreaker(**{"threshold": 2, "base_delay": 10, "max_delay": 40, **kwargs})
+
+    def _failover_cache(self, shared_only=()):
+        import redis
+        from flask_caching.backends.simplecache import SimpleCache
+        from unittest.mock import MagicMock
+        from redis_pool import FailoverRedisCache
+        primary = MagicMock()
+        primary.get.side_effect = redis.ConnectionError("down")
+        primary.set.side_effect = redis.ConnectionError("down")
+        return FailoverRedisCache(primary, SimpleCache(threshold=10),
+                                  shared_only=shared_only), primary
+
+    def test_breaker_opens_after_threshold_with_jittered_delay(self):
+        breaker = self._breaker()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        snapshot = breaker.snapshot()
+        self.assertEqual((snapshot["state"], snapshot["trips"]), ("open", 1))
+        self.assertTrue(5 <= snapshot["reconnect_in"] <= 10)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.snapshot()["rejected"], 1)
+
+    def test_breaker_lends_one_probe_and_closes_on_success(self):
+        breaker = self._breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.retry_at = 0.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, "half-open")
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_backs_off_further(self):
+        breaker = self._breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.retry_at = 0.0
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertTrue(10 <= breaker.snapshot()["reconnect_in"] <= 20)
+
+    def test_open_breaker_fails_checkouts_without_connecting(self):
+        import redis
+        from redis_pool import _MeteredPool
+        pool = _MeteredPool.from_url("redis://127.0.0.1:1/0", breaker=self._breaker())
+        pool.breaker.record_failure()
+        pool.breaker.record_failure()
+        with patch.object(pool, "make_connection") as make:
+            with self.assertRaises(redis.ConnectionError):
+                pool.get_connection()
+        make.assert_not_called()
+
+    def test_cache_falls_back_locally_and_clears_on_recovery(self):
+        cache_backend, primary = self._failover_cache()
+        cache_backend.set("all_cocktails", [1, 2])
+        self.assertEqual(cache_backend.get("all_cocktails"), [1, 2])
+        self.assertTrue(cache_backend.degraded)
+        primary.get.side_effect = None
+        primary.get.return_value = None
+        self.assertIsNone(cache_backend.get("all_cocktails"))
+        self.assertFalse(cache_backend.degraded)
+        self.assertFalse(cache_backend.local.has("all_cocktails"))
+
+    def test_shared_only_keys_raise_instead_of_falling_back(self):
+        import redis
+        cache_backend, _ = self._failover_cache(shared_only=("user_ctx:",))
+        with self.assertRaises(redis.ConnectionError):
+            cache_backend.get("user_ctx:1")
+        self.assertIsNone(cache_backend.get("api_ingredients_list"))
+
+    def test_app_cache_configured_for_failover(self):
+        from extensions import cache
+        with app.app_context():
+            backend = cache.cache
+        self.assertEqual(backend.shared_only, ("user_ctx:",))
+        self.assertEqual(backend.local._threshold, app.config["CACHE_LOCAL_MAX_ITEMS"])
+
+    def test_local_task_runs_in_process_while_breaker_open(self):
+        from extensions import redis_pool
+        from services.thumb_cache import fetch_thumb
+        breaker = self._breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        with patch.object(redis_pool, "breaker", return_value=breaker), \
+                patch("task_fallback.submit_local") as submit, \
+                patch("celery.app.task.Task.apply_async") as publish:
+            self.assertIsNone(fetch_thumb.apply_async(("a/b.jpg",)))
+        publish.assert_not_called()
+        submit.assert_called_once()
+        self.assertEqual(submit.call_args.args[1], ("a/b.jpg",))
+
+    def test_other_tasks_raise_so_callers_fall_back(self):
+        from kombu.exceptions import OperationalError
+        from extensions import redis_pool
+        from services.broadcast_service import send_broadcast_chunk
+        breaker = self._breaker()
+        with patch.object(redis_pool, "breaker", return_value=breaker), \
+                patch("celery.app.task.Task.apply_async",
+                      side_effect=OperationalError("refused")):
+            for _ in range(2):
+                with self.assertRaises(OperationalError):
+                    send_broadcast_chunk.apply_async((1, 0, 10))
+        self.assertEqual(breaker.state, "open")
+
+    def test_local_backlog_is_bounded(self):
+        from unittest.mock import MagicMock
+        import task_fallback
+        task = MagicMock()
+        task.name = "slow"
+        with app.app_context(), \
+                patch.dict(app.config, {"CELERY_LOCAL_BACKLOG": 0}):
+            before = task_fallback.stats()["dropped"]
+            self.assertFalse(task_fallback.submit_local(task, ("x",)))
+            self.assertEqual(task_fallback.stats()["dropped"], before + 1)
+        task.assert_not_called()
+
+
+# ===========================================================================
+# 42. Per-request Server-Timing Instrumentation
+# ===========================================================================
+
+class RequestTimingTests(_BaseSuite):
+    """Sampled requests report DB, cache, CocktailDB and template timings."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(app.config.update,
+                        {"SERVER_TIMING_SAMPLE_RATE": app.config["SERVER_TIMING_SAMPLE_RATE"]})
+        app.config["SERVER_TIMING_SAMPLE_RATE"] = 1.0
+        with app.app_context():
+            self.uid = _make_user(username="timed", email="timed@example.com").id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = self.uid
+
+    def test_unsampled_requests_get_no_header(self):
+        app.config["SERVER_TIMING_SAMPLE_RATE"] = 0
+        self.assertNotIn("Server-Timing", self.client.get("/").headers)
+
+    def test_header_reports_queries_templates_and_total(self):
+        header = self.client.get("/").headers["Server-Timing"]
+        self.assertRegex(header, r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertRegex(header, r'tmpl;dur=[\d.]+;desc="1 templates"')
+        self.assertRegex(header, r"total;dur=[\d.]+$")
+        self.assertNotIn("cocktaildb", header)
+
+    def test_structured_log_line_per_sampled_request(self):
+        import json
+        with self.assertLogs("request_timing", level="INFO") as logs:
+            self.client.get("/")
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line["path"], line["status"], line["endpoint"]),
+                         ("/", 200, "users.homepage"))
+        self.assertGreater(line["db_queries"], 0)
+        self.assertEqual(line["templates"], 1)
+
+    def test_cache_hits_misses_and_cocktaildb_calls_counted(self):
+        from unittest.mock import MagicMock
+        from flask import g
+        from flask_caching.backends.simplecache import SimpleCache
+        import request_timing
+        from cocktaildb_api import lookup_cocktail
+        from redis_pool import FailoverRedisCache
+        primary = MagicMock()
+        primary.get.side_effect = lambda key: "hit" if key == "warm" else None
+        backend = FailoverRedisCache(primary, SimpleCache())
+        response = MagicMock()
+        response.json.return_value = {"drinks": []}
+        with app.test_request_context("/"):
+            g._request_timings = timings = request_timing.RequestTimings()
+            backend.get("warm")
+            backend.get("cold")
+            with patch("cocktaildb_api.requests.get", return_value=response):
+                lookup_cocktail("11007")
+        self.assertEqual((timings.hits, timings.misses, timings.counts["cache"]), (1, 1, 2))
+        self.assertEqual(timings.counts["cocktaildb"], 1)
+        self.assertIn('cache;dur=', timings.header(0.01))
+        self.assertIn('desc="1 hits, 1 misses"', timings.header(0.01))
+
+    def test_failed_statement_leaves_no_state_on_connection(self):
+        from flask import g
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+        import request_timing
+        with app.test_request_context("/"):
+            g._request_timings = timings = request_timing.RequestTimings()
+            with self.assertRaises(OperationalError):
+                db.session.execute(text("SELECT * FROM no_such_table"))
+            db.session.rollback()
+            db.session.execute(text("SELECT 1"))
+            info = dict(db.session.connection().info)
+        self.assertEqual(timings.counts["db"], 1)
+        self.assertEqual(info, {})
+
+
+# ===========================================================================
+# 43. Prometheus Metrics Endpoint
+# ===========================================================================
+
+class MetricsEndpointTests(_BaseSuite):
+    """/metrics exposes request, cache, CocktailDB and Celery series locally."""
+
+    def _sample(self, name, **labels):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    def test_restricted_to_localhost_like_heartbeat(self):
+        response = self.client.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.5"})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+
+    def test_token_required_when_configured_even_from_localhost(self):
+        self.addCleanup(app.config.update, {"METRICS_TOKEN": app.config["METRICS_TOKEN"]})
+        app.config["METRICS_TOKEN"] = "s3cret"
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        wrong = {"Authorization": "Bearer nope"}
+        self.assertEqual(self.client.get("/metrics", headers=wrong).status_code, 403)
+        right = {"Authorization": "Bearer s3cret"}
+        response = self.client.get("/metrics", headers=right,
+                                   environ_base={"REMOTE_ADDR": "10.0.0.5"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_request_latency_by_endpoint_and_status(self):
+        labels = {"endpoint": "auth.login", "status": "200"}
+        before = self._sample("http_request_duration_seconds_count", **labels)
+        self.client.get("/login")
+        self.assertEqual(self._sample("http_request_duration_seconds_count", **labels),
+                         before + 1)
+        body = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="auth.login"', body)
+
+    def test_unmatched_urls_share_one_label(self):
+        labels = {"endpoint": "<unmatched>", "status": "404"}
+        before = self._sample("http_request_duration_seconds_count", **labels)
+        self.client.get("/no-such-page-1")
+        self.client.get("/no-such-page-2")
+        self.assertEqual(self._sample("http_request_duration_seconds_count", **labels),
+                         before + 2)
+
+    def test_cache_lookups_counted_for_tracked_keys_only(self):
+        from unittest.mock import MagicMock
+        from flask_caching.backends.simplecache import SimpleCache
+        from redis_pool import FailoverRedisCache
+        primary = MagicMock()
+        primary.get.side_effect = lambda key: [] if key == "all_cocktails" else None
+        backend = FailoverRedisCache(primary, SimpleCache())
+        hit = {"key": "all_cocktails", "result": "hit"}
+        miss = {"key": "api_ingredients_list", "result": "miss"}
+        before = (self._sample("cache_lookups_total", **hit),
+                  self._sample("cache_lookups_total", **miss))
+        backend.get("all_cocktails")
+        backend.get("api_ingredients_list")
+        backend.get("user_ctx:1")
+        self.assertEqual((self._sample("cache_lookups_total", **hit),
+                          self._sample("cache_lookups_total", **miss)),
+                         (before[0] + 1, before[1] + 1))
+        self.assertEqual(self._sample("cache_lookups_total", key="user_ctx:1", result="miss"), 0)
+
+    def test_cocktaildb_latency_and_errors(self):
+        import requests
+        from cocktaildb_api import _upstream_call
+        count = self._sample("cocktaildb_request_duration_seconds_count")
+        errors = self._sample("cocktaildb_errors_total", error="ConnectionError")
+        with self.assertRaises(requests.ConnectionError):
+            with _upstream_call():
+                raise requests.ConnectionError("refused")
+        self.assertEqual(self._sample("cocktaildb_request_duration_seconds_count"), count + 1)
+        self.assertEqual(self._sample("cocktaildb_errors_total", error="ConnectionError"),
+                         errors + 1)
+
+    def test_celery_enqueue_latency_by_outcome(self):
+        from redis_pool import CircuitBreaker
+        from extensions import redis_pool
+        from services.broadcast_service import send_broadcast_chunk
+        breaker = CircuitBreaker(threshold=1)
+        breaker.record_failure()
+        labels = {"task": send_broadcast_chunk.name, "outcome": "skipped"}
+        before = self._sample("celery_enqueue_duration_seconds_count", **labels)
+        with patch.object(redis_pool, "breaker", return_value=breaker):
+            with self.assertRaises(Exception):
+                send_broadcast_chunk.apply_async((1, 0, 10))
+        self.assertEqual(self._sample("celery_enqueue_duration_seconds_count", **labels),
+                         before + 1)
+
+    def test_db_pool_gauges_follow_checkouts(self):
+        import tempfile
+        from sqlalchemy import create_engine, text
+        from sqlalchemy.pool import QueuePool
+        import metrics
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f"sqlite:///{directory}/pool.db", poolclass=QueuePool,
+                                   pool_size=1, max_overflow=2)
+            metrics._watch_pool(engine)
+            with engine.connect() as first, engine.connect() as second:
+                first.execute(text("select 1"))
+                second.execute(text("select 1"))
+                self.assertEqual((self._sample("db_pool_checked_out"),
+                                  self._sample("db_pool_overflow")), (2, 1))
+            self.assertEqual((self._sample("db_pool_checked_out"),
+                              self._sample("db_pool_overflow")), (0, 0))
+            engine.dispose()
+
+    def test_multiprocess_directory_is_merged_when_configured(self):
+        import tempfile
+        import metrics
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}), \
+                patch("metrics.multiprocess.MultiProcessCollector") as collector:
+            metrics.render()
+        collector.assert_called_once()
+
+
+# ===========================================================================
+# 44. Per-route Query Budgets
+# ===========================================================================
+
+class QueryBudgetTests(_BaseSuite):
+    """Views stay within their @query_budget and read views do not grow with data."""
+
+    def _seed(self, n):
+        """*n* of everything the read views list; returns the ids they need."""
+        owner = _make_user(username="owner", email="owner@example.com")
+        admin = _make_user(username="boss", email="boss@example.com", is_admin=True)
+        ingredients = [Ingredient(name=f"Ingredient {i}") for i in range(n)]
+        db.session.add_all(ingredients)
+        db.session.flush()
+        original = variant = None
+        for i in range(n):
+            original = Cocktail(name=f"Original {i}", instructions="Shake.", owner_id=owner.id)
+            shared = Cocktail(name=f"Shared {i}", instructions="Stir.",
+                              is_api_cocktail=True, api_cocktail_id=str(9000 + i))
+            db.session.add_all([original, shared])
+            db.session.flush()
+            variant = Cocktail(name=f"Shared {i}", owner_id=owner.id,
+                               source_cocktail_id=shared.id)
+            db.session.add(variant)
+            db.session.flush()
+            for ingredient in ingredients:
+                db.session.add_all([
+                    Cocktails_Ingredients(cocktail_id=original.id,
+                                          ingredient_id=ingredient.id, quantity="1 oz"),
+                    Cocktails_Ingredients(cocktail_id=shared.id,
+                                          ingredient_id=ingredient.id, quantity="2 oz"),
+                ])
+            db.session.add(Cocktails_Ingredients(cocktail_id=variant.id,
+                                                 ingredient_id=ingredients[i].id,
+                                                 quantity="3 oz"))
+            db.session.add_all([
+                Cocktails_Users(user_id=owner.id, cocktail_id=original.id),
+                Cocktails_Users(user_id=owner.id, cocktail_id=variant.id),
+                UserFavoriteIngredients(user_id=owner.id, ingredient_id=ingredients[i].id),
+                AdminMessage(user_id=owner.id, subject=f"Subject {i}", message="Hello there",
+                             message_type="suggestion", admin_response="Thanks",
+                             admin_response_date=datetime.utcnow()),
+                Broadcast(admin_id=admin.id, subject=f"News {i}", body="Body",
+                          audience="all", status="done"),
+            ])
+            banned = User(username=f"banned{i}", email=f"banned{i}@example.com",
+                          password="x", is_email_verified=True,
+                          ban_until=datetime.utcnow() + timedelta(days=7))
+            db.session.add(banned)
+            db.session.flush()
+            db.session.add(UserAppeal(user_id=banned.id, appeal_text="Please", status="pending"))
+        db.session.commit()
+        return {"owner": owner.id, "admin": admin.id,
+                "original": original.id, "variant": variant.id}
+
+    def _read_view_counts(self, n):
+        import query_counter
+        # Requests run outside this context so each gets its own ``g``.
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            ids = self._seed(n)
+        pages = [
+            ("owner", "/"),
+            ("owner", "/my-cocktails"),
+            ("owner", f"/edit-cocktail/{ids['original']}"),
+            ("owner", f"/edit-cocktail/{ids['variant']}"),
+            ("owner", f"/users/profile/{ids['owner']}"),
+            ("owner", "/user/messages"),
+            ("admin", "/admin/panel"),
+            ("admin", "/admin/messages"),
+            ("admin", "/admin/broadcasts"),
+        ]
+        counts = {}
+        ingredients = {"drinks": [{"strIngredient1": "Gin"}]}
+        with patch("blueprints.users.list_ingredients", return_value=ingredients):
+            for who, path in pages:
+                with self.client.session_transaction() as sess:
+                    sess["user_id"] = ids[who]
+                # Over budget raises QueryBudgetExceeded here (TESTING).
+                with query_counter.count_queries() as counter:
+                    response = self.client.get(path)
+                self.assertEqual(response.status_code, 200, path)
+                counts[path.replace(str(ids["original"]), "<original>")
+                       .replace(str(ids["variant"]), "<variant>")
+                       .replace(str(ids["owner"]), "<owner>")] = counter.count
+        return counts
+
+    def test_every_blueprint_view_declares_a_budget(self):
+        missing = [endpoint for endpoint, view in app.view_functions.items()
+                   if "." in endpoint and not hasattr(view, "query_budget")]
+        self.assertEqual(missing, [])
+
+    def test_read_views_stay_within_budget_and_do_not_grow_with_data(self):
+        small = self._read_view_counts(2)
+        large = self._read_view_counts(6)
+        self.assertEqual(large, small)
+
+    def test_over_budget_request_raises(self):
+        import query_counter
+        with app.app_context():
+            uid = _make_user().id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        with patch.object(app.view_functions["users.homepage"], "query_budget", 0):
+            with self.assertRaises(query_counter.QueryBudgetExceeded) as raised:
+                self.client.get("/")
+        self.assertIn("users.homepage", str(raised.exception))
+        self.assertIn("SELECT", str(raised.exception))
+
+    def test_log_mode_warns_and_serves_the_response(self):
+        with app.app_context():
+            uid = _make_user().id
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = uid
+        self.addCleanup(app.config.update, {"QUERY_BUDGET_MODE": app.config["QUERY_BUDGET_MODE"]})
+        app.config["QUERY_BUDGET_MODE"] = "log"
+        with patch.object(app.view_functions["users.homepage"], "query_budget", 0), \
+                self.assertLogs(level="WARNING") as logs:
+            response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("its budget is 0", logs.output[-1])
+
+    def test_count_queries_counts_nested_blocks(self):
+        from query_counter import count_queries
+        with app.app_context():
+            with count_queries() as outer:
+                User.query.count()
+                with count_queries() as inner:
+                    User.query.count()
+        self.assertEqual((outer.count, inner.count), (2, 1))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -5,7 +5,7 @@ from unittest.mock import patch
 
 from app import app
 from extensions import limiter
-from models import db, User, Ingredient, Cocktail, Cocktails_Users, Cocktails_Ingredients, UserAppeal
+from models import db, User, Ingredient, Cocktail, Cocktails_Users, Cocktails_Ingredients, UserAppeal, EmailOutbox
 
 
 # ---------------------------------------------------------------------------
@@ -325,7 +325,7 @@ class FlaskTestCase(unittest.TestCase):
     # ------------------------------------------------------------------
 
     def test_registration_email_sent_async(self):
-        """Registration enqueues a background email task without blocking."""
+        """Registration writes the email to the outbox without touching the broker."""
         with patch('services.email_service._deliver.delay') as mock_delay:
             resp = self.client.post('/register', data={
                 'username': 'emailuser',
@@ -334,7 +334,11 @@ class FlaskTestCase(unittest.TestCase):
                 'confirm': 'Emailpass1',
             }, follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
-            mock_delay.assert_called_once()
+            mock_delay.assert_not_called()
+        with app.app_context():
+            queued = EmailOutbox.query.one()
+            self.assertEqual(queued.recipients, ['email@example.com'])
+            self.assertEqual(queued.status, 'pending')
 
     # ------------------------------------------------------------------
     # Password strength validation
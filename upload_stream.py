@@ -0,0 +1,62 @@
+"""Request class that validates uploaded images while they stream in.
+
+Werkzeug spools every file part of a multipart body to a temporary file
+before the view runs, so without this a request carrying a non-image (or a
+decompression bomb) would be stored in full — up to ``MAX_CONTENT_LENGTH``
+— before ``_check_upload_gates`` looked at its first eight bytes.
+
+:class:`UploadRequest` wraps each file part's container in a
+:class:`SniffedUpload`, which runs
+:func:`services.cocktail_service.check_image_header` on the first bytes as
+they arrive.  Once a file is rejected the rest of it is discarded instead
+of written, and the reason is left on the stream for the gates to report
+through the form's usual error message.  Bodies whose ``Content-Length``
+exceeds ``MAX_CONTENT_LENGTH`` are still refused by Werkzeug with 413
+before any of the body is read.
+"""
+from flask import Request
+
+from services.cocktail_service import check_image_header
+
+
+# Image headers (including a JPEG's EXIF block) fit well within this; a
+# file whose header is still incomplete here is left to the full gates.
+_SNIFF_LIMIT = 64 * 1024
+
+
+class SniffedUpload:
+    """File-part container that checks the image header as data arrives."""
+
+    def __init__(self, container):
+        self._container = container
+        self._head = b''
+        self._sniffing = True
+        self.rejected = None
+
+    def write(self, data: bytes) -> int:
+        if self.rejected is not None:
+            return len(data)  # discard everything after a rejection
+        if self._sniffing:
+            self._head += data[:_SNIFF_LIMIT - len(self._head)]
+            try:
+                accepted = check_image_header(self._head)
+            except ValueError as exc:
+                self.rejected = str(exc)
+                self._container.seek(0)
+                self._container.truncate()
+                return len(data)
+            self._sniffing = not accepted and len(self._head) < _SNIFF_LIMIT
+        return self._container.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._container, name)
+
+
+class UploadRequest(Request):
+    """Flask request whose uploaded files are validated while streaming."""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return SniffedUpload(super()._get_file_stream(
+            total_content_length, content_type, filename, content_length
+        ))